@@ -0,0 +1,615 @@
+'''
+batch_module.py
+
+Incremental batch reduction of whole nights and archives, driven by a JSON config instead of notebook edits
+
+Every night in the config is turned into a graph of nodes, each of which makes one or more products from its
+inputs:
+
+    dark/<night>                  master dark (median of the night's darks)
+    flat/<night>                  master flat (median of the flats, dark subtracted, divided by its median)
+    reduced/<night>/nNNNN         one science frame, dark subtracted and flat fielded
+    photometry/<night>/<base>     top and bottom channel sums of every frame of a sequence, as an ECSV table
+    fit/<night>/<base>            harmonic fit of the normalized difference vs HWP angle (per IMR angle) and the
+                                  double-difference q and u of the sequence, as JSON
+    throughput/<name>             measure_throughput on a throughput data set, as an ECSV table
+
+A node depends on whatever node makes one of its inputs. The state file (STATE_NAME in the output folder)
+records, for every node, a hash of its parameters and the content hashes of its inputs and outputs. On the next
+run a node is only rebuilt if one of those changed or an output is missing, and since the hashes are of content
+rather than modification times, a rebuilt product that comes out the same doesn't trigger anything downstream.
+Nodes whose inputs are ready run in parallel in a pool of worker processes
+
+Config:
+    {
+      "output": "reduced",                         ...relative paths are relative to the config file
+      "params": {"output_format": "float32", "harmonics": [4]},
+      "nights": [
+        {"name": "2025oct02_H", "directory": "/home/shared/.../2025oct02", "frames": [3, 21], "skip": [7, 13],
+         "darks": ["/home/shared/.../2025sep18/n0007.fits"], "flats": [1]}
+      ],
+      "throughput": [
+        {"name": "JHK_waveplates", "directory": "...", "wvls": ["1100", "1500"], "threshold": 1000, "radius": 75}
+      ]
+    }
+frames is an inclusive range of frame numbers and skip a list of frame numbers to leave out. darks and flats are
+frame numbers or paths...without them, frames whose OBJECT contains 'dark' or 'flat' are used. Science frames
+are the ones with a sequence label (polarimetry_module.parse_label). params of a night override the global ones
+
+From a shell:
+    python batch_module.py nights.json --workers 4
+    python batch_module.py nights.json --dry-run
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+import argparse
+import contextlib
+import concurrent.futures
+from astropy.io import fits
+from astropy.table import Table
+import catalog_module as cm
+import collapse_module as cl
+import harmonic_module as hm
+import photometry_module as pm
+import polarimetry_module as pol
+import product_module as prd
+import profiling_module as pr
+import throughput_module as tm
+
+#######################################################################
+
+# state file kept in the output folder
+STATE_NAME = 'batch_state.json'
+
+# frame numbers of NIRC2 file names
+FRAME_NUMBER = re.compile(r'^n(\d+)\.fits$')
+
+# parameters used where the config doesn't give them
+DEFAULTS = {
+    'pattern': 'n*.fits',
+    'output_format': 'float32',
+    'quantize_level': prd.QUANTIZE_LEVEL,
+    'channels': pol.CHANNELS,
+    # the HWP modulates the normalized difference at 4 theta...a standard 4-angle cycle pins that harmonic down,
+    #   while fitting 2 and 4 together needs more angles, e.g. a grid sequence
+    'harmonics': [4],
+    'collapse_threads': 1,
+    'checkpoints': False,
+}
+
+# version of each kind of node...bumping one rebuilds every node of that kind, e.g. after a change in how it is made
+VERSIONS = {'dark': 1, 'flat': 1, 'reduced': 1, 'photometry': 1, 'fit': 3, 'throughput': 1}
+
+############################## Node functions ################################
+
+@contextlib.contextmanager
+def _replacing(write_path):
+    '''
+    yields a temporary path to write a product to, which is moved over write_path once it is complete...an
+        interrupted node never leaves a product behind that looks finished
+    '''
+
+    os.makedirs(os.path.dirname(write_path), exist_ok = True)
+    root, ext = os.path.splitext(write_path)
+    tmp_path = root + '.' + str(os.getpid()) + '.tmp' + ext
+    try:
+        yield tmp_path
+        os.replace(tmp_path, write_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _make_master(kind, files, dark_path, write_path, params):
+    '''
+    builds a master dark or flat from its frames (see calibration_module.build_master for the recipe)
+    '''
+
+    with contextlib.ExitStack() as stack:
+        hduls = [stack.enter_context(fits.open(f)) for f in files]
+        hdr = prd.data_hdu(hduls[0]).header.copy()
+        master = cl.collapse([prd.data_hdu(hdul).section for hdul in hduls], 'median',
+                             n_threads = params['collapse_threads'])
+
+    if kind == 'flat':
+        if dark_path is not None:
+            master = master - prd.read_data(dark_path)
+        master = master / np.median(master)
+
+    hdr['NCOMBINE'] = len(files)
+    with _replacing(write_path) as tmp_path:
+        # masters are kept at full precision whatever the products are written as
+        prd.write_product(tmp_path, master, hdr)
+
+def _reduce_frame(raw_path, dark_path, flat_path, write_path, params):
+    '''
+    dark subtracts and flat fields one frame (the mean of its coadded frames, if it is a cube)
+    '''
+
+    with fits.open(raw_path) as hdul:
+        hdu = prd.data_hdu(hdul)
+        hdr = hdu.header.copy()
+        frame = np.asarray(hdu.data, dtype = float)
+
+    if frame.ndim == 3:
+        frame = frame.mean(axis = 0)
+    if dark_path is not None:
+        frame = frame - prd.read_data(dark_path)
+    if flat_path is not None:
+        flat = prd.read_data(flat_path)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frame = np.where(flat != 0, frame / flat, np.nan)
+
+    with _replacing(write_path) as tmp_path:
+        prd.write_product(tmp_path, frame, hdr, params['output_format'], params['quantize_level'])
+
+def _photometry(frame_paths, write_path, params):
+    '''
+    top and bottom channel sums of every reduced frame of a sequence
+    '''
+
+    boxes = np.array([params['channels']['top'], params['channels']['bottom']])
+
+    rows = []
+    for path in frame_paths:
+        with fits.open(path) as hdul:
+            hdu = prd.data_hdu(hdul)
+            base, hwp, imr = pol.parse_label(hdu.header['OBJECT'])
+            top, bottom = pm.box_sums(np.asarray(hdu.data, dtype = float), boxes)[0]
+        rows.append((os.path.basename(path), hwp, np.nan if imr is None else imr, top, bottom,
+                     (top - bottom) / (top + bottom)))
+
+    table = Table(rows = rows, names = ('file', 'hwp', 'imr', 'top', 'bottom', 'norm_diff'))
+    with _replacing(write_path) as tmp_path:
+        table.write(tmp_path, format = 'ascii.ecsv')
+
+def _fit(photometry_path, write_path, params):
+    '''
+    harmonic fit of the normalized difference vs HWP angle for every IMR angle of a sequence, and the
+        double-difference q and u from the mean normalized difference at the four critical angles
+    '''
+
+    table = Table.read(photometry_path, format = 'ascii.ecsv')
+    harmonics = tuple(params['harmonics'])
+    n_params = 1 + 2 * len(harmonics)
+
+    fits_out = []
+    imrs = np.unique(np.asarray(table['imr'], dtype = float))
+    for imr in imrs:
+        rows = table[np.isnan(table['imr'])] if np.isnan(imr) else table[table['imr'] == imr]
+        angles = np.asarray(rows['hwp'], dtype = float)
+        norm_diff = np.asarray(rows['norm_diff'], dtype = float)
+
+        entry = {'imr': None if np.isnan(imr) else float(imr), 'n_frames': len(rows)}
+        # the fit needs enough distinct angles (mod 360/k) to pin down every parameter
+        if np.linalg.matrix_rank(hm.harmonic_design(angles, harmonics)) == n_params:
+            fit = hm.fit_harmonics(angles, norm_diff, harmonics)
+            for key in ('offset', 'amplitude', 'amplitude_err', 'peak_angle', 'peak_angle_err', 'residual_rms'):
+                entry[key] = np.asarray(fit[key]).tolist()
+        else:
+            entry['skipped'] = 'rank deficient'
+
+        # double differences, if every critical angle was taken
+        means = {a: norm_diff[angles == a].mean() for a in pol.HWP_ANGLES if np.any(angles == a)}
+        if len(means) == len(pol.HWP_ANGLES):
+            entry['q'] = float((means[0.0] - means[45.0]) / 2)
+            entry['u'] = float((means[22.5] - means[67.5]) / 2)
+        fits_out.append(entry)
+
+    with _replacing(write_path) as tmp_path:
+        with open(tmp_path, 'w') as fo:
+            json.dump({'harmonics': list(harmonics), 'fits': fits_out}, fo, indent = 1)
+
+def _throughput(directory, wvls, threshold, radius, write_path, params):
+    '''
+    runs measure_throughput on a throughput data set and saves the results table
+    '''
+
+    with contextlib.redirect_stdout(sys.stderr):
+        table = tm.measure_throughput(directory, wvls, threshold, radius, checkpoints = params['checkpoints'],
+                                      output_format = params['output_format'],
+                                      quantize_level = params['quantize_level'],
+                                      collapse_threads = params['collapse_threads'])
+    if table is False:
+        raise RuntimeError('measure_throughput failed on ' + directory)
+
+    with _replacing(write_path) as tmp_path:
+        table.write(tmp_path, format = 'ascii.ecsv')
+
+############################## Graph ################################
+
+def _node(name, func, args, inputs, outputs, params):
+    '''
+    one node of the graph...func(*args) makes the outputs from the inputs
+    '''
+
+    kind = name.split('/')[0]
+    return {'name': name, 'kind': kind, 'func': func, 'args': args, 'inputs': list(inputs), 'outputs': list(outputs),
+            'params': dict(params, version = VERSIONS[kind]), 'deps': []}
+
+def _frame_number(path):
+    '''
+    frame number of an nNNNN.fits file, None for other names
+    '''
+
+    match = FRAME_NUMBER.match(os.path.basename(path))
+    return None if match is None else int(match.group(1))
+
+def _select(directory, entries, rows):
+    '''
+    the files a list of frame numbers or paths from the config stands for
+    '''
+
+    by_number = {_frame_number(row['path']): os.path.join(directory, row['path']) for row in rows}
+    return [by_number[entry] if isinstance(entry, int) else os.path.abspath(entry) for entry in entries]
+
+def night_nodes(night, output, params):
+    '''
+    the nodes of one night
+    in:
+        night (dict) - the night's entry in the config
+        output (str) - output folder...the night's products go in <output>/<name>
+        params (dict) - parameters, the defaults and global ones with the night's on top
+    out:
+        nodes (list of dict) - the night's nodes, in an order that respects their dependencies
+    '''
+
+    name = night['name']
+    directory = os.path.abspath(night['directory'])
+    night_dir = os.path.join(output, name)
+
+    # the header catalog is kept with the night's products, so the raw directory is never written to
+    os.makedirs(night_dir, exist_ok = True)
+    rows = cm.query_catalog(directory, params['pattern'], db_path = os.path.join(night_dir, cm.CATALOG_NAME))
+    numbers = [_frame_number(row['path']) for row in rows]
+    first, last = night.get('frames', (None, None))
+    skip = set(night.get('skip', ()))
+    selected = [row for row, n in zip(rows, numbers)
+                if n not in skip and (first is None or (n is not None and first <= n <= last))]
+
+    def pick(key, word):
+        if key in night:
+            return _select(directory, night[key], rows)
+        return [os.path.join(directory, row['path']) for row in selected if word in str(row['object']).lower()]
+
+    darks = pick('darks', 'dark')
+    flats = pick('flats', 'flat')
+
+    nodes = []
+    dark_path = flat_path = None
+    if darks:
+        dark_path = os.path.join(night_dir, 'calib', 'master_dark.fits')
+        nodes.append(_node('dark/' + name, _make_master, ('dark', darks, None, dark_path, params), darks,
+                           [dark_path], {'collapse': 'median'}))
+    if flats:
+        flat_path = os.path.join(night_dir, 'calib', 'master_flat.fits')
+        inputs = flats + ([dark_path] if dark_path else [])
+        nodes.append(_node('flat/' + name, _make_master, ('flat', flats, dark_path, flat_path, params), inputs,
+                           [flat_path], {'collapse': 'median'}))
+
+    # science frames, grouped by the base of their sequence label
+    sequences = {}
+    for row in selected:
+        label = pol.parse_label(row['object'])
+        if label is None:
+            continue
+        raw_path = os.path.join(directory, row['path'])
+        write_path = os.path.join(night_dir, 'reduced', os.path.basename(row['path'])[:-len('.fits')] + '_red.fits')
+        inputs = [raw_path] + [p for p in (dark_path, flat_path) if p is not None]
+        nodes.append(_node('reduced/' + name + '/' + os.path.basename(row['path'])[:-len('.fits')], _reduce_frame,
+                           (raw_path, dark_path, flat_path, write_path, params), inputs, [write_path],
+                           {key: params[key] for key in ('output_format', 'quantize_level')}))
+        sequences.setdefault(label[0], []).append(write_path)
+
+    for base, frame_paths in sequences.items():
+        phot_path = os.path.join(night_dir, 'photometry', base + '.ecsv')
+        fit_path = os.path.join(night_dir, 'fits', base + '.json')
+        nodes.append(_node('photometry/' + name + '/' + base, _photometry, (frame_paths, phot_path, params),
+                           frame_paths, [phot_path], {'channels': params['channels']}))
+        nodes.append(_node('fit/' + name + '/' + base, _fit, (phot_path, fit_path, params), [phot_path],
+                           [fit_path], {'harmonics': params['harmonics']}))
+
+    return nodes
+
+def throughput_nodes(entry, output, params):
+    '''
+    the node of one throughput data set...its inputs are the raw files, not the products measure_throughput
+        may checkpoint next to them
+    '''
+
+    directory = os.path.abspath(entry['directory'])
+    inputs = sorted(f for wvl in entry['wvls'] for f in glob.glob(os.path.join(directory, '**', '*' + wvl + '*.fits'),
+                                                                   recursive = True) if '_dsub' not in f)
+    write_path = os.path.join(output, 'throughput', entry['name'] + '.ecsv')
+    args = (directory, entry['wvls'], entry['threshold'], entry['radius'], write_path, params)
+    used = {key: entry[key] for key in ('wvls', 'threshold', 'radius')}
+    used.update({key: params[key] for key in ('checkpoints', 'output_format', 'quantize_level')})
+
+    return [_node('throughput/' + entry['name'], _throughput, args, inputs, [write_path], used)]
+
+def load_config(path):
+    '''
+    reads a batch config...relative paths in it are taken relative to the config file
+    in:
+        path (str) - JSON config, see the module docstring
+    out:
+        config (dict) - with absolute 'output' and 'directory' paths
+    '''
+
+    with open(path) as fo:
+        config = json.load(fo)
+
+    root = os.path.dirname(os.path.abspath(path))
+
+    def absolute(p):
+        return os.path.normpath(os.path.join(root, os.path.expanduser(p)))
+
+    config['output'] = absolute(config.get('output', 'reduced'))
+    for entry in config.get('nights', []) + config.get('throughput', []):
+        entry['directory'] = absolute(entry['directory'])
+        for key in ('darks', 'flats'):
+            if key in entry:
+                entry[key] = [e if isinstance(e, int) else absolute(e) for e in entry[key]]
+
+    return config
+
+def build_graph(config):
+    '''
+    the nodes of every night and throughput data set in a config, with each node's 'deps' (the names of the
+        nodes that make its inputs) filled in
+    in:
+        config (dict) - from load_config
+    out:
+        nodes (list of dict) - in an order that respects their dependencies
+    '''
+
+    output = config['output']
+    base_params = dict(DEFAULTS, **config.get('params', {}))
+
+    nodes = []
+    for night in config.get('nights', []):
+        nodes += night_nodes(night, output, dict(base_params, **night.get('params', {})))
+    for entry in config.get('throughput', []):
+        nodes += throughput_nodes(entry, output, dict(base_params, **entry.get('params', {})))
+
+    makers = {path: node['name'] for node in nodes for path in node['outputs']}
+    for node in nodes:
+        node['deps'] = sorted({makers[path] for path in node['inputs'] if path in makers})
+
+    return nodes
+
+############################## State ################################
+
+def _params_hash(params):
+    '''
+    hash of a node's parameters
+    '''
+
+    return hashlib.sha1(json.dumps(params, sort_keys = True, default = str).encode()).hexdigest()
+
+def file_hash(path, state):
+    '''
+    content hash of a file...kept in the state with the file's modification time and size, so a file is only read
+        again when one of those changes
+    in:
+        path (str) - the file
+        state (dict) - from load_state
+    out:
+        digest (str) - sha1 of the contents, None if the file isn't there
+    '''
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    cached = state['files'].get(path)
+    if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+        return cached[2]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fo:
+        for block in iter(lambda: fo.read(1 << 20), b''):
+            sha.update(block)
+    state['files'][path] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+
+    return sha.hexdigest()
+
+def load_state(output):
+    '''
+    the state of the products in an output folder...empty if nothing was built there yet
+    '''
+
+    path = os.path.join(output, STATE_NAME)
+    if not os.path.exists(path):
+        return {'files': {}, 'nodes': {}}
+
+    with open(path) as fo:
+        return json.load(fo)
+
+def save_state(output, state):
+    '''
+    saves the state...written to a temporary file first so an interrupted save doesn't lose it
+    '''
+
+    os.makedirs(output, exist_ok = True)
+    path = os.path.join(output, STATE_NAME)
+    with open(path + '.tmp', 'w') as fo:
+        json.dump(state, fo)
+    os.replace(path + '.tmp', path)
+
+def out_of_date(node, state):
+    '''
+    why a node has to be rebuilt
+    in:
+        node (dict) - from build_graph
+        state (dict) - from load_state
+    out:
+        reason (str) - e.g. 'new', 'parameters changed' or 'input changed: <path>'...None if it is up to date
+    '''
+
+    record = state['nodes'].get(node['name'])
+    if record is None:
+        return 'new'
+    if record['params'] != _params_hash(node['params']):
+        return 'parameters changed'
+    if sorted(record['inputs']) != sorted(node['inputs']):
+        return 'inputs changed'
+
+    for path in node['inputs']:
+        if file_hash(path, state) != record['inputs'][path]:
+            return 'input changed: ' + path
+    for path in node['outputs']:
+        digest = file_hash(path, state)
+        if digest is None:
+            return 'output missing: ' + path
+        if digest != record['outputs'].get(path):
+            return 'output changed: ' + path
+
+    return None
+
+def _record(node, state):
+    '''
+    notes in the state what a node was just built from and what it made
+    '''
+
+    state['nodes'][node['name']] = {
+        'params': _params_hash(node['params']),
+        'inputs': {path: file_hash(path, state) for path in node['inputs']},
+        'outputs': {path: file_hash(path, state) for path in node['outputs']},
+    }
+
+############################## Runner ################################
+
+def _run_node(func, args, name):
+    '''
+    runs one node, as a profiling stage
+    '''
+
+    with pr.stage('batch_node', node = name):
+        func(*args)
+
+def run(config, n_workers = 1, dry_run = False, force = False, verbose = True):
+    '''
+    brings every product of a config up to date
+    in:
+        config (dict or str) - from load_config, or the path to a config file
+        n_workers (int or None) - worker processes nodes are spread over...1 runs them in order in this process,
+            None uses every core
+        dry_run (bool) - only report what would be rebuilt...a node downstream of one that would be rebuilt is
+            counted as rebuilt too
+        force (bool) - rebuild everything
+        verbose (bool) - print every node that is built
+    out:
+        summary (dict) - lists of node names 'built', 'up_to_date', 'failed' and 'blocked' (not run because a node
+            they depend on failed)
+    '''
+
+    if isinstance(config, str):
+        config = load_config(config)
+
+    output = config['output']
+    state = load_state(output)
+    nodes = build_graph(config)
+    by_name = {node['name']: node for node in nodes}
+
+    summary = {'built': [], 'up_to_date': [], 'failed': [], 'blocked': []}
+    finished = set()
+    pending = list(nodes)
+    running = {}
+
+    def ready(node):
+        return all(dep in finished for dep in node['deps'])
+
+    def blocked(node):
+        return any(dep in summary['failed'] or dep in summary['blocked'] for dep in node['deps'])
+
+    def finish(node, error = None):
+        if error is not None:
+            print('FAILED ' + node['name'] + ': ' + repr(error))
+            summary['failed'].append(node['name'])
+        else:
+            _record(node, state)
+            summary['built'].append(node['name'])
+            save_state(output, state)
+        finished.add(node['name'])
+
+    pool = None
+    if n_workers != 1 and not dry_run:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = n_workers, **pr.pool_args())
+
+    try:
+        while pending or running:
+            # start everything whose dependencies are done
+            for node in [node for node in pending if ready(node)]:
+                pending.remove(node)
+                if blocked(node):
+                    summary['blocked'].append(node['name'])
+                    finished.add(node['name'])
+                    continue
+
+                rebuilt_deps = [dep for dep in node['deps'] if dep in summary['built']]
+                reason = 'forced' if force else out_of_date(node, state)
+                if reason is None and dry_run and rebuilt_deps:
+                    reason = 'upstream rebuilt: ' + rebuilt_deps[0]
+                if reason is None:
+                    summary['up_to_date'].append(node['name'])
+                    finished.add(node['name'])
+                    continue
+
+                if verbose:
+                    print(('would rebuild ' if dry_run else 'building ') + node['name'] + ' (' + reason + ')')
+                if dry_run:
+                    summary['built'].append(node['name'])
+                    finished.add(node['name'])
+                elif pool is None:
+                    try:
+                        _run_node(node['func'], node['args'], node['name'])
+                        finish(node)
+                    except Exception as error:
+                        finish(node, error)
+                else:
+                    running[pool.submit(_run_node, node['func'], node['args'], node['name'])] = node
+
+            if not running:
+                if pending and not any(ready(node) for node in pending):
+                    # can't happen with the graphs build_graph makes, but never spin forever
+                    for node in pending:
+                        summary['blocked'].append(node['name'])
+                    break
+                continue
+
+            done, not_done = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                finish(node, future.exception())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if verbose:
+        print('{} built, {} up to date, {} failed, {} blocked'.format(
+            len(summary['built']), len(summary['up_to_date']), len(summary['failed']), len(summary['blocked'])))
+
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'incremental batch reduction of NIRC2-Pol nights')
+    parser.add_argument('config', help = 'JSON config of the nights and throughput data sets to reduce')
+    parser.add_argument('--workers', type = int, default = 1, help = 'worker processes, 0 for every core')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'only list what would be rebuilt')
+    parser.add_argument('--force', action = 'store_true', help = 'rebuild everything')
+    parser.add_argument('--profile', help = 'JSON lines file to write a profile of the run to (profiling_module)')
+    args = parser.parse_args()
+
+    if args.profile:
+        pr.start(args.profile)
+    summary = run(args.config, args.workers or None, args.dry_run, args.force)
+    sys.exit(1 if summary['failed'] else 0)
@@ -0,0 +1,663 @@
+'''
+benchmark_module.py
+
+Reproducible benchmarks of the reductions on synthetic NIRC2-like data, so a change can be checked for speed
+before it meets a real night
+
+The generators write data sets that look like the real ones to the reductions: a throughput tree
+(<wvl>/Air_Meas, <wvl>/Dark_Meas, <wvl>/Data) of 1024x1024 cubes with a beam spot and per-frame OPMPOWER
+readings, and HWP sequences of nNNNN.fits frames with both Wollaston spots modulated by the HWP angle and
+labelled <base>_hwp_<angle> like HWP_Rotation_Sequence.sh and Fast_Axis_Cal_Sequence.sh label them. Nothing
+from the observatory is needed
+
+run_benchmarks() generates every data set size asked for, runs each stage (dark_subtract_2,
+normalize_photodiode_readings_aircal_2, get_throughput, measure_throughput, mod_centroid, aperture_sum, the
+double-difference reduction, the fast-axis map, the ABBA dither registration and the Mueller-matrix fit of a
+JHKL' calibration grid with bootstrap errors) and records its wall time, CPU time, peak traced memory and bytes
+read and written. Results can be saved as a baseline and compared against one later
+
+benchmark_formats() writes and reads back a dark subtracted cube (float and integer valued) and a normalized
+frame in every product format (product_module), and reports the size on disk, write and read throughput and the
+error against the float64 products the reductions used to write
+
+benchmark_qacits() makes polarimetry frames with the star behind the vortex at known offsets (Fourier optics of
+the pupil, vortex and Lyot stop, in both Wollaston beams), and reports how long the QACITS estimator takes per
+frame against the readout time and how well it recovers the offsets
+
+Typical use:
+    results = run_benchmarks('/tmp/nirc2_bench', sizes = ('small', 'medium'))
+    save_results(results, 'baseline.json')
+    ...after a change...
+    compare(run_benchmarks('/tmp/nirc2_bench'), load_results('baseline.json'))
+...or from a shell: python benchmark_module.py /tmp/nirc2_bench --sizes small medium --baseline baseline.json
+                   python benchmark_module.py /tmp/nirc2_bench --formats
+                   python benchmark_module.py /tmp/nirc2_bench --qacits
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import io
+import sys
+import json
+import glob
+import time
+import shutil
+import platform
+import argparse
+import tracemalloc
+import contextlib
+from astropy.io import fits
+import throughput_module as tm
+import polarimetry_module as pol
+import harmonic_module as hm
+import profiling_module as pr
+import product_module as prd
+import registration_module as rm
+import mueller_module as mm
+import sequence_module as sq
+import qacits_module as qm
+
+#######################################################################
+
+# data set sizes...wavelengths, positions per wavelength, frames per cube, and HWP cycles / fast-axis angles
+SIZES = {
+    'small': {'n_wvls': 1, 'n_positions': 2, 'n_frames': 4, 'n_cycles': 2, 'n_fast_axis': 18},
+    'medium': {'n_wvls': 2, 'n_positions': 4, 'n_frames': 10, 'n_cycles': 4, 'n_fast_axis': 18},
+    'large': {'n_wvls': 3, 'n_positions': 6, 'n_frames': 20, 'n_cycles': 8, 'n_fast_axis': 36},
+}
+
+# wavelengths (nm) the throughput sets are made with, as in the JHK waveplate data set
+WAVELENGTHS = ('1100', '1500', '1900')
+
+# time to read out a full NIRC2 frame, in s...the QACITS estimate of a frame should take a small fraction of it
+READOUT_TIME = 0.18
+
+# threshold and radius the throughput stages are run with
+THRESHOLD = 1000
+RADIUS = 75
+
+def _spot(shape, cy, cx, sigma, peak):
+    '''
+    gaussian spot on a frame
+    '''
+
+    yy, xx = np.indices(shape)
+    return peak * np.exp(-((yy - cy)**2 + (xx - cx)**2) / (2 * sigma**2))
+
+def _opmpower(rng, power, n_frames):
+    '''
+    an OPMPOWER header value...one photodiode reading per frame, written the way the OPM logger writes them
+    '''
+
+    return '[' + ', '.join(f'{x:.8e}' for x in rng.normal(power, power * 0.01, n_frames)) + ']'
+
+def make_throughput_set(directory, n_wvls = 2, n_positions = 4, n_frames = 10, shape = (1024, 1024), seed = 0):
+    '''
+    writes a synthetic throughput data set in the layout the throughput_module functions expect
+    in:
+        directory (str) - top directory...anything already there is removed
+        n_wvls (int) - number of wavelengths (from WAVELENGTHS)
+        n_positions (int) - position measurements per wavelength, named h3_v1, h3_v2, ...
+        n_frames (int) - frames in every cube
+        shape (tuple) - (ny, nx) of a frame
+        seed (int) - random seed...the same seed gives the same files
+    out:
+        wvls (list of str) - the wavelengths written
+        files - <wvl>/Air_Meas/Air_<wvl>.fits, <wvl>/Dark_Meas/Dark_<wvl>.fits, <wvl>/Data/<pos>_<wvl>.fits
+    '''
+
+    rng = np.random.default_rng(seed)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    wvls = list(WAVELENGTHS[:n_wvls])
+    ny, nx = shape
+
+    for wvl in wvls:
+        files = [('Dark_Meas', 'Dark', 0., 0.), ('Air_Meas', 'Air', 1., 1e-3)]
+        files += [('Data', 'h3_v' + str(i + 1), rng.uniform(0.7, 0.95), rng.uniform(0.9e-3, 1.1e-3))
+                  for i in range(n_positions)]
+
+        for folder, name, transmission, power in files:
+            os.makedirs(os.path.join(directory, wvl, folder), exist_ok = True)
+
+            # bias and read noise, plus a beam that wanders a little and scales with the laser power
+            cube = rng.normal(100., 3., (n_frames, ny, nx)).astype(np.float32)
+            if transmission > 0:
+                spot = _spot(shape, ny / 2 + rng.normal(0, 5), nx / 2 + rng.normal(0, 5), 20., 5000. * transmission)
+                cube += (spot * power / 1e-3).astype(np.float32)
+
+            hdr = fits.Header()
+            hdr['CENWAVE'] = float(wvl) / 1000
+            hdr['ITIME'] = 1.0
+            hdr['COADDS'] = 1
+            if transmission > 0:
+                hdr['OPMPOWER'] = _opmpower(rng, power, n_frames)
+
+            fits.PrimaryHDU(data = cube, header = hdr).writeto(os.path.join(directory, wvl, folder,
+                                                                             name + '_' + wvl + '.fits'))
+
+    return wvls
+
+def make_hwp_set(directory, angles = pol.HWP_ANGLES, n_cycles = 4, base_obj = 'bench', pol_frac = (0.1, -0.05),
+                 shape = (1024, 1024), channels = pol.CHANNELS, first = 1, seed = 0, dither = None, jitter = 0.,
+                 background = 0.):
+    '''
+    writes a synthetic HWP sequence as NIRC2 would...one nNNNN.fits frame per angle per cycle with both Wollaston
+        spots, the top channel modulated by (1 + q cos 4 theta + u sin 4 theta) and the bottom by the opposite...
+        with a dither, the cycles are taken A B B A like HWP_Rotation_Sequence.sh with XY set, and the sky level
+        changes from frame to frame
+    in:
+        directory (str) - folder for the frames...created if it isn't there
+        angles (list) - HWP angles of a cycle in degrees
+        n_cycles (int) - number of cycles...cycles at each A position with a dither (4 x n_cycles in all)
+        base_obj (str) - base object name of the OBJECT labels
+        pol_frac (tuple) - (q, u) of the source
+        shape (tuple) - (ny, nx) of a frame
+        channels (dict) - 'top' and 'bottom' channel boxes the spots are centred in
+        first (int) - file number of the first frame
+        seed (int) - random seed
+        dither (tuple) - (dy, dx) pixels from A to B, None for no dither
+        jitter (float) - rms pointing jitter of every frame in pixels, with a dither
+        background (float) - peak of a static background that is the same in every frame (a gradient across the
+            frame, ghost-like blobs and a fixed pixel pattern), 0 for none...it doesn't move with the dither
+    out:
+        paths (list) - the frames written, in order
+    '''
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok = True)
+    q, u = pol_frac
+
+    def spots(dy = 0., dx = 0.):
+        # the same spot, centred in each channel box
+        return [_spot(shape, (y0 + y1) / 2 + dy, (x0 + x1) / 2 + dx, 30., 10000.)
+                for y0, y1, x0, x1 in (channels['top'], channels['bottom'])]
+
+    # the static background comes from its own generator, so the frames are otherwise the same with or without it
+    static = 0.
+    if background:
+        bg_rng = np.random.default_rng(seed + 1)
+        yy, xx = np.indices(shape)
+        static = background * (yy / shape[0] + xx / shape[1]) / 2 + bg_rng.normal(0., background / 20, shape)
+        for cy, cx in bg_rng.uniform(0., 1., (8, 2)) * shape:
+            static = static + _spot(shape, cy, cx, 15., background)
+
+    if dither is None:
+        positions = [None] * n_cycles
+        fixed = spots()
+    else:
+        positions = ['A'] * n_cycles + ['B'] * (2 * n_cycles) + ['A'] * n_cycles
+
+    paths = []
+    n = first
+    for position in positions:
+        for angle in angles:
+            theta = np.radians(4 * angle)
+            mod = q * np.cos(theta) + u * np.sin(theta)
+            if position is None:
+                top, bottom = fixed
+                sky = 100.
+            else:
+                dy, dx = rng.normal(0., jitter, 2) + (np.array(dither) if position == 'B' else 0.)
+                top, bottom = spots(dy, dx)
+                sky = rng.uniform(80., 120.)
+            frame = rng.normal(sky, 3., shape) + static + top * (1 + mod) / 2 + bottom * (1 - mod) / 2
+
+            hdr = fits.Header()
+            hdr['OBJECT'] = '{}_hwp_{:.1f}'.format(base_obj, angle)
+            hdr['PCUPR'] = angle
+            hdr['ITIME'] = 1.0
+            hdr['COADDS'] = 1
+
+            path = os.path.join(directory, 'n{:04d}.fits'.format(n))
+            fits.PrimaryHDU(data = frame.astype(np.float32), header = hdr).writeto(path, overwrite = True)
+            paths.append(path)
+            n += 1
+
+    return paths
+
+def measure(func, *args, trace_memory = False, **kwargs):
+    '''
+    runs a function once and measures it...output printed by the function is swallowed
+    in:
+        func (function) - what to run, with args and kwargs
+        trace_memory (bool) - trace allocations to get the peak memory...this slows the run down, so the times of a
+            traced run shouldn't be compared with untraced ones
+    out:
+        result - what func returned
+        stats (dict) - 'wall' and 'cpu' seconds, 'peak_mem' bytes (None if not traced), 'bytes_read' and
+            'bytes_written' (None if the counters aren't available)...these count read and write calls, so data
+            astropy memory maps instead of reading doesn't show up in 'bytes_read'
+    '''
+
+    if trace_memory:
+        tracemalloc.start()
+    read0, written0 = pr.io_counters()
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+
+    wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+    read1, written1 = pr.io_counters()
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, {'wall': wall, 'cpu': cpu, 'peak_mem': peak,
+                    'bytes_read': None if read0 is None else read1 - read0,
+                    'bytes_written': None if written0 is None else written1 - written0}
+
+def _clean_products(directory):
+    '''
+    removes everything the reductions wrote, so the next run starts from the raw files again
+    '''
+
+    for f in glob.glob(os.path.join(directory, '**', '*_dsub*.fits'), recursive = True):
+        os.remove(f)
+    for f in glob.glob(os.path.join(directory, '**', 'header_catalog.sqlite'), recursive = True):
+        os.remove(f)
+
+def _stages(work_dir, size):
+    '''
+    the stages to benchmark for one data set size...(name, setup, func) with setup run untimed before func
+    '''
+
+    thru_dir = os.path.join(work_dir, size, 'throughput')
+    hwp_dir = os.path.join(work_dir, size, 'hwp')
+    fast_dir = os.path.join(work_dir, size, 'fast_axis')
+    dither_dir = os.path.join(work_dir, size, 'dither')
+    params = SIZES[size]
+
+    wvls = make_throughput_set(thru_dir, params['n_wvls'], params['n_positions'], params['n_frames'])
+    if os.path.exists(hwp_dir):
+        shutil.rmtree(hwp_dir)
+    make_hwp_set(hwp_dir, n_cycles = params['n_cycles'])
+    if os.path.exists(fast_dir):
+        shutil.rmtree(fast_dir)
+    make_hwp_set(fast_dir, angles = np.arange(params['n_fast_axis']) * 180. / params['n_fast_axis'], n_cycles = 1)
+    if os.path.exists(dither_dir):
+        shutil.rmtree(dither_dir)
+    # the same number of cycles as the undithered set, split into A B B A blocks, over a static background as
+    #   bright as the source in places
+    make_hwp_set(dither_dir, n_cycles = max(params['n_cycles'] // 4, 1), dither = (0., 150.), jitter = 0.3,
+                 background = 3000.)
+
+    # a normalized frame for the single frame stages
+    frame = _spot((1024, 1024), 500., 520., 20., 5000.) + np.random.default_rng(0).normal(0, 3, (1024, 1024))
+    com = tm.mod_centroid(frame, THRESHOLD)
+
+    def nothing():
+        pass
+
+    def clean():
+        _clean_products(thru_dir)
+
+    def fast_axis():
+        angles, stack = hm.load_sequence(fast_dir)
+        return hm.fast_axis_map(angles, stack)
+
+    def reduce_cycles():
+        return pol.reduce_hwp_cycles(pol.group_hwp_cycles(hwp_dir))
+
+    def register_dither():
+        return rm.reduce_dither(pol.group_hwp_cycles(dither_dir))
+
+    # normalized differences of the IMR x HWP calibration grid in four bands, from the Mueller model with noise
+    imr, hwp = [a.ravel() for a in np.meshgrid(sq.IMR_ANGLES, sq.GRID_HWP_ANGLES, indexing = 'ij')]
+    rng = np.random.default_rng(0)
+    bands = {}
+    for band, retardance in (('J', 150.), ('H', 170.), ('K', 180.), ('Lp', 195.)):
+        truth = dict(mm.GUESS, q_in = 0.3, u_in = -0.1, hwp_retardance = retardance, imr_retardance = 30.,
+                     imr_offset = 4., imr_diattenuation = 0.02)
+        bands[band] = {'hwp': hwp, 'imr': imr,
+                       'norm_diff': mm.model(truth, hwp, imr) + rng.normal(0., 1e-3, len(hwp))}
+
+    return [
+        ('dark_subtract_2', clean, lambda: tm.dark_subtract_2(thru_dir, wvls)),
+        ('normalize_photodiode_readings_aircal_2', nothing, lambda: tm.normalize_photodiode_readings_aircal_2(thru_dir, wvls)),
+        ('get_throughput', nothing, lambda: tm.get_throughput(thru_dir, wvls, THRESHOLD, RADIUS)),
+        ('measure_throughput', clean, lambda: tm.measure_throughput(thru_dir, wvls, THRESHOLD, RADIUS)),
+        ('mod_centroid', nothing, lambda: [tm.mod_centroid(frame, THRESHOLD) for i in range(10)]),
+        ('aperture_sum', nothing, lambda: [tm.aperture_sum(frame, com, RADIUS) for i in range(10)]),
+        ('reduce_hwp_cycles', lambda: _clean_products(hwp_dir), reduce_cycles),
+        ('fast_axis_map', lambda: _clean_products(fast_dir), fast_axis),
+        ('register_dither', lambda: _clean_products(dither_dir), register_dither),
+        ('mueller_fit', nothing, lambda: mm.fit_bands(bands, n_bootstrap = 100)),
+    ]
+
+def run_benchmarks(work_dir, sizes = ('small',), repeats = 3, stages = None):
+    '''
+    generates the synthetic data sets and benchmarks every stage on them
+    in:
+        work_dir (str) - scratch folder for the data sets...each size goes in its own subfolder
+        sizes (list) - keys of SIZES to run
+        repeats (int) - timed runs of each stage...the median is kept...plus one more run with memory tracing
+        stages (list) - names of the stages to record, None for all of them...the others still run (untimed)
+            since the later throughput stages need the products of the earlier ones
+    out:
+        results (list of dict) - one per size and stage with 'size', 'stage', 'wall' and 'cpu' (median over the
+            repeats), 'peak_mem' (from the traced run), 'bytes_read' and 'bytes_written' (median)
+    '''
+
+    results = []
+    for size in sizes:
+        stage_list = _stages(work_dir, size)
+        recorded = [name for name, setup, func in stage_list if stages is None or name in stages]
+
+        runs = {name: [] for name in recorded}
+        # every stage runs once per repeat, in order, since the later throughput stages need the earlier products
+        for i in range(repeats + 1):
+            traced = i == repeats
+            for name, setup, func in stage_list:
+                setup()
+                if name in runs:
+                    runs[name].append(measure(func, trace_memory = traced)[1])
+                else:
+                    measure(func)
+
+        for name in recorded:
+            timed = runs[name][:-1]
+            result = {'size': size, 'stage': name, 'peak_mem': runs[name][-1]['peak_mem']}
+            for key in ('wall', 'cpu', 'bytes_read', 'bytes_written'):
+                values = [run[key] for run in timed]
+                result[key] = None if None in values else float(np.median(values))
+            results.append(result)
+            io_mb = ['{:8.1f}'.format(result[key] / 1e6) if result[key] is not None else '     n/a'
+                     for key in ('bytes_read', 'bytes_written')]
+            print('{:>8} {:<40} wall {:8.3f} s  cpu {:8.3f} s  peak {:8.1f} MB  read {} MB  written {} MB'.format(
+                size, name, result['wall'], result['cpu'], result['peak_mem'] / 1e6, *io_mb))
+
+    return results
+
+def _format_products(size, seed = 0):
+    '''
+    the products benchmark_formats writes...(name, data, noise sigma) with the data as float64, the way the
+        reductions make them from integer NIRC2 frames
+    '''
+
+    rng = np.random.default_rng(seed)
+    n_frames = SIZES[size]['n_frames']
+    shape = (1024, 1024)
+
+    # integer frames of bias, read noise and a beam, minus the median of an integer dark with an odd number of
+    #   frames (a whole number) or an even one (half integers, so not integer valued)
+    spot = _spot(shape, 512., 520., 20., 5000.)
+    cube = np.round(rng.normal(100., 3., (n_frames,) + shape) + spot)
+    dark_odd = np.median(np.round(rng.normal(100., 3., (3,) + shape)), axis = 0)
+    dark_even = np.median(np.round(rng.normal(100., 3., (4,) + shape)), axis = 0)
+
+    dsub = cube - dark_even
+    norm = np.median(dsub, axis = 0) / 0.87
+
+    return [('dsub', dsub, 3. * np.sqrt(1.25)), ('dsub_integer', cube - dark_odd, 3. * np.sqrt(1.25)),
+            ('dsub_norm', norm, 3. * np.sqrt(1.25 * np.pi / (2 * n_frames)) / 0.87)]
+
+def benchmark_formats(work_dir, size = 'small', formats = tuple(prd.FORMATS), repeats = 3,
+                      quantize_level = prd.QUANTIZE_LEVEL):
+    '''
+    writes and reads back the reduction products in every output format
+    in:
+        work_dir (str) - scratch folder...the files go in <work_dir>/formats
+        size (str) - key of SIZES, for the number of frames in the cubes
+        formats (list) - keys of product_module.FORMATS to run
+        repeats (int) - timed writes and reads of each product...the median is kept
+        quantize_level (float) - quantization of the compressed formats
+    out:
+        results (list of dict) - one per product and format with 'product', 'format', 'size' (bytes on disk),
+            'ratio' (size over that of the float64 data), 'write' and 'read' throughput (MB of float64 data per second),
+            'max_err' and 'rms_err' against the float64 data, and 'rms_err_noise' (rms error over the noise sigma)
+    '''
+
+    out_dir = os.path.join(work_dir, 'formats')
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    results = []
+    for product, data, noise in _format_products(size):
+        hdr = fits.Header()
+        hdr['NORMPWR'] = 0.87
+        mb = data.nbytes / 1e6
+
+        for output_format in formats:
+            path = os.path.join(out_dir, product + '_' + output_format + '.fits')
+
+            writes = []
+            reads = []
+            for i in range(repeats):
+                if os.path.exists(path):
+                    os.remove(path)
+                t0 = time.perf_counter()
+                prd.write_product(path, data, hdr, output_format, quantize_level)
+                writes.append(time.perf_counter() - t0)
+
+                # copy the data out so a memory mapped file is really read
+                t0 = time.perf_counter()
+                read = np.array(prd.read_data(path), dtype = float)
+                reads.append(time.perf_counter() - t0)
+
+            n_bytes = os.path.getsize(path)
+            err = read - data
+            result = {'product': product, 'format': output_format, 'size': n_bytes, 'ratio': n_bytes / data.nbytes,
+                      'write': mb / np.median(writes), 'read': mb / np.median(reads),
+                      'max_err': float(np.abs(err).max()), 'rms_err': float(np.sqrt(np.mean(err**2)))}
+            result['rms_err_noise'] = result['rms_err'] / noise
+            results.append(result)
+
+            print('{:<13} {:<10} {:9.1f} MB  x{:5.3f}  write {:8.1f} MB/s  read {:8.1f} MB/s  max err {:9.2e}  '
+                  'rms err {:9.2e} ({:.4f} sigma)'.format(product, output_format, n_bytes / 1e6, result['ratio'],
+                                                           result['write'], result['read'], result['max_err'],
+                                                           result['rms_err'], result['rms_err_noise']))
+
+    return results
+
+def vortex_image(tiptilt, lambdaoverd, size = 256, lyot = 0.9, obscuration = 0.24, vortex = True):
+    '''
+    monochromatic image of a star through a charge 2 vortex, from Fourier optics: a circular pupil with a central
+        obscuration, tilted by the star's offset, the vortex phase in the focal plane, and a Lyot stop undersized
+        by lyot (and the obscuration oversized by as much)
+    in:
+        tiptilt (tuple) - (x, y) offset of the star from the vortex in lambda / D
+        lambdaoverd (float) - lambda / D in pixels
+        size (int) - size of the square image
+        lyot (float) - Lyot stop diameter over the pupil diameter
+        obscuration (float) - central obscuration diameter over the pupil diameter
+        vortex (bool) - False for the off-axis PSF (no vortex)
+    out:
+        image (np array) - (size, size), centred between pixels at (size / 2 - 0.5, size / 2 - 0.5), normalized
+            so the image without the vortex sums to 1
+    '''
+
+    yy, xx = np.indices((size, size)) - size / 2.
+    r = np.hypot(xx, yy) / (size / lambdaoverd / 2)
+
+    # the star lands half a pixel off the FFT centre, right on the vortex singularity, when tiptilt is 0
+    shift_x, shift_y = np.asarray(tiptilt, dtype = float) * lambdaoverd - 0.5
+    pupil = ((r <= 1) & (r >= obscuration)) * np.exp(2j * np.pi * (shift_x * xx + shift_y * yy) / size)
+    norm = np.sum(np.abs(pupil)**2) * size**2
+
+    def fft(field):
+        return np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(field)))
+
+    field = fft(pupil)
+    if vortex:
+        field = field * np.exp(2j * np.arctan2(yy + 0.5, xx + 0.5))
+        lyot_plane = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(field)))
+        field = fft(lyot_plane * ((r <= lyot) & (r >= obscuration / lyot)))
+
+    return np.abs(field)**2 / norm
+
+def make_vortex_frames(tiptilts, plan, peak = 5e4, pol_frac = 0.05, sky = 100., read_noise = 10., seed = 0,
+                       shape = (1024, 1024), vortex = True):
+    '''
+    synthetic polarimetry frames with the star behind the vortex in both Wollaston beams, at known offsets...the
+        beams are centred on the plan's vortex centres, which have to be half way between pixels
+    in:
+        tiptilts (np array) - (n_frames, 2) (x, y) offsets of the star in lambda / D
+        plan (dict) - from qacits_module.make_plan
+        peak (float) - counts in the peak of the off-axis PSF of both beams together
+        pol_frac (float) - the top beam gets (1 + pol_frac) / 2 of the light, the bottom one the rest
+        sky (float) - sky level in counts
+        read_noise (float) - read noise in counts
+        seed (int) - random seed
+        shape (tuple) - (ny, nx) of a frame
+        vortex (bool) - False for off-axis PSF frames
+    out:
+        frames (np array) - (n_frames, ny, nx) with photon and read noise
+    '''
+
+    rng = np.random.default_rng(seed)
+    size = 256
+    scale = peak / vortex_image((0., 0.), plan['lambdaoverd'], size, vortex = False).max()
+
+    frames = np.empty((len(tiptilts),) + tuple(shape))
+    for i, tiptilt in enumerate(tiptilts):
+        image = scale * vortex_image(tiptilt, plan['lambdaoverd'], size, vortex = vortex)
+        model = np.full(shape, sky)
+        for (cy, cx), share in zip(plan['centres'], ((1 + pol_frac) / 2, (1 - pol_frac) / 2)):
+            y0, x0 = int(cy - (size / 2 - 0.5)), int(cx - (size / 2 - 0.5))
+            model[y0:y0 + size, x0:x0 + size] += share * image
+        frames[i] = rng.poisson(model) + rng.normal(0., read_noise, shape)
+
+    return frames
+
+def benchmark_qacits(n_frames = 100, max_tiptilt = 0.5, repeats = 200, wavelength = 'Kp', seed = 0):
+    '''
+    latency and accuracy of the QACITS estimator (qacits_module) on synthetic vortex frames with known offsets
+    in:
+        n_frames (int) - frames with random offsets, and frames in the calibration scan
+        max_tiptilt (float) - largest offset in lambda / D
+        repeats (int) - timed single frame estimates
+        wavelength (str or float) - filter or wavelength in m
+        seed (int) - random seed
+    out:
+        result (dict) - 'latency' (median seconds for one frame), 'batch_latency' (seconds per frame when the whole
+            stack is estimated at once), 'readout' (READOUT_TIME), and for each of 'top', 'bottom' and 'both',
+            'rms_err' (lambda / D, with gam_out calibrated on a scan of known offsets), 'rms_err_params' (with the
+            params file's gam_out) and 'gam_out' (the calibrated value)
+    '''
+
+    rng = np.random.default_rng(seed)
+    # the vortex half way between pixels, at the pixel the params file gives
+    centres = [(qm.PARAMS['centery'] - 0.5, qm.PARAMS['centerx'] - 0.5),
+               (qm.PARAMS['centery'] - qm.BEAM_SEPARATION - 0.5, qm.PARAMS['centerx'] - 0.5)]
+    plan = qm.make_plan(wavelength, qm.PARAMS, centres)
+
+    psf_frame = make_vortex_frames(np.zeros((1, 2)), plan, seed = seed, vortex = False)[0]
+    sky = np.full(psf_frame.shape, 100.)
+    psf_flux = qm.offaxis_flux(psf_frame, plan, centres, sky)
+
+    # a scan along x and y to calibrate the estimator, as with the modulator, then random offsets to test it
+    scan = np.linspace(-max_tiptilt, max_tiptilt, n_frames // 2)
+    scan = np.concatenate([np.stack([scan, 0 * scan], axis = 1), np.stack([0 * scan, scan], axis = 1)])
+    radius = max_tiptilt * np.sqrt(rng.uniform(0, 1, n_frames))
+    angle = rng.uniform(0, 2 * np.pi, n_frames)
+    truth = np.stack([radius * np.cos(angle), radius * np.sin(angle)], axis = 1)
+
+    scan_est = qm.estimate(make_vortex_frames(scan, plan, seed = seed + 1), plan, psf_flux, sky)
+    frames = make_vortex_frames(truth, plan, seed = seed + 2)
+
+    # one frame at a time, as the loop sees them, and the whole stack at once
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        qm.estimate(frames[i % n_frames], plan, psf_flux, sky)
+        times.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    est = qm.estimate(frames, plan, psf_flux, sky)
+    batch = (time.perf_counter() - t0) / n_frames
+
+    result = {'latency': float(np.median(times)), 'batch_latency': batch, 'readout': READOUT_TIME}
+    print('QACITS latency {:.1f} us per frame ({:.1f} us batched), {:.0f}x under the {:.2f} s readout'.format(
+        result['latency'] * 1e6, batch * 1e6, READOUT_TIME / result['latency'], READOUT_TIME))
+
+    for c, name in enumerate(qm.CHANNEL_NAMES):
+        gam = qm.calibrate_gamma(scan_est['dI_out'][:, c], scan)
+        err = est['dI_out'][:, c] / gam - truth
+        err_params = est['tiptilt_out'][:, c] - truth
+        result[name] = {'gam_out': gam, 'rms_err': float(np.sqrt(np.mean(np.sum(err**2, axis = 1)))),
+                        'rms_err_params': float(np.sqrt(np.mean(np.sum(err_params**2, axis = 1))))}
+        print('{:<7} gam_out {:6.4f}  rms error {:6.4f} lambda/D calibrated, {:6.4f} with gam_out {}'.format(
+            name, gam, result[name]['rms_err'], result[name]['rms_err_params'], qm.PARAMS['gam_out']))
+
+    return result
+
+def save_results(results, path):
+    '''
+    saves benchmark results (e.g. as a baseline) with a note of the machine they were run on
+    '''
+
+    machine = {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'cpu_count': os.cpu_count()}
+    with open(path, 'w') as fo:
+        json.dump({'machine': machine, 'results': results}, fo, indent = 1)
+
+def load_results(path):
+    '''
+    benchmark results saved by save_results
+    '''
+
+    with open(path) as fo:
+        return json.load(fo)['results']
+
+def compare(results, baseline, tolerance = 0.2):
+    '''
+    compares benchmark results against a baseline, stage by stage
+    in:
+        results (list of dict) - from run_benchmarks
+        baseline (list of dict) - from load_results
+        tolerance (float) - fractional change in wall time or peak memory that counts as a regression
+    out:
+        ratios (list of dict) - 'size', 'stage', 'wall' and 'peak_mem' ratios to the baseline and 'regression'
+            for every stage that is in both
+    '''
+
+    base = {(row['size'], row['stage']): row for row in baseline}
+
+    ratios = []
+    for row in results:
+        ref = base.get((row['size'], row['stage']))
+        if ref is None:
+            continue
+
+        wall = row['wall'] / ref['wall']
+        mem = row['peak_mem'] / ref['peak_mem'] if row['peak_mem'] and ref['peak_mem'] else np.nan
+        regression = wall > 1 + tolerance or mem > 1 + tolerance
+        ratios.append({'size': row['size'], 'stage': row['stage'], 'wall': wall, 'peak_mem': mem,
+                       'regression': regression})
+        print('{:>8} {:<40} wall x{:6.2f}  peak mem x{:6.2f}{}'.format(row['size'], row['stage'], wall, mem,
+                                                                     '  <-- REGRESSION' if regression else ''))
+
+    return ratios
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'benchmark the reductions on synthetic NIRC2 data')
+    parser.add_argument('work_dir', help = 'scratch folder for the synthetic data sets')
+    parser.add_argument('--sizes', nargs = '+', default = ['small'], choices = list(SIZES))
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--stages', nargs = '+', default = None)
+    parser.add_argument('--baseline', help = 'baseline results to compare against')
+    parser.add_argument('--save', help = 'where to save the results, e.g. as a new baseline')
+    parser.add_argument('--formats', action = 'store_true', help = 'benchmark the product formats instead')
+    parser.add_argument('--qacits', action = 'store_true', help = 'benchmark the QACITS estimator instead')
+    args = parser.parse_args()
+
+    if args.formats:
+        for size in args.sizes:
+            benchmark_formats(args.work_dir, size, repeats = args.repeats)
+        sys.exit(0)
+    if args.qacits:
+        benchmark_qacits()
+        sys.exit(0)
+
+    results = run_benchmarks(args.work_dir, args.sizes, args.repeats, args.stages)
+    if args.save:
+        save_results(results, args.save)
+    if args.baseline:
+        ratios = compare(results, load_results(args.baseline))
+        sys.exit(1 if any(r['regression'] for r in ratios) else 0)
@@ -0,0 +1,207 @@
+'''
+calibration_module.py
+
+A library of master darks and flats that are built once and reused by every reduction
+
+Masters are keyed by the instrument configuration in the header (filter, itime, coadds, sampling mode and date,
+see KEY_FIELDS) plus the files they were built from, and saved as .npy files in a library folder so they can be
+memory mapped. Loaded masters are kept in an in-process LRU cache, and since they are read-only memory maps,
+worker processes reading the same master share the same pages instead of each holding a copy
+
+Typical use:
+    dark = master_dark(library_dir, dark_files)
+    flat = master_flat(library_dir, flat_files, dark)
+    ...or, for a science frame, find_master(library_dir, 'dark', hdr) to pick a master by configuration
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import glob
+import json
+import hashlib
+import contextlib
+from collections import OrderedDict
+from astropy.io import fits
+import catalog_module as cm
+import collapse_module as cl
+
+#######################################################################
+
+# header values that key a master...they come from the catalog_module header keywords
+KEY_FIELDS = ('filter', 'itime', 'coadds', 'sampmode', 'date')
+
+# number of masters kept loaded in the LRU cache
+CACHE_SIZE = 16
+
+# loaded masters, least recently used first
+_cache = OrderedDict()
+
+def calibration_key(hdr):
+    '''
+    the instrument configuration of a frame, as used to key masters
+    in:
+        hdr (fits header) - header of the frame
+    out:
+        key (dict) - a string for each of KEY_FIELDS...'none' where the header doesn't have it
+    '''
+
+    row = cm.header_row('', hdr)
+
+    key = {}
+    for field in KEY_FIELDS:
+        value = row[field]
+        if field == 'date' and value is not None:
+            # only the day, not the time of the observation
+            value = value.split('T')[0]
+        # file name safe, e.g. 'Kp + clear' -> 'Kp+clear'
+        key[field] = 'none' if value is None else str(value).replace(' ', '').replace(os.sep, '-').replace('_', '-')
+
+    return key
+
+def _master_name(kind, key, files):
+    '''
+    file name of a master...the configuration first so masters can be looked up by it, then a short hash of the
+        source files so two masters of the same configuration don't overwrite each other
+    '''
+
+    sources = '\n'.join(sorted(os.path.abspath(f) for f in files))
+    digest = hashlib.sha1(sources.encode()).hexdigest()[:10]
+
+    return '_'.join([kind] + [key[field] for field in KEY_FIELDS] + [digest]) + '.npy'
+
+def _sources(files):
+    '''
+    the source files of a master with their modification times, to tell whether it is out of date
+    '''
+
+    return sorted([os.path.abspath(f), os.stat(f).st_mtime_ns] for f in files)
+
+def _median_stack(files, n_threads = 1):
+    '''
+    median over every frame of every file (cube or single frame)...the files are collapsed as one stack by
+        collapse_module, a band of rows at a time, so the stack is never in memory at once
+    '''
+
+    with contextlib.ExitStack() as stack:
+        sections = [stack.enter_context(fits.open(f))[0].section for f in files]
+        return cl.collapse(sections, 'median', n_threads = n_threads)
+
+def build_master(library_dir, kind, files, dark = None, n_threads = 1):
+    '''
+    builds a master dark or flat from a list of files and saves it in the library...if a master of the same
+        files already exists and none of them changed since, nothing is recomputed
+    in:
+        library_dir (str) - folder of the calibration library...created if it isn't there
+        kind (str) - 'dark' (median of every frame) or 'flat' (median of every frame, dark subtracted and divided
+            by its own median, as in the commissioning notebooks)
+        files (list) - fits files to build the master from...the configuration is read from the first one
+        dark (np array or str) - master dark (or the path to one) subtracted from a flat...None for no dark
+        n_threads (int) - threads the median is spread over (collapse_module)
+    out:
+        path (str) - path to the master in the library
+    '''
+
+    os.makedirs(library_dir, exist_ok = True)
+
+    key = calibration_key(fits.getheader(files[0]))
+    path = os.path.join(library_dir, _master_name(kind, key, files))
+    sources = _sources(files)
+
+    # the sidecar records what the master was built from
+    meta_path = path[:-len('.npy')] + '.json'
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as fo:
+            if json.load(fo)['sources'] == sources:
+                return path
+
+    master = _median_stack(files, n_threads)
+
+    if kind == 'flat':
+        if dark is not None:
+            master = master - (load_master(dark) if isinstance(dark, str) else dark)
+        master = master / np.median(master)
+
+    # write to a temporary name and move it into place, so other processes never map a half written master
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as fo:
+        np.save(fo, master)
+    os.replace(tmp_path, path)
+
+    with open(meta_path, 'w') as fo:
+        json.dump({'kind': kind, 'key': key, 'sources': sources}, fo, indent = 1)
+
+    # a rebuilt master must not be served from the cache
+    _cache.pop(path, None)
+
+    return path
+
+def load_master(path):
+    '''
+    a master from the library as a read-only memory map, through the LRU cache
+    in:
+        path (str) - path to the master (from build_master or find_master)
+    out:
+        master (np memmap) - the master frame
+    '''
+
+    if path in _cache:
+        _cache.move_to_end(path)
+        return _cache[path]
+
+    master = np.load(path, mmap_mode = 'r')
+    _cache[path] = master
+
+    # evict the least recently used masters
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last = False)
+
+    return master
+
+def clear_cache():
+    '''
+    drops every loaded master from the cache
+    '''
+
+    _cache.clear()
+
+def master_dark(library_dir, files, n_threads = 1):
+    '''
+    the master dark of a list of dark files, built the first time and loaded from the library after that
+    '''
+
+    return load_master(build_master(library_dir, 'dark', files, n_threads = n_threads))
+
+def master_flat(library_dir, files, dark = None, n_threads = 1):
+    '''
+    the normalized master flat of a list of flat files (dark subtracted with dark, if given), built the first
+        time and loaded from the library after that
+    '''
+
+    return load_master(build_master(library_dir, 'flat', files, dark, n_threads))
+
+def find_master(library_dir, kind, hdr, match = KEY_FIELDS):
+    '''
+    looks up the master for a frame by its instrument configuration
+    in:
+        library_dir (str) - folder of the calibration library
+        kind (str) - 'dark' or 'flat'
+        hdr (fits header) - header of the frame
+        match (tuple) - the KEY_FIELDS that have to match...e.g. leave out 'filter' for darks, or 'date' to use
+            a master from another night
+    out:
+        path (str) - path to the matching master with the latest date (undated masters last), None if there isn't one
+    '''
+
+    key = calibration_key(hdr)
+    fields = [glob.escape(key[field]) if field in match else '*' for field in KEY_FIELDS]
+    paths = glob.glob(os.path.join(library_dir, '_'.join([kind] + fields + ['*']) + '.npy'))
+
+    if not paths:
+        return None
+
+    # the date is the second to last field of the name...undated ('none') masters sort before every dated one,
+    #   so they are only used when nothing dated matches
+    dates = [os.path.basename(p).split('_')[-2] for p in paths]
+    return max(zip(dates, paths), key = lambda d: (d[0] != 'none', d[0]))[1]
@@ -0,0 +1,212 @@
+'''
+catalog_module.py
+
+A persistent index of the FITS headers in a data tree, kept in an SQLite file next to the data
+
+Every fits file under the directory gets one row with its path (relative to the directory), its classification (Air/Dark/position, the same
+way throughput_module sorts them), what product it is (raw, _dsub, _dsub_norm) and the header values the
+reductions care about. The catalog is updated incrementally: a file's header is only read again when its
+modification time or size changes, so re-reading THRUPUT or OPMPOWER for a whole night costs a directory walk
+(or nothing at all with refresh = False) instead of opening every file
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import sqlite3
+import product_module as prd
+
+#######################################################################
+
+# name of the catalog file that is put in the top directory of the data set
+CATALOG_NAME = 'header_catalog.sqlite'
+
+# header keywords recorded for each column...the first keyword found in a header is used
+HEADER_KEYS = {
+    'normpwr': ('NORMPWR',),
+    'thruput': ('THRUPUT',),
+    'hwp': ('PCUPR', 'PCUANG'),
+    'imr': ('ROTPPOSN',),
+    'filter': ('FILTER', 'FWINAME'),
+    'wavelength': ('CENWAVE',),
+    'itime': ('ITIME',),
+    'coadds': ('COADDS',),
+    'sampmode': ('SAMPMODE',),
+    'object': ('OBJECT',),
+    'date': ('DATE-OBS',),
+}
+
+# columns that hold text rather than numbers
+TEXT_COLUMNS = ('filter', 'sampmode', 'object', 'date')
+
+def _connect(directory, db_path = None):
+    '''
+    opens the catalog of a directory, creating the table the first time
+    '''
+
+    if db_path is None:
+        db_path = os.path.join(directory, CATALOG_NAME)
+
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+
+    columns = [key + (' TEXT' if key in TEXT_COLUMNS else ' REAL') for key in HEADER_KEYS]
+    con.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, name TEXT, mtime INTEGER, '
+                'size INTEGER, kind TEXT, product TEXT, opmpower REAL, ' + ', '.join(columns) + ')')
+
+    # catalogs made before a column was added to HEADER_KEYS get it added...those files are re-read on the next 
+    #   update since their mtime is cleared
+    existing = [row['name'] for row in con.execute('PRAGMA table_info(headers)')]
+    missing = [column for key, column in zip(HEADER_KEYS, columns) if key not in existing]
+    if missing:
+        with con:
+            for column in missing:
+                con.execute('ALTER TABLE headers ADD COLUMN ' + column)
+            con.execute('UPDATE headers SET mtime = NULL')
+
+    return con
+
+def classify(path):
+    '''
+    sorts a file into 'air', 'dark' or 'position' the same way dark_subtract_2 does, and into the product it is
+    in:
+        path (str) - path to the fits file
+    out:
+        kind (str) - 'air', 'dark' or 'position'
+        product (str) - 'dsub_norm', 'dsub' or 'raw'
+    '''
+
+    if 'Air' in path:
+        kind = 'air'
+    elif 'Dark' in path:
+        kind = 'dark'
+    else:
+        kind = 'position'
+
+    if path.endswith('dsub_norm.fits'):
+        product = 'dsub_norm'
+    elif path.endswith('dsub.fits'):
+        product = 'dsub'
+    else:
+        product = 'raw'
+
+    return kind, product
+
+def header_row(path, hdr):
+    '''
+    pulls the catalogued values out of a header
+    in:
+        path (str) - path to the fits file, relative to the top directory of the data set so that an 'Air' or 
+            'Dark' higher up doesn't change the classification
+        hdr (fits header) - its primary header
+    out:
+        row (dict) - one value per catalog column, None where the header doesn't have it
+    '''
+
+    kind, product = classify(path)
+    row = {'path': path, 'name': os.path.basename(path), 'kind': kind, 'product': product}
+
+    # median of the photodiode readings logged in the header
+    try:
+        row['opmpower'] = float(np.median(np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)))
+    except (KeyError, ValueError):
+        row['opmpower'] = None
+
+    for column, keys in HEADER_KEYS.items():
+        row[column] = None
+        for key in keys:
+            if key in hdr:
+                value = hdr[key]
+                row[column] = str(value) if column in TEXT_COLUMNS else _to_float(value)
+                break
+
+    return row
+
+def _to_float(value):
+    '''
+    header value as a float, None if it isn't a number
+    '''
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def update_catalog(directory, db_path = None):
+    '''
+    walks the directory and brings the catalog up to date...only files that are new or whose modification time
+        or size changed are opened, and only their headers are read...files that are gone are dropped
+    in:
+        directory (str) - top directory of the data set
+        db_path (str) - catalog file, defaults to CATALOG_NAME in the directory
+    out:
+        n_updated (int) - number of files whose headers were (re)read
+    '''
+
+    con = _connect(directory, db_path)
+    known = {row['path']: (row['mtime'], row['size']) for row in con.execute('SELECT path, mtime, size FROM headers')}
+
+    seen = set()
+    rows = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.fits'):
+                continue
+
+            # paths are stored relative to the directory so the same file is found however it is spelled
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, directory)
+            stat = os.stat(full_path)
+            seen.add(path)
+            if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+
+            # the products can be compressed, with the header in the image extension
+            row = header_row(path, prd.read_header(full_path))
+            row['mtime'] = stat.st_mtime_ns
+            row['size'] = stat.st_size
+            rows.append(row)
+
+    with con:
+        if rows:
+            columns = list(rows[0])
+            con.executemany('INSERT OR REPLACE INTO headers (' + ', '.join(columns) + ') VALUES (' +
+                            ', '.join('?' * len(columns)) + ')', [[row[c] for c in columns] for row in rows])
+        con.executemany('DELETE FROM headers WHERE path = ?', [(path,) for path in known if path not in seen])
+    con.close()
+
+    return len(rows)
+
+def query_catalog(directory, pattern = '*.fits', kind = None, db_path = None, refresh = True):
+    '''
+    looks up the catalogued headers of the files whose names match a glob pattern...this replaces
+        glob.glob(os.path.join(directory, '**', pattern), recursive = True) followed by opening every file
+    in:
+        directory (str) - top directory of the data set
+        pattern (str) - glob pattern for the file name, e.g. '*1550*dsub_norm.fits'
+        kind (str) - only return 'air', 'dark' or 'position' files...None returns all of them
+        db_path (str) - catalog file, defaults to CATALOG_NAME in the directory
+        refresh (bool) - update the catalog before the query...False skips walking the directory entirely
+    out:
+        rows (list of dict) - catalog rows sorted by path, e.g. row['thruput']...row['path'] is joined onto the 
+            directory, so it is the same path glob would have given
+    '''
+
+    if refresh:
+        update_catalog(directory, db_path)
+
+    query = 'SELECT * FROM headers WHERE name GLOB ?'
+    args = [pattern]
+    if kind is not None:
+        query += ' AND kind = ?'
+        args.append(kind)
+
+    con = _connect(directory, db_path)
+    rows = [dict(row) for row in con.execute(query + ' ORDER BY path', args)]
+    con.close()
+
+    for row in rows:
+        row['path'] = os.path.join(directory, row['path'])
+
+    return rows
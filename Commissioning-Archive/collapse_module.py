@@ -0,0 +1,181 @@
+'''
+collapse_module.py
+
+Collapses deep cubes over the frame axis in bounded memory
+
+np.median(cube, axis = 0) needs the whole cube in memory plus a copy of it for the partition, which is too much
+for the long OPM-logged cubes with hundreds of frames. collapse() instead works through the cube in bands of rows
+(every frame, a few rows of each), sized so one band and its temporaries fit in a memory budget, and writes each
+band's result into the output frame. Every pixel is still collapsed over exactly the same values, so the median
+is identical to np.median, bit for bit. Bands can be spread over threads...numpy lets go of the GIL while it
+partitions and sums, and reading the band of a memory mapped or sectioned file does too
+
+The cube can be anything that slices like a (n_frames, ny, nx) array: an array, a memory map, or the .section of
+an HDU (which reads only the rows asked for, and decompresses only the tiles they are in for compressed images).
+A list of those is collapsed as if they were stacked along the frame axis, so the frames of several files can be
+collapsed together without ever concatenating them
+
+Methods:
+    'median'     - np.median
+    'mean'       - np.mean
+    'sigma_clip' - mean after iteratively clipping values more than sigma standard deviations from the median of
+                   each pixel (astropy's sigma_clip with its defaults: cenfunc median, stdfunc std)
+
+Typical use:
+    with fits.open(f) as hdul:
+        dark = collapse(hdul[0].section, 'median', n_threads = 4)
+'''
+
+############################## Imports ################################
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+#######################################################################
+
+# default memory budget for the bands being collapsed at once, in bytes
+MEMORY_BUDGET = 256e6
+
+# working copies of a band each method needs at once...the band as read, the pixel-major copy the median
+#   partitions in place, and for sigma clipping a float64 copy, its mask and the deviations
+BAND_COPIES = {'median': 2, 'mean': 2, 'sigma_clip': 5}
+
+METHODS = tuple(BAND_COPIES)
+
+def _shape(cube):
+    '''
+    (n_frames, ny, nx) of a cube or of a list of cubes stacked along the frame axis...single frames count as one
+        frame
+    '''
+
+    cubes = cube if isinstance(cube, (list, tuple)) else [cube]
+
+    n_frames = 0
+    for c in cubes:
+        shape = tuple(c.shape)
+        n_frames += shape[0] if len(shape) == 3 else 1
+        frame_shape = shape[-2:]
+
+    return (n_frames,) + frame_shape
+
+def _band(cube, y0, y1):
+    '''
+    rows y0:y1 of every frame of a cube (or of a list of cubes) as an array
+    '''
+
+    if not isinstance(cube, (list, tuple)):
+        return np.asarray(cube[:, y0:y1]) if len(cube.shape) == 3 else np.asarray(cube[y0:y1])[None]
+
+    return np.concatenate([_band(c, y0, y1) for c in cube], axis = 0)
+
+def _dtype(cube):
+    '''
+    dtype of the data in a cube (or of a list of cubes once stacked)...sections don't have one, so a pixel is read
+    '''
+
+    if isinstance(cube, (list, tuple)):
+        return np.result_type(*[_dtype(c) for c in cube])
+
+    if hasattr(cube, 'dtype'):
+        return np.dtype(cube.dtype)
+
+    return np.asarray(cube[(0,) * len(cube.shape)]).dtype
+
+def band_rows(shape, itemsize, method = 'median', memory_budget = MEMORY_BUDGET, n_threads = 1):
+    '''
+    rows per band so that n_threads bands and their temporaries fit in the memory budget
+    in:
+        shape (tuple) - (n_frames, ny, nx) of the cube
+        itemsize (int) - bytes per value as read
+        method (str) - one of METHODS
+        memory_budget (float) - bytes for all the bands being collapsed at once
+        n_threads (int) - bands collapsed at once
+    out:
+        rows (int) - at least 1, at most ny
+    '''
+
+    n_frames, ny, nx = shape
+    # everything is worked on in at least float64 except the median and mean of narrower data
+    itemsize = 8 if method == 'sigma_clip' else max(itemsize, 4)
+    row_bytes = n_frames * nx * itemsize * BAND_COPIES[method]
+
+    return int(np.clip(memory_budget // (row_bytes * max(n_threads, 1)), 1, ny))
+
+def _median(band):
+    '''
+    median of every pixel of a band over the frame axis...the band is copied pixel-major first, so each pixel's
+        values are contiguous for the partition, which is faster than np.median down the frame axis and gives
+        the same values
+    '''
+
+    n_frames = band.shape[0]
+    pixels = np.ascontiguousarray(band.reshape(n_frames, -1).T)
+
+    return np.median(pixels, axis = 1, overwrite_input = True).reshape(band.shape[1:])
+
+def _sigma_clip_mean(band, sigma, maxiters):
+    '''
+    sigma clipped mean of every pixel of a band over the frame axis
+    '''
+
+    band = np.array(band, dtype = float)
+    for i in range(maxiters):
+        center = np.nanmedian(band, axis = 0)
+        std = np.nanstd(band, axis = 0)
+        with np.errstate(invalid = 'ignore'):
+            clip = np.abs(band - center) > sigma * std
+        if not clip.any():
+            break
+        band[clip] = np.nan
+
+    with np.errstate(invalid = 'ignore'):
+        return np.nanmean(band, axis = 0)
+
+def collapse(cube, method = 'median', memory_budget = MEMORY_BUDGET, n_threads = 1, sigma = 3., maxiters = 5):
+    '''
+    collapses a cube over the frame axis, a band of rows at a time
+    in:
+        cube (array-like or list) - (n_frames, ny, nx) array, memory map or HDU section, or a list of those (or of
+            single frames) to collapse as one stack
+        method (str) - 'median', 'mean' or 'sigma_clip'
+        memory_budget (float) - bytes for the bands being collapsed at once...the output frame comes on top
+        n_threads (int) - threads the bands are spread over
+        sigma (float) - clipping threshold in standard deviations, for 'sigma_clip'
+        maxiters (int) - maximum clipping iterations, for 'sigma_clip'
+    out:
+        frame (np array) - (ny, nx) collapsed frame...the same values and dtype as np.median / np.mean of the
+            whole stack (float64 for 'sigma_clip')...False if the method isn't one of METHODS
+    '''
+
+    if method not in METHODS:
+        print('Unknown collapse method ' + str(method) + ', use one of ' + ', '.join(METHODS))
+        return False
+
+    shape = _shape(cube)
+    n_frames, ny, nx = shape
+    dtype = _dtype(cube)
+    rows = band_rows(shape, dtype.itemsize, method, memory_budget, n_threads)
+
+    if method == 'median':
+        func = _median
+    elif method == 'mean':
+        func = lambda band: np.mean(band, axis = 0)
+    else:
+        func = lambda band: _sigma_clip_mean(band, sigma, maxiters)
+
+    # the output dtype is whatever the method gives for this dtype
+    out = np.empty((ny, nx), dtype = func(np.zeros((1, 1, 1), dtype = dtype)).dtype)
+
+    def collapse_band(y0):
+        y1 = min(y0 + rows, ny)
+        out[y0:y1] = func(_band(cube, y0, y1))
+
+    starts = range(0, ny, rows)
+    if n_threads == 1 or len(starts) == 1:
+        for y0 in starts:
+            collapse_band(y0)
+    else:
+        with ThreadPoolExecutor(max_workers = n_threads) as pool:
+            list(pool.map(collapse_band, starts))
+
+    return out
@@ -0,0 +1,203 @@
+'''
+harmonic_module.py
+
+Linear least-squares fits of HWP modulation curves, and fast-axis maps built from them
+
+The normalized difference of the two Wollaston channels modulates with the HWP angle theta at known harmonics
+(4 theta for an ideal HWP, 2 theta from imperfections), so instead of the FFT guess + curve_fit + find_peaks
+of fit_sum_of_sines in the fast axis notebooks, the curve is fit with the linear model
+
+    y(theta) = c + sum over k of [a_k cos(k theta) + b_k sin(k theta)]
+
+which has a closed-form solution. The same design matrix is used for every curve, so every pixel (or every
+binned tile) of a Fast_Axis_Cal_Sequence.sh stack is fit with one matrix product. The angle of the peak of
+harmonic k is atan2(b_k, a_k) / k, and the uncertainties come from the least-squares covariance
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import catalog_module as cm
+import polarimetry_module as pol
+from astropy.io import fits
+
+#######################################################################
+
+def harmonic_design(angles, harmonics = (2, 4)):
+    '''
+    design matrix of the harmonic model
+    in:
+        angles (list) - HWP angles in degrees
+        harmonics (tuple) - harmonics k of the HWP angle to fit
+    out:
+        design (np array) - (n_angles, 1 + 2*n_harmonics) columns: 1, then cos(k theta), sin(k theta) for each k
+    '''
+
+    theta = np.radians(np.asarray(angles, dtype = float))
+
+    columns = [np.ones_like(theta)]
+    for k in harmonics:
+        columns += [np.cos(k * theta), np.sin(k * theta)]
+
+    return np.stack(columns, axis = 1)
+
+def fit_harmonics(angles, y, harmonics = (2, 4)):
+    '''
+    fits the harmonic model to one curve or to many curves sampled at the same angles
+    in:
+        angles (list) - HWP angles in degrees
+        y (np array) - (n_angles, ...) curves...e.g. (n_angles,) for one aperture sum, or (n_angles, ny, nx) to
+            fit every pixel
+        harmonics (tuple) - harmonics k of the HWP angle to fit
+    out:
+        fit (dict) - 'offset' (...), 'cos' and 'sin' (n_harmonics, ...) coefficients, 'amplitude' and 'peak_angle'
+            (n_harmonics, ...) with the angle in degrees in [0, 360/k), their 1 sigma errors 'amplitude_err' and
+            'peak_angle_err', 'residual_rms' (...), 'harmonics', and 'fitfunc' to evaluate the fit at new angles
+    '''
+
+    y = np.asarray(y, dtype = float)
+    shape = y.shape[1:]
+    n_angles = y.shape[0]
+    curves = y.reshape(n_angles, -1)
+
+    design = harmonic_design(angles, harmonics)
+    n_params = design.shape[1]
+
+    # (A^T A)^-1 is the same for every curve, so one solve covers all of them
+    unscaled_cov = np.linalg.inv(design.T @ design)
+    coefs = unscaled_cov @ design.T @ curves
+
+    # noise of each curve from its residuals...the covariance of each curve is sigma^2 (A^T A)^-1
+    residuals = curves - design @ coefs
+    dof = max(n_angles - n_params, 1)
+    sigma2 = np.sum(residuals**2, axis = 0) / dof
+
+    amplitude, amplitude_err, peak_angle, peak_angle_err = harmonic_terms(coefs, unscaled_cov, sigma2, harmonics)
+
+    def fitfunc(theta):
+        return np.tensordot(harmonic_design(theta, harmonics), coefs, axes = 1).reshape((-1,) + shape)
+
+    n_harmonics = len(harmonics)
+    return {
+        'offset': coefs[0].reshape(shape),
+        'cos': coefs[1::2].reshape((n_harmonics,) + shape),
+        'sin': coefs[2::2].reshape((n_harmonics,) + shape),
+        'amplitude': amplitude.reshape((n_harmonics,) + shape),
+        'amplitude_err': amplitude_err.reshape((n_harmonics,) + shape),
+        'peak_angle': peak_angle.reshape((n_harmonics,) + shape),
+        'peak_angle_err': peak_angle_err.reshape((n_harmonics,) + shape),
+        'residual_rms': np.sqrt(np.mean(residuals**2, axis = 0)).reshape(shape),
+        'harmonics': tuple(harmonics),
+        'fitfunc': fitfunc,
+    }
+
+def harmonic_terms(coefs, unscaled_cov, sigma2, harmonics = (2, 4)):
+    '''
+    amplitude and peak angle of each harmonic from the fitted coefficients, with the covariance propagated
+        through them
+    in:
+        coefs (np array) - (1 + 2*n_harmonics, n_curves) coefficients in the column order of harmonic_design
+        unscaled_cov (np array) - (A^T A)^-1 of the design matrix
+        sigma2 (np array) - (n_curves,) residual variance of each curve
+        harmonics (tuple) - harmonics k of the coefficients
+    out:
+        amplitude, amplitude_err (np array) - (n_harmonics, n_curves) amplitude of each harmonic and its 1 sigma error
+        peak_angle, peak_angle_err (np array) - (n_harmonics, n_curves) angle of the peak in degrees, in [0, 360/k),
+            and its 1 sigma error
+    '''
+
+    a = coefs[1::2]
+    b = coefs[2::2]
+    caa = np.diag(unscaled_cov)[1::2, None]
+    cbb = np.diag(unscaled_cov)[2::2, None]
+    cab = np.diagonal(unscaled_cov, offset = 1)[1::2, None]
+
+    amplitude = np.hypot(a, b)
+    phase = np.arctan2(b, a)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        amplitude_err = np.sqrt(sigma2 * (a**2 * caa + 2 * a * b * cab + b**2 * cbb)) / amplitude
+        phase_err = np.sqrt(sigma2 * (b**2 * caa - 2 * a * b * cab + a**2 * cbb)) / amplitude**2
+
+    # the peak of a cos(k theta) + b sin(k theta) is at theta = phase / k
+    k = np.asarray(harmonics, dtype = float)[:, None]
+    peak_angle = np.mod(np.degrees(phase) / k, 360. / k)
+    peak_angle_err = np.degrees(phase_err) / k
+
+    return amplitude, amplitude_err, peak_angle, peak_angle_err
+
+def load_sequence(directory, pattern = '*.fits', refresh = True):
+    '''
+    reads a HWP sequence (e.g. from Fast_Axis_Cal_Sequence.sh) with its HWP angles, which come from the
+        <BASE_OBJ>_hwp_<angle> OBJECT labels in the header catalog
+    in:
+        directory (str) - folder with the frames
+        pattern (str) - glob pattern for the file names, e.g. 'n*.fits'
+        refresh (bool) - bring the header catalog up to date first
+    out:
+        angles (np array) - HWP angle of each frame in degrees
+        stack (np array) - (n_frames, ny, nx) frames in file order
+    '''
+
+    angles = []
+    frames = []
+    for row in cm.query_catalog(directory, pattern, refresh = refresh):
+        label = pol.parse_label(row['object'])
+        if label is None:
+            continue
+
+        with fits.open(row['path']) as hdul:
+            frames.append(np.asarray(hdul[0].data, dtype = float))
+        angles.append(label[1])
+
+    return np.asarray(angles), np.stack(frames)
+
+def normalized_difference(stack, channels = pol.CHANNELS, bin_size = 1):
+    '''
+    (top - bottom) / (top + bottom) of every pixel (or every bin_size x bin_size tile) of a stack of frames
+    in:
+        stack (np array) - (n_frames, ny, nx) dark subtracted, flat fielded frames
+        channels (dict) - 'top' and 'bottom' channel boxes
+        bin_size (int) - the channels are summed over tiles of this size before differencing...1 for every pixel
+    out:
+        norm_diff (np array) - (n_frames, ny // bin_size, nx // bin_size)
+    '''
+
+    channel_stack = pol.split_channels(np.asarray(stack, dtype = float), channels)
+
+    if bin_size > 1:
+        n, c, ny, nx = channel_stack.shape
+        ny, nx = ny // bin_size * bin_size, nx // bin_size * bin_size
+        channel_stack = channel_stack[..., :ny, :nx].reshape(n, c, ny // bin_size, bin_size, nx // bin_size, bin_size)
+        channel_stack = np.nansum(channel_stack, axis = (3, 5))
+
+    top = channel_stack[:, 0]
+    bottom = channel_stack[:, 1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (top - bottom) / (top + bottom)
+
+def fast_axis_map(angles, stack, channels = pol.CHANNELS, bin_size = 8, harmonics = (2, 4), harmonic = 4):
+    '''
+    fast-axis and modulation-efficiency maps of a HWP modulation stack...every pixel / tile of the normalized
+        difference is fit at once with fit_harmonics
+    in:
+        angles (list) - HWP angle of each frame in degrees
+        stack (np array) - (n_frames, ny, nx) dark subtracted, flat fielded frames
+        channels (dict) - 'top' and 'bottom' channel boxes
+        bin_size (int) - tile size in pixels...1 fits every pixel
+        harmonics (tuple) - harmonics fit to the modulation
+        harmonic (int) - harmonic whose peak angle and amplitude are mapped (4 for the HWP modulation)
+    out:
+        maps (dict) - 'fast_axis' (peak angle in degrees) and 'mod_eff' (amplitude of the harmonic), their 1 sigma
+            errors 'fast_axis_err' and 'mod_eff_err', and the full 'fit' from fit_harmonics
+    '''
+
+    fit = fit_harmonics(angles, normalized_difference(stack, channels, bin_size), harmonics)
+    i = list(harmonics).index(harmonic)
+
+    return {
+        'fast_axis': fit['peak_angle'][i],
+        'fast_axis_err': fit['peak_angle_err'][i],
+        'mod_eff': fit['amplitude'][i],
+        'mod_eff_err': fit['amplitude_err'][i],
+        'fit': fit,
+    }
@@ -0,0 +1,596 @@
+'''
+ktl_module.py
+
+Keyword access for the observing sequences, on the telescope or against a local stand-in
+
+A backend is a dict of the handful of functions a sequence needs:
+
+    show(service, keyword) -> value as a string, None if it couldn't be read
+    modify(service, keyword, value) -> True if the command went through
+    subscribe(service, keyword, callback) -> handle...callback(value) is called with the current value and then
+        on every update, until unsubscribe(handle)
+    goi(n) -> True once n frames are taken and written
+    object(label) -> True if OBJECT was set
+    xy(dx, dy) -> True once the telescope offset is done
+    rotate(imr) -> True if the IMR was sent to imr (rotate <imr_to_rotate(imr)> stationary)
+    sleep(seconds), time() -> seconds
+
+ktl_backend() uses the KTL Python bindings with one cached connection per service, and monitored keywords call
+back as soon as the dispatcher broadcasts, so waiting on a move (wait_for with an in_tolerance predicate) wakes
+up on the update that brings it into tolerance instead of forking show + awk every POLL seconds.
+shell_backend() runs the same show / modify / goi / object / xy commands as the bash sequences, for machines
+without the bindings...its subscriptions fall back to polling. sim_backend() runs against simulator(), an
+in-process stand-in for pcu2 PCUPR and ao obrt motion (trapezoidal velocity profile, then an exponential settle)
+and for alad expstate going through Integrating, Reading and Filewait during a goi. The simulator broadcasts
+keyword updates to subscribers like a dispatcher, can run faster than real time (time_scale), keeps a log of
+every frame with the HWP and IMR positions while it was integrating, and records a violation whenever the HWP is
+commanded to move while the detector is integrating or reading out, so pipelined sequences can be checked for
+safety offline. benchmark_settle() compares how long after the true settle a polled and an event driven wait
+return
+
+The rotate command takes the rotator angle, not the IMR angle that ao obrt reads back. Every backend's rotate takes
+the IMR angle and sends imr_to_rotate of it (by default 2 * imr - 0.7, as Internal_Pol_Cal_Sequence.sh does), and
+sequences wait for obrt in IMR degrees. The simulator's rotator converts back with its own rotate_scale and
+rotate_offset, so a conversion that doesn't match the rotator shows up as an IMR that never arrives
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import subprocess
+import threading
+import time
+import itertools
+
+try:
+    import ktl
+except ImportError:
+    ktl = None
+
+#######################################################################
+
+# expstate while a frame is being taken...Filewait is the only state in which the HWP may move
+EXPSTATES = ('Ready', 'Integrating', 'Reading', 'Filewait')
+
+# position keywords of the two rotators
+AXES = {('pcu2', 'PCUPR'): 'hwp', ('ao', 'obrt'): 'imr'}
+
+# rotate argument for an IMR angle, scale * imr + offset...Internal_Pol_Cal_Sequence.sh sends rotate (imr*2-0.7)
+#   and then waits for ao obrt to read back imr
+ROTATE_SCALE = 2.
+ROTATE_OFFSET = -0.7
+
+def imr_to_rotate(imr, scale = ROTATE_SCALE, offset = ROTATE_OFFSET):
+    '''
+    the rotate argument that sends the IMR to imr (the angle ao obrt reads back)...pass another function to the
+        backends for a different convention, e.g. lambda imr: imr if rotate takes the IMR angle itself
+    '''
+
+    return scale * imr + offset
+
+def in_tolerance(target, tol):
+    '''
+    predicate for wait_for...true once a numeric keyword is within tol of target
+    '''
+
+    def predicate(value):
+        try:
+            return abs(float(value) - target) <= tol
+        except (TypeError, ValueError):
+            return False
+
+    return predicate
+
+def wait_for(backend, service, keyword, predicate, timeout = 120.):
+    '''
+    waits for a keyword update that satisfies a predicate
+    in:
+        backend (dict) - keyword backend
+        service, keyword (str) - e.g. 'pcu2', 'PCUPR'
+        predicate (function) - called with the value string, e.g. in_tolerance(45., 0.05)
+        timeout (float) - seconds before giving up
+    out:
+        value (str) - the value that satisfied the predicate, None on timeout
+    '''
+
+    done = threading.Event()
+    result = []
+
+    def callback(value):
+        if not done.is_set() and predicate(value):
+            result.append(value)
+            done.set()
+
+    handle = backend['subscribe'](service, keyword, callback)
+    try:
+        # the backend clock may run faster than real time, so the timeout is counted on it
+        t_start = backend['time']()
+        while not done.is_set() and backend['time']() - t_start < timeout:
+            done.wait(0.05)
+    finally:
+        backend['unsubscribe'](handle)
+
+    return result[0] if result else None
+
+def poll_for(backend, service, keyword, predicate, timeout = 120., poll = 0.4):
+    '''
+    the polling loop of the bash sequences...reads the keyword every poll seconds until the predicate holds
+    in:
+        see wait_for, plus poll (float) - seconds between reads
+    out:
+        value (str) - the value that satisfied the predicate, None on timeout
+    '''
+
+    t_start = backend['time']()
+    while True:
+        value = backend['show'](service, keyword)
+        if value is not None and predicate(value):
+            return value
+        if backend['time']() - t_start > timeout:
+            return None
+        backend['sleep'](poll)
+
+def _run(args):
+    '''
+    runs a keyword command, printing its error if it fails
+    '''
+
+    try:
+        result = subprocess.run(args, capture_output = True, text = True)
+    except OSError as err:
+        print(' '.join(args) + ' failed: ' + str(err))
+        return None
+
+    if result.returncode != 0:
+        print(' '.join(args) + ' failed: ' + result.stderr.strip())
+        return None
+
+    return result.stdout
+
+def _commands(imr_to_rotate = imr_to_rotate):
+    '''
+    the commands that aren't keywords (goi, object, xy, rotate), run as the bash sequences run them...rotate
+        takes the IMR angle and sends imr_to_rotate of it
+    '''
+
+    return {
+        'goi': lambda n: _run(['goi', '-s', str(n)]) is not None,
+        'object': lambda label: _run(['object', label]) is not None,
+        'xy': lambda dx, dy: _run(['xy', str(dx), str(dy)]) is not None,
+        'rotate': lambda imr: _run(['rotate', str(round(imr_to_rotate(imr), 6)), 'stationary']) is not None,
+        'sleep': time.sleep,
+        'time': time.monotonic,
+    }
+
+def _polled_subscriptions(show, poll):
+    '''
+    subscribe / unsubscribe for a backend that can only read...one thread per subscription reads the keyword
+        every poll seconds and calls back when the value changes
+    '''
+
+    stops = {}
+    handles = itertools.count()
+
+    def subscribe(service, keyword, callback):
+        handle = next(handles)
+        stop = threading.Event()
+        stops[handle] = stop
+
+        def watch():
+            last = None
+            while not stop.is_set():
+                value = show(service, keyword)
+                if value is not None and value != last:
+                    last = value
+                    callback(value)
+                stop.wait(poll)
+
+        threading.Thread(target = watch, daemon = True).start()
+        return handle
+
+    def unsubscribe(handle):
+        stops.pop(handle).set()
+
+    return subscribe, unsubscribe
+
+def shell_backend(poll = 0.4, imr_to_rotate = imr_to_rotate):
+    '''
+    backend that runs the KTL command line tools, as the bash sequences do
+    in:
+        poll (float) - seconds between reads of a subscribed keyword
+        imr_to_rotate (function) - rotate argument for an IMR angle
+    out:
+        backend (dict) - see the module docstring
+    '''
+
+    def show(service, keyword):
+        out = _run(['show', '-s', service, keyword])
+        # e.g. 'PCUPR = 45.00 deg'
+        if out is None or '=' not in out:
+            return None
+        value = out.split('=', 1)[1].split()
+        return value[0] if value else None
+
+    subscribe, unsubscribe = _polled_subscriptions(show, poll)
+
+    backend = _commands(imr_to_rotate)
+    backend.update({
+        'show': show,
+        'modify': lambda service, keyword, value: _run(['modify', '-s', service, keyword + '=' + str(value)]) is not None,
+        'subscribe': subscribe,
+        'unsubscribe': unsubscribe,
+    })
+
+    return backend
+
+def ktl_backend(imr_to_rotate = imr_to_rotate):
+    '''
+    backend on the KTL Python bindings...each service is opened once and kept, and subscriptions are KTL monitors
+    in:
+        imr_to_rotate (function) - rotate argument for an IMR angle
+    out:
+        backend (dict) - see the module docstring...False if the bindings aren't installed
+    '''
+
+    if ktl is None:
+        print('Error: the KTL Python bindings are not installed...use shell_backend() instead')
+        return False
+
+    services = {}
+    callbacks = {}
+    handles = itertools.count()
+
+    def keyword_of(service, keyword):
+        if service not in services:
+            services[service] = ktl.cache(service)
+        return services[service][keyword]
+
+    def show(service, keyword):
+        try:
+            return str(keyword_of(service, keyword).read())
+        except Exception as err:
+            print('show ' + service + ' ' + keyword + ' failed: ' + str(err))
+            return None
+
+    def modify(service, keyword, value):
+        try:
+            keyword_of(service, keyword).write(str(value))
+            return True
+        except Exception as err:
+            print('modify ' + service + ' ' + keyword + ' failed: ' + str(err))
+            return False
+
+    def subscribe(service, keyword, callback):
+        kw = keyword_of(service, keyword)
+
+        def ktl_callback(kw):
+            if kw['populated']:
+                callback(str(kw['ascii']))
+
+        handle = next(handles)
+        callbacks[handle] = (kw, ktl_callback)
+        kw.callback(ktl_callback)
+        if not kw['monitored']:
+            kw.monitor()
+        # the monitor only calls back on updates, so the current value is sent first
+        callback(str(kw.read()))
+        return handle
+
+    def unsubscribe(handle):
+        kw, ktl_callback = callbacks.pop(handle)
+        kw.callback(ktl_callback, remove = True)
+
+    backend = _commands(imr_to_rotate)
+    backend.update({'show': show, 'modify': modify, 'subscribe': subscribe, 'unsubscribe': unsubscribe})
+
+    return backend
+
+def simulator(hwp_speed = 10., hwp_accel = 20., imr_speed = 2., imr_accel = 2., settle_error = 0.2,
+              settle_tau = 0.3, start_hwp = 0., start_imr = 0., itime = 5., coadds = 1, setup = 1.0,
+              readout = 0.5, filewrite = 2.0, xy_time = 5., read_latency = 0.05, broadcast_interval = 0.02,
+              rotate_scale = ROTATE_SCALE, rotate_offset = ROTATE_OFFSET, time_scale = 1.):
+    '''
+    a stand-in for the pcu2, ao and alad keywords and the goi / object / xy / rotate commands
+    in:
+        hwp_speed, imr_speed (float) - top rotation speeds in deg/s
+        hwp_accel, imr_accel (float) - accelerations in deg/s^2
+        settle_error (float) - how far short of the target (deg) a move stops before it creeps in
+        settle_tau (float) - time constant of the creep in s
+        start_hwp, start_imr (float) - positions at the start
+        itime, coadds (float, int) - integration time per coadd in s and the number of coadds
+        setup (float) - time from goi to the start of integration in s (expstate Ready)
+        readout (float) - readout time per coadd in s (expstate Reading)
+        filewrite (float) - time to write the file in s (expstate Filewait)
+        xy_time (float) - time for a telescope offset in s
+        read_latency (float) - time a show takes in s...a show, two awks and their process spawns
+        broadcast_interval (float) - seconds between keyword broadcasts to subscribers
+        rotate_scale, rotate_offset (float) - how the rotator turns a rotate argument into an IMR angle...obrt
+            goes to (argument - rotate_offset) / rotate_scale
+        time_scale (float) - real seconds per simulated second...e.g. 0.01 runs 100x faster than real time
+    out:
+        sim (dict) - simulator state, used through sim_backend(sim)
+    '''
+
+    def axis(position, speed, accel):
+        return {'start': float(position), 'target': float(position), 't_start': 0., 'duration': 0.,
+                'speed': speed, 'accel': accel}
+
+    return {
+        'config': {'settle_error': settle_error, 'settle_tau': settle_tau, 'itime': itime, 'coadds': coadds,
+                   'setup': setup, 'readout': readout, 'filewrite': filewrite, 'xy_time': xy_time,
+                   'read_latency': read_latency, 'broadcast_interval': broadcast_interval,
+                   'rotate_scale': rotate_scale, 'rotate_offset': rotate_offset},
+        'time_scale': time_scale,
+        't0': time.monotonic(),
+        'lock': threading.Lock(),
+        'axes': {'hwp': axis(start_hwp, hwp_speed, hwp_accel), 'imr': axis(start_imr, imr_speed, imr_accel)},
+        'exposures': [],
+        'object': '',
+        'frames': [],
+        'moves': [],
+        'violations': [],
+        'subscriptions': {},
+        'handles': itertools.count(),
+        'dispatcher': None,
+    }
+
+def sim_time(sim):
+    '''
+    simulated seconds since the simulator was made
+    '''
+
+    return (time.monotonic() - sim['t0']) / sim['time_scale']
+
+def move_time(distance, speed, accel):
+    '''
+    duration of a move with a trapezoidal velocity profile (triangular if it never reaches top speed)
+    in:
+        distance (float) - length of the move
+        speed (float) - top speed
+        accel (float) - acceleration (and deceleration)
+    out:
+        duration (float) - time from start to stop
+    '''
+
+    distance = abs(distance)
+    if distance < speed**2 / accel:
+        return 2 * np.sqrt(distance / accel)
+    return distance / speed + speed / accel
+
+def _position(sim, axis, t):
+    '''
+    readback of an axis at simulated time t...the trapezoidal move stops settle_error short of the target and
+        the rest is covered exponentially
+    '''
+
+    move = sim['axes'][axis]
+    config = sim['config']
+    distance = move['target'] - move['start']
+    d = abs(distance)
+    creep = min(config['settle_error'], d)
+    elapsed = t - move['t_start']
+
+    if elapsed >= move['duration']:
+        covered = d - creep * np.exp(-(elapsed - move['duration']) / config['settle_tau'])
+    else:
+        # distance covered along the trapezoidal profile
+        accel = move['accel']
+        t_accel = min(move['speed'] / accel, move['duration'] / 2)
+        if elapsed < t_accel:
+            covered = accel * elapsed**2 / 2
+        elif elapsed < move['duration'] - t_accel:
+            covered = accel * t_accel**2 / 2 + accel * t_accel * (elapsed - t_accel)
+        else:
+            covered = d - creep - accel * (move['duration'] - elapsed)**2 / 2
+
+    return move['start'] + np.sign(distance) * covered
+
+def settle_time(sim, axis, tol):
+    '''
+    simulated time at which the last move of an axis came within tol of its target
+    '''
+
+    move = sim['axes'][axis]
+    config = sim['config']
+    d = abs(move['target'] - move['start'])
+    creep = min(config['settle_error'], d)
+    if d <= tol:
+        return move['t_start']
+    if creep <= tol:
+        # the trapezoidal part alone brings it into tolerance...find where along the deceleration
+        accel = move['accel']
+        return max(move['t_start'] + move['duration'] - np.sqrt(2 * (tol - creep) / accel), move['t_start'])
+
+    return move['t_start'] + move['duration'] + config['settle_tau'] * np.log(creep / tol)
+
+def _expstate(sim, t):
+    '''
+    alad expstate at simulated time t
+    '''
+
+    for exposure in sim['exposures']:
+        if exposure['setup'] <= t < exposure['done']:
+            for state, start, end in exposure['states']:
+                if start <= t < end:
+                    return state
+    return 'Ready'
+
+def _value(sim, service, keyword, t):
+    '''
+    keyword value at simulated time t, as a string
+    '''
+
+    axis = AXES.get((service, keyword))
+    if axis is not None:
+        return '{:.3f}'.format(_position(sim, axis, t))
+    if keyword.lower() == 'expstate':
+        return _expstate(sim, t)
+    if keyword.upper() == 'OBJECT':
+        return sim['object']
+    return None
+
+def _sim_show(sim, service, keyword):
+    # the value is read when the command runs, and the answer comes back after the read latency
+    with sim['lock']:
+        value = _value(sim, service, keyword, sim_time(sim))
+    time.sleep(sim['config']['read_latency'] * sim['time_scale'])
+    return value
+
+def _start_move(sim, axis, target):
+    '''
+    sends an axis to a new target from wherever it is now
+    '''
+
+    t = sim_time(sim)
+    move = sim['axes'][axis]
+    start = _position(sim, axis, t)
+    creep = min(sim['config']['settle_error'], abs(target - start))
+    duration = move_time(abs(target - start) - creep, move['speed'], move['accel'])
+    move.update({'start': start, 'target': target, 't_start': t, 'duration': duration})
+    sim['moves'].append({'axis': axis, 'time': t, 'start': start, 'target': target, 'duration': duration})
+
+def _sim_modify(sim, service, keyword, value):
+    if (service, keyword) != ('pcu2', 'PCUPR'):
+        # sound cues and the like are accepted and ignored
+        return True
+
+    with sim['lock']:
+        t = sim_time(sim)
+        state = _expstate(sim, t)
+        if state in ('Integrating', 'Reading'):
+            sim['violations'].append({'time': t, 'expstate': state, 'target': float(value)})
+        _start_move(sim, 'hwp', float(value))
+
+    return True
+
+def _sim_rotate(sim, angle):
+    # angle is the rotate argument...the imr axis is ao obrt, in IMR degrees
+    config = sim['config']
+    with sim['lock']:
+        _start_move(sim, 'imr', (float(angle) - config['rotate_offset']) / config['rotate_scale'])
+    return True
+
+def _sim_goi(sim, n):
+    config = sim['config']
+    integration = config['itime'] * config['coadds']
+    readout = config['readout'] * config['coadds']
+
+    with sim['lock']:
+        t = sim_time(sim)
+        for i in range(n):
+            states = []
+            for state, length in zip(EXPSTATES, (config['setup'], integration, readout, config['filewrite'])):
+                states.append((state, t, t + length))
+                t += length
+            sim['exposures'].append({'setup': states[0][1], 'done': t, 'states': states})
+
+            # the HWP has to be still while the detector integrates
+            t_int, t_read = states[1][1], states[2][2]
+            hwp = sim['axes']['hwp']
+            if hwp['t_start'] + hwp['duration'] > t_int and hwp['t_start'] < t_read:
+                sim['violations'].append({'time': t_int, 'expstate': 'Integrating', 'target': hwp['target']})
+            sim['frames'].append({'object': sim['object'], 'hwp': _position(sim, 'hwp', t_int),
+                                  'imr': _position(sim, 'imr', t_int), 'start': t_int, 'end': t_read})
+        done = t
+
+    # goi returns once the last file is written
+    time.sleep(max(done - sim_time(sim), 0) * sim['time_scale'])
+
+    return True
+
+def _sim_xy(sim, dx, dy):
+    time.sleep(sim['config']['xy_time'] * sim['time_scale'])
+    return True
+
+def _dispatch(sim):
+    '''
+    broadcasts changed keyword values to the subscribers every broadcast_interval, like a KTL dispatcher...runs
+        until the last subscription is dropped
+    '''
+
+    while True:
+        with sim['lock']:
+            if not sim['subscriptions']:
+                sim['dispatcher'] = None
+                return
+            t = sim_time(sim)
+            updates = []
+            for subscription in sim['subscriptions'].values():
+                value = _value(sim, subscription['service'], subscription['keyword'], t)
+                if value != subscription['last']:
+                    subscription['last'] = value
+                    updates.append((subscription['callback'], value))
+
+        for callback, value in updates:
+            callback(value)
+        time.sleep(sim['config']['broadcast_interval'] * sim['time_scale'])
+
+def _sim_subscribe(sim, service, keyword, callback):
+    with sim['lock']:
+        handle = next(sim['handles'])
+        sim['subscriptions'][handle] = {'service': service, 'keyword': keyword, 'callback': callback, 'last': None}
+        if sim['dispatcher'] is None:
+            sim['dispatcher'] = threading.Thread(target = _dispatch, args = (sim,), daemon = True)
+            sim['dispatcher'].start()
+    return handle
+
+def _sim_unsubscribe(sim, handle):
+    with sim['lock']:
+        sim['subscriptions'].pop(handle, None)
+
+def sim_backend(sim, imr_to_rotate = imr_to_rotate):
+    '''
+    backend that runs against a simulator
+    in:
+        sim (dict) - from simulator()
+        imr_to_rotate (function) - rotate argument for an IMR angle
+    out:
+        backend (dict) - see the module docstring...sleep and time are in simulated seconds
+    '''
+
+    def set_object(label):
+        sim['object'] = label
+        return True
+
+    return {
+        'show': lambda service, keyword: _sim_show(sim, service, keyword),
+        'modify': lambda service, keyword, value: _sim_modify(sim, service, keyword, value),
+        'subscribe': lambda service, keyword, callback: _sim_subscribe(sim, service, keyword, callback),
+        'unsubscribe': lambda handle: _sim_unsubscribe(sim, handle),
+        'goi': lambda n: _sim_goi(sim, n),
+        'object': set_object,
+        'xy': lambda dx, dy: _sim_xy(sim, dx, dy),
+        'rotate': lambda imr: _sim_rotate(sim, imr_to_rotate(imr)),
+        'sleep': lambda seconds: time.sleep(seconds * sim['time_scale']),
+        'time': lambda: sim_time(sim),
+    }
+
+def benchmark_settle(targets = (45., 22.5, 67.5, 0.), tol = 0.05, poll = 0.4, time_scale = 0.05, **sim_kwargs):
+    '''
+    how long after the HWP actually settles a polled wait (the bash loop) and an event driven wait return, on
+        the simulator
+    in:
+        targets (list) - HWP angles to move through
+        tol (float) - tolerance in degrees
+        poll (float) - seconds between reads of the polled wait
+        time_scale (float) - real seconds per simulated second
+        sim_kwargs - passed on to simulator(), e.g. read_latency or broadcast_interval
+    out:
+        latency (dict) - 'poll' and 'event' arrays of simulated seconds from settling to returning, per move
+    '''
+
+    latency = {}
+    for method in ('poll', 'event'):
+        sim = simulator(time_scale = time_scale, **sim_kwargs)
+        backend = sim_backend(sim)
+        latency[method] = []
+        for target in targets:
+            backend['modify']('pcu2', 'PCUPR', target)
+            if method == 'poll':
+                poll_for(backend, 'pcu2', 'PCUPR', in_tolerance(target, tol), poll = poll)
+            else:
+                wait_for(backend, 'pcu2', 'PCUPR', in_tolerance(target, tol))
+            latency[method].append(backend['time']() - settle_time(sim, 'hwp', tol))
+        latency[method] = np.array(latency[method])
+
+    return latency
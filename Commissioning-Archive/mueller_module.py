@@ -0,0 +1,387 @@
+'''
+mueller_module.py
+
+Mueller-matrix model fits of the IMR x HWP internal calibration grid (Internal_Pol_Cal_Sequence.sh)
+
+The light from the internal source goes through the HWP in the PCU, then the image rotator (IMR), then the
+Wollaston, so the normalized difference of the two channels of a frame taken at HWP angle theta_h and IMR angle
+theta_i is
+
+    S = P M_imr(theta_i) M_hwp(theta_h) (1, q_in, u_in, 0)
+    (top - bottom) / (top + bottom) = wollaston_efficiency * S_Q / S_I + channel_offset
+
+with each element a linear retarder (and for the IMR a diattenuator) rotated to its angle, and P = diag(1, 1, -1,
+-1) for the odd number of reflections in the IMR. The rotation and retarder matrices are the ones in
+HWP_Modulation_Math.nb:
+
+    M(theta) = T(-theta) M_0 T(theta)
+    T(theta) = [[1, 0, 0, 0], [0, cos 2theta, sin 2theta, 0], [0, -sin 2theta, cos 2theta, 0], [0, 0, 0, 1]]
+    M_0 = [[1, d, 0, 0], [d, 1, 0, 0], [0, 0, r cos delta, r sin delta], [0, 0, -r sin delta, r cos delta]]
+
+with retardance delta, diattenuation d (0 for the HWP) and r = sqrt(1 - d^2). The parameters are PARAMS, angles
+and retardances in degrees. Fitting all of them at once is degenerate (rotating the input polarization and the
+HWP fast axis together changes nothing, and the Wollaston efficiency scales the input polarization), so FIXED
+holds the HWP offset (from the fast-axis calibration, harmonic_module) and the Wollaston efficiency by default
+
+The model and its analytic Jacobian are evaluated for every grid point at once as stacks of 4x4 matrices, and
+scipy's least_squares is given the Jacobian, so a fit takes a few iterations of a few matrix products.
+Uncertainties come from bootstrap resamples of the grid points, and fit_bands spreads the bands and their
+resamples over a pool of worker processes
+
+Typical use:
+    bands = {band: load_grid(directory, 'n*.fits', dark = dark) for band, directory in directories.items()}
+    fits = fit_bands(bands, n_bootstrap = 200, n_workers = 4)
+...or from the batch photometry tables: python mueller_module.py J=phot_J.ecsv H=phot_H.ecsv --bootstrap 200
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import json
+import argparse
+import concurrent.futures
+from astropy.table import Table
+from scipy.optimize import least_squares
+import catalog_module as cm
+import polarimetry_module as pol
+import photometry_module as pm
+import profiling_module as pr
+
+#######################################################################
+
+# model parameters, in the order of the fitted vectors and the Jacobian columns
+PARAMS = ('q_in', 'u_in', 'hwp_retardance', 'hwp_offset', 'imr_retardance', 'imr_offset', 'imr_diattenuation',
+          'wollaston_efficiency', 'channel_offset')
+
+# starting point of every fit...q_in and u_in are replaced by a harmonic estimate unless they are given
+GUESS = {'q_in': 0., 'u_in': 0., 'hwp_retardance': 180., 'hwp_offset': 0., 'imr_retardance': 10.,
+         'imr_offset': 0., 'imr_diattenuation': 0., 'wollaston_efficiency': 1., 'channel_offset': 0.}
+
+# parameters held at these values unless told otherwise (see above)
+FIXED = {'hwp_offset': 0., 'wollaston_efficiency': 1.}
+
+# bounds of the parameters that have them
+BOUNDS = {'q_in': (-1., 1.), 'u_in': (-1., 1.), 'imr_diattenuation': (-0.99, 0.99),
+          'wollaston_efficiency': (0., 1.)}
+
+# P = diag(1, 1, -1, -1) for the reflections in the IMR
+PARITY = np.array([1., 1., -1., -1.])
+
+def _rotation(theta):
+    '''
+    T(theta) of every angle and its derivative dT/dtheta
+    in:
+        theta (np array) - (n,) angles in radians
+    out:
+        rot, drot (np array) - (n, 4, 4)
+    '''
+
+    c, s = np.cos(2 * theta), np.sin(2 * theta)
+    rot = np.zeros(theta.shape + (4, 4))
+    drot = np.zeros(theta.shape + (4, 4))
+    rot[:, 0, 0] = rot[:, 3, 3] = 1.
+    rot[:, 1, 1] = rot[:, 2, 2] = c
+    rot[:, 1, 2], rot[:, 2, 1] = s, -s
+    drot[:, 1, 1] = drot[:, 2, 2] = -2 * s
+    drot[:, 1, 2], drot[:, 2, 1] = 2 * c, -2 * c
+
+    return rot, drot
+
+def _element(theta, retardance, diattenuation = 0.):
+    '''
+    Mueller matrix of a retarder / diattenuator rotated to every angle of a grid, and its derivatives
+    in:
+        theta (np array) - (n,) angles of the element in radians
+        retardance (float) - radians
+        diattenuation (float) - d of M_0
+    out:
+        matrix (np array) - (n, 4, 4) M(theta)
+        derivs (dict) - (n, 4, 4) derivatives by 'theta', 'retardance' (both per radian) and 'diattenuation'
+    '''
+
+    c, s = np.cos(retardance), np.sin(retardance)
+    r = np.sqrt(1 - diattenuation**2)
+
+    m0 = np.array([[1., diattenuation, 0., 0.], [diattenuation, 1., 0., 0.],
+                   [0., 0., r * c, r * s], [0., 0., -r * s, r * c]])
+    dm0_ret = np.array([[0., 0., 0., 0.], [0., 0., 0., 0.], [0., 0., -r * s, r * c], [0., 0., -r * c, -r * s]])
+    dr = -diattenuation / r
+    dm0_dia = np.array([[0., 1., 0., 0.], [1., 0., 0., 0.], [0., 0., dr * c, dr * s], [0., 0., -dr * s, dr * c]])
+
+    rot, drot = _rotation(theta)
+    rot_back, drot_back = _rotation(-theta)
+
+    # d/dtheta of T(-theta) M_0 T(theta)
+    dtheta = -drot_back @ m0 @ rot + rot_back @ m0 @ drot
+
+    return rot_back @ m0 @ rot, {'theta': dtheta, 'retardance': rot_back @ dm0_ret @ rot,
+                                 'diattenuation': rot_back @ dm0_dia @ rot}
+
+def model(values, hwp, imr, jacobian = False):
+    '''
+    normalized difference of the model at every grid point
+    in:
+        values (dict or np array) - a value for every one of PARAMS, or a vector in the order of PARAMS
+        hwp, imr (np array) - (n,) HWP and IMR angles of the grid points in degrees
+        jacobian (bool) - also return the derivatives
+    out:
+        norm_diff (np array) - (n,) (top - bottom) / (top + bottom)
+        jac (np array) - (n, len(PARAMS)) derivatives by every parameter, per degree for the angles and
+            retardances...only if jacobian
+    '''
+
+    if isinstance(values, dict):
+        values = np.array([values[name] for name in PARAMS], dtype = float)
+    q_in, u_in, hwp_ret, hwp_off, imr_ret, imr_off, imr_dia, efficiency, offset = values
+    hwp = np.radians(np.asarray(hwp, dtype = float))
+    imr = np.radians(np.asarray(imr, dtype = float))
+
+    m_hwp, d_hwp = _element(hwp + np.radians(hwp_off), np.radians(hwp_ret))
+    m_imr, d_imr = _element(imr + np.radians(imr_off), np.radians(imr_ret), imr_dia)
+
+    stokes_in = np.array([1., q_in, u_in, 0.])
+    after_hwp = m_hwp @ stokes_in
+    out = PARITY * np.einsum('nij,nj->ni', m_imr, after_hwp)
+    norm_diff = efficiency * out[:, 1] / out[:, 0] + offset
+
+    if not jacobian:
+        return norm_diff
+
+    # derivatives of the Stokes vector out of the IMR, (n, n_params, 4)...the HWP and input terms go through the
+    #   IMR, the IMR terms act on the light the HWP sent it
+    deg = np.pi / 180.
+    d_after_hwp = np.stack([m_hwp[:, :, 1], m_hwp[:, :, 2], deg * d_hwp['retardance'] @ stokes_in,
+                            deg * d_hwp['theta'] @ stokes_in], axis = 1)
+    d_out = np.concatenate([
+        PARITY * np.einsum('nij,nkj->nki', m_imr, d_after_hwp),
+        PARITY * np.stack([deg * np.einsum('nij,nj->ni', d_imr['retardance'], after_hwp),
+                           deg * np.einsum('nij,nj->ni', d_imr['theta'], after_hwp),
+                           np.einsum('nij,nj->ni', d_imr['diattenuation'], after_hwp)], axis = 1)], axis = 1)
+
+    ratio = out[:, 1] / out[:, 0]
+    d_ratio = (d_out[:, :, 1] - ratio[:, None] * d_out[:, :, 0]) / out[:, 0, None]
+    jac = np.column_stack([efficiency * d_ratio, ratio, np.ones_like(ratio)])
+
+    return norm_diff, jac
+
+def _start(hwp, imr, norm_diff, guess):
+    '''
+    starting values of a fit...q_in and u_in from the 4 theta harmonic of the normalized difference, which is what
+        an ideal HWP and IMR would give, unless the guess has them
+    '''
+
+    start = dict(GUESS)
+    theta = np.radians(4 * np.asarray(hwp, dtype = float))
+    design = np.column_stack([np.ones_like(theta), np.cos(theta), np.sin(theta)])
+    coefs = np.linalg.lstsq(design, norm_diff, rcond = None)[0]
+    start['q_in'], start['u_in'] = np.clip(coefs[1:], -0.9, 0.9)
+    start.update(guess or {})
+
+    return start
+
+def fit_grid(hwp, imr, norm_diff, guess = None, fixed = FIXED, sigma = None):
+    '''
+    least-squares fit of the Mueller-matrix model to the normalized differences of a calibration grid
+    in:
+        hwp, imr (np array) - (n,) HWP and IMR angles of every frame in degrees
+        norm_diff (np array) - (n,) (top - bottom) / (top + bottom) of every frame
+        guess (dict) - starting values for any of PARAMS, over GUESS
+        fixed (dict) - parameters to hold at the given values, e.g. FIXED
+        sigma (np array) - (n,) 1 sigma errors of the normalized differences, None to weight them equally
+    out:
+        fit (dict) - 'params' (every one of PARAMS, fixed ones included), 'errors' (from the covariance, scaled
+            by the reduced chi^2 when there's no sigma...0 for the fixed ones), 'free' (names fitted),
+            'covariance' (of the free ones), 'residual_rms', 'chi2', 'n_points', 'nfev' and 'success'
+    '''
+
+    hwp = np.asarray(hwp, dtype = float)
+    imr = np.asarray(imr, dtype = float)
+    norm_diff = np.asarray(norm_diff, dtype = float)
+    weights = np.ones_like(norm_diff) if sigma is None else 1 / np.asarray(sigma, dtype = float)
+
+    start = _start(hwp, imr, norm_diff, guess)
+    values = np.array([fixed.get(name, start[name]) for name in PARAMS], dtype = float)
+    free = np.array([name not in fixed for name in PARAMS])
+    names = [name for name in PARAMS if name not in fixed]
+
+    def residuals(x):
+        values[free] = x
+        return weights * (model(values, hwp, imr) - norm_diff)
+
+    def jac(x):
+        values[free] = x
+        return weights[:, None] * model(values, hwp, imr, jacobian = True)[1][:, free]
+
+    lower = [BOUNDS.get(name, (-np.inf, np.inf))[0] for name in names]
+    upper = [BOUNDS.get(name, (-np.inf, np.inf))[1] for name in names]
+    x0 = np.clip(values[free], np.nextafter(lower, 0), np.nextafter(upper, 0))
+    result = least_squares(residuals, x0, jac = jac, bounds = (lower, upper), method = 'trf', x_scale = 'jac')
+    values[free] = result.x
+
+    # covariance from the Jacobian at the solution...pinv copes with parameters the grid doesn't constrain
+    chi2 = float(np.sum(result.fun**2))
+    dof = max(len(norm_diff) - len(names), 1)
+    covariance = np.linalg.pinv(result.jac.T @ result.jac)
+    if sigma is None:
+        covariance = covariance * chi2 / dof
+    errors = np.zeros(len(PARAMS))
+    errors[free] = np.sqrt(np.diag(covariance))
+
+    residual = model(values, hwp, imr) - norm_diff
+    return {'params': dict(zip(PARAMS, values.tolist())), 'errors': dict(zip(PARAMS, errors.tolist())),
+            'free': names, 'covariance': covariance, 'residual_rms': float(np.sqrt(np.mean(residual**2))),
+            'chi2': chi2, 'n_points': len(norm_diff), 'nfev': int(result.nfev), 'success': bool(result.success)}
+
+def _bootstrap(hwp, imr, norm_diff, sigma, start, fixed, seed, n_resamples):
+    '''
+    fits of n_resamples bootstrap resamples of the grid points, started from the best fit...run in the workers
+    '''
+
+    rng = np.random.default_rng(seed)
+    samples = np.empty((n_resamples, len(PARAMS)))
+    for i in range(n_resamples):
+        pick = rng.integers(0, len(norm_diff), len(norm_diff))
+        fit = fit_grid(hwp[pick], imr[pick], norm_diff[pick], start, fixed, None if sigma is None else sigma[pick])
+        samples[i] = [fit['params'][name] for name in PARAMS]
+
+    return samples
+
+def _fit_band(band, grid, guess, fixed):
+    '''
+    fit of one band's grid...run in the workers
+    '''
+
+    with pr.stage('mueller_fit', band = band, points = len(grid['norm_diff'])):
+        return fit_grid(grid['hwp'], grid['imr'], grid['norm_diff'], guess, fixed, grid.get('sigma'))
+
+def fit_bands(bands, n_bootstrap = 100, n_workers = 1, guess = None, fixed = FIXED, seed = 0, chunk = 25):
+    '''
+    fits the calibration grid of every band and bootstraps the uncertainties
+    in:
+        bands (dict) - {band name: grid} with grids from load_grid or load_photometry
+        n_bootstrap (int) - bootstrap resamples per band, 0 for none
+        n_workers (int or None) - worker processes the fits are spread over...1 fits everything in this process,
+            None uses every core
+        guess (dict) - starting values over GUESS
+        fixed (dict) - parameters held fixed
+        seed (int) - random seed of the resamples
+        chunk (int) - resamples per task sent to a worker
+    out:
+        fits (dict) - {band name: fit} with the fits from fit_grid, plus 'bootstrap' ((n_bootstrap, len(PARAMS))
+            parameters of the resamples) and 'bootstrap_errors' (their standard deviations) with n_bootstrap > 0
+    '''
+
+    names = list(bands)
+    pool = None
+    if n_workers != 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = n_workers, **pr.pool_args())
+
+    def run(func, *args):
+        return pool.submit(func, *args) if pool is not None else func(*args)
+
+    def result(job):
+        return job.result() if pool is not None else job
+
+    try:
+        jobs = {band: run(_fit_band, band, bands[band], guess, fixed) for band in names}
+        fits_out = {band: result(jobs[band]) for band in names}
+
+        # every band's resamples in chunks, each chunk with its own stream of random numbers
+        streams = iter(np.random.SeedSequence(seed).spawn(len(names) * (n_bootstrap // max(chunk, 1) + 1)))
+        jobs = []
+        for band in names:
+            grid = bands[band]
+            arrays = [np.asarray(grid[key], dtype = float) for key in ('hwp', 'imr', 'norm_diff')]
+            sigma = None if grid.get('sigma') is None else np.asarray(grid['sigma'], dtype = float)
+            for start in range(0, n_bootstrap, chunk):
+                jobs.append((band, run(_bootstrap, *arrays, sigma, fits_out[band]['params'], fixed, next(streams),
+                                       min(chunk, n_bootstrap - start))))
+
+        with pr.stage('mueller_bootstrap', resamples = n_bootstrap * len(names)):
+            samples = {band: [] for band in names}
+            for band, job in jobs:
+                samples[band].append(result(job))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for band in names:
+        if samples[band]:
+            boot = np.concatenate(samples[band])
+            fits_out[band]['bootstrap'] = boot
+            fits_out[band]['bootstrap_errors'] = dict(zip(PARAMS, np.std(boot, axis = 0, ddof = 1).tolist()))
+
+    return fits_out
+
+def load_grid(directory, pattern = '*.fits', channels = pol.CHANNELS, dark = None, flat = None, refresh = True):
+    '''
+    the channel fluxes of every frame of a calibration grid, from the <base>_imr_<imr>_hwp_<hwp> frames
+    in:
+        directory (str) - folder with the frames...the OBJECT keywords come from the header catalog
+        pattern (str) - glob pattern for the file names, e.g. 'n*.fits'
+        channels (dict) - 'top' and 'bottom' channel boxes
+        dark (np array) - dark to subtract from every frame, None for no dark
+        flat (np array) - normalized flat to divide every frame by, None for no flat
+        refresh (bool) - bring the header catalog up to date first
+    out:
+        grid (dict) - 'hwp', 'imr', 'top', 'bottom' and 'norm_diff' arrays with one value per frame
+    '''
+
+    boxes = [channels['top'], channels['bottom']]
+    rows = []
+    for row in cm.query_catalog(directory, pattern, refresh = refresh):
+        label = pol.parse_label(row['object'])
+        if label is None or label[2] is None:
+            continue
+
+        frame = pol._read_frame([row['path']], dark, flat)
+        top, bottom = pm.box_sums(frame, boxes)[0]
+        rows.append((label[1], label[2], top, bottom))
+
+    hwp, imr, top, bottom = np.array(rows, dtype = float).reshape(-1, 4).T
+    return {'hwp': hwp, 'imr': imr, 'top': top, 'bottom': bottom, 'norm_diff': (top - bottom) / (top + bottom)}
+
+def load_photometry(path):
+    '''
+    a calibration grid from the photometry table batch_module writes for a sequence...frames without an IMR
+        angle are left out
+    '''
+
+    table = Table.read(path, format = 'ascii.ecsv')
+    table = table[np.isfinite(np.asarray(table['imr'], dtype = float))]
+
+    return {key: np.asarray(table[key], dtype = float) for key in ('hwp', 'imr', 'top', 'bottom', 'norm_diff')}
+
+def save_fits(fits_out, path):
+    '''
+    writes the fits of fit_bands as JSON...the covariance and bootstrap samples as nested lists
+    '''
+
+    out = {}
+    for band, fit in fits_out.items():
+        out[band] = {key: np.asarray(value).tolist() if isinstance(value, np.ndarray) else value
+                     for key, value in fit.items()}
+
+    with open(path, 'w') as fo:
+        json.dump(out, fo, indent = 1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Mueller-matrix fits of the IMR x HWP calibration grids')
+    parser.add_argument('bands', nargs = '+', help = 'band=photometry table (from batch_module) for every band')
+    parser.add_argument('--bootstrap', type = int, default = 100, help = 'bootstrap resamples per band')
+    parser.add_argument('--workers', type = int, default = 1, help = 'worker processes, 0 for every core')
+    parser.add_argument('--save', help = 'JSON file to write the fits to')
+    args = parser.parse_args()
+
+    bands = dict(band.split('=', 1) for band in args.bands)
+    fits_out = fit_bands({band: load_photometry(path) for band, path in bands.items()}, args.bootstrap,
+                         args.workers or None)
+
+    for band, fit in fits_out.items():
+        errors = fit.get('bootstrap_errors', fit['errors'])
+        print(band + ': ' + ', '.join('{} {:.4f} +/- {:.4f}'.format(name, fit['params'][name], errors[name])
+                                      for name in fit['free']) +
+              ', rms {:.2e}'.format(fit['residual_rms']))
+
+    if args.save:
+        save_fits(fits_out, args.save)
@@ -0,0 +1,173 @@
+'''
+photometry_module.py
+
+Batched photometry for stacks of NIRC2 frames...the same measurements as mod_centroid and aperture_sum in
+throughput_module.py, plus the top/bottom box sums from the commissioning notebooks, but done on a whole
+(n_frames, ny, nx) stack at once
+
+Aperture sums only ever touch a small cutout around each centroid, and the coordinate grids of the cutouts are
+cached, so nothing the size of the full frame is allocated per image
+'''
+
+############################## Imports ################################
+
+import numpy as np
+from functools import lru_cache
+
+#######################################################################
+
+@lru_cache(maxsize = 32)
+def _offset_grid(half_width, subpixel = 1):
+    '''
+    pixel offsets of a (2*half_width + 1) square cutout from its central pixel...with subpixel > 1 every pixel
+        is split into subpixel x subpixel samples, which go along the last axis
+    in:
+        half_width (int) - half width of the cutout in pixels
+        subpixel (int) - samples per pixel along each axis
+    out:
+        dy, dx - read-only offset arrays of shape (size, 1, n_samples) and (1, size, n_samples)
+    '''
+
+    offsets = np.arange(-half_width, half_width + 1, dtype = float)
+
+    # centers of the sub-pixel samples within a pixel
+    samples = (np.arange(subpixel) + 0.5) / subpixel - 0.5
+    sy, sx = np.meshgrid(samples, samples, indexing = 'ij')
+
+    dy = offsets[:, None, None] + sy.ravel()[None, None, :]
+    dx = offsets[None, :, None] + sx.ravel()[None, None, :]
+    dy.setflags(write = False)
+    dx.setflags(write = False)
+
+    return dy, dx
+
+def _cutouts(stack, iy, ix, half_width):
+    '''
+    pulls a (2*half_width + 1) square cutout centered on pixel (iy[i], ix[i]) out of every frame of the stack...
+        pixels that fall off the edge of the frame come back as 0
+    in:
+        stack (np array) - (n_frames, ny, nx) stack of frames
+        iy, ix (np arrays) - integer center of the cutout for each frame
+        half_width (int) - half width of the cutout in pixels
+    out:
+        cutouts (np array) - (n_frames, size, size) cutouts
+    '''
+
+    n_frames, ny, nx = stack.shape
+    offsets = np.arange(-half_width, half_width + 1)
+
+    rows = iy[:, None] + offsets[None, :]
+    cols = ix[:, None] + offsets[None, :]
+    good = ((rows >= 0) & (rows < ny))[:, :, None] & ((cols >= 0) & (cols < nx))[:, None, :]
+
+    frames = np.arange(n_frames)[:, None, None]
+    cutouts = stack[frames, np.clip(rows, 0, ny - 1)[:, :, None], np.clip(cols, 0, nx - 1)[:, None, :]]
+
+    return np.where(good, cutouts, 0)
+
+def centroid_stack(stack, threshold, guess = None, half_width = None):
+    '''
+    the mod_centroid of every frame in a stack: each frame is turned into a binary image based on the threshold,
+        and the centroid of that binary image is returned...if a guess and half_width are given, only the cutout
+        around the guess is thresholded instead of the full frame
+    in:
+        stack (np array) - (n_frames, ny, nx) stack of frames, or a single frame
+        threshold - value in counts
+        guess - [y,x] rough position of the beam, either one for all frames or one per frame
+        half_width (int) - half width in pixels of the cutout around the guess
+    out:
+        coms (np array) - (n_frames, 2) [y,x] coordinates of the centroids...nan if nothing is above threshold
+    '''
+
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    n_frames = stack.shape[0]
+
+    if guess is None or half_width is None:
+        mask = stack > threshold
+        y0 = np.zeros(n_frames)
+        x0 = np.zeros(n_frames)
+    else:
+        guess = np.broadcast_to(np.asarray(guess, dtype = float), (n_frames, 2))
+        iy = np.rint(guess[:, 0]).astype(int)
+        ix = np.rint(guess[:, 1]).astype(int)
+        mask = _cutouts(stack, iy, ix, half_width) > threshold
+        y0 = iy - half_width
+        x0 = ix - half_width
+
+    # centroid of a binary image from its row and column projections
+    counts = mask.sum(axis = (1, 2))
+    rows = mask.sum(axis = 2) @ np.arange(mask.shape[1])
+    cols = mask.sum(axis = 1) @ np.arange(mask.shape[2])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        coms = np.stack((y0 + rows / counts, x0 + cols / counts), axis = 1)
+
+    return coms
+
+def aperture_sums(stack, coms, radii, subpixel = 1):
+    '''
+    the aperture_sum of every frame in a stack for every radius in one go...each frame is summed within each
+        radius of its own centroid
+    in:
+        stack (np array) - (n_frames, ny, nx) stack of frames, or a single frame
+        coms - (n_frames, 2) [y,x] centroids (given by centroid_stack), or one [y,x] for all frames
+        radii (list) - radii in pixels to sum over
+        subpixel (int) - 1 counts a pixel if its center is within the radius, like aperture_sum...larger values
+            weight each pixel by the fraction of its subpixel x subpixel samples within the radius
+    out:
+        sums (np array) - (n_frames, n_radii) total counts within each aperture
+    '''
+
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    n_frames = stack.shape[0]
+
+    coms = np.broadcast_to(np.asarray(coms, dtype = float), (n_frames, 2))
+    radii = np.atleast_1d(np.asarray(radii, dtype = float))
+
+    # the cutout only has to reach the largest radius (plus the rounding of the center)
+    half_width = int(np.ceil(radii.max())) + 1
+    iy = np.rint(coms[:, 0]).astype(int)
+    ix = np.rint(coms[:, 1]).astype(int)
+    cutouts = _cutouts(stack, iy, ix, half_width)
+
+    # distance of every (sub)pixel sample from the centroid, from the cached offsets
+    dy, dx = _offset_grid(half_width, subpixel)
+    fy = (iy - coms[:, 0])[:, None, None, None]
+    fx = (ix - coms[:, 1])[:, None, None, None]
+    distances = np.sqrt((dy[None] + fy)**2 + (dx[None] + fx)**2)
+
+    sums = np.empty((n_frames, len(radii)))
+    for j, radius in enumerate(radii):
+        weights = (distances <= radius).mean(axis = 3)
+        # only pixels inside the aperture count, so a NaN outside it (e.g. where the flat is 0) doesn't spread
+        sums[:, j] = np.sum(np.where(weights > 0, cutouts, 0) * weights, axis = (1, 2))
+
+    return sums
+
+def box_sums(stack, boxes):
+    '''
+    nan-ignoring sums of rectangular boxes in every frame of a stack...e.g. the top and bottom Wollaston channels
+        in the HWP modulation notebooks
+    in:
+        stack (np array) - (n_frames, ny, nx) stack of frames, or a single frame
+        boxes (list) - (y0, y1, x0, x1) for each box, inclusive start and exclusive end...clipped to the frame
+    out:
+        sums (np array) - (n_frames, n_boxes) sum of each box
+    '''
+
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    ny, nx = stack.shape[1:]
+
+    sums = np.empty((stack.shape[0], len(boxes)))
+    for j, (y0, y1, x0, x1) in enumerate(boxes):
+        y0, y1 = np.clip([y0, y1], 0, ny)
+        x0, x1 = np.clip([x0, x1], 0, nx)
+        sums[:, j] = np.nansum(stack[:, y0:y1, x0:x1], axis = (1, 2))
+
+    return sums
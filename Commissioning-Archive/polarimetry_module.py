@@ -0,0 +1,190 @@
+'''
+polarimetry_module.py
+
+Dual-channel double-difference reduction of the frames taken by HWP_Rotation_Sequence.sh
+
+The sequence labels every frame with OBJECT = <BASE_OBJ>_hwp_<angle> while it cycles the HWP through
+0, 45, 22.5 and 67.5 degrees. This module groups a night's frames into complete HWP cycles from those labels,
+cuts the top and bottom Wollaston channels out of each frame, and computes the double-difference Q and U and
+double-sum intensity images for every cycle (see de Boer+ 2020):
+
+    D(theta) = top - bottom, S(theta) = top + bottom
+    Q = (D(0) - D(45)) / 2, I_Q = (S(0) + S(45)) / 2
+    U = (D(22.5) - D(67.5)) / 2, I_U = (S(22.5) + S(67.5)) / 2
+
+All the cycles of a chunk are computed as one stack operation, and long sequences are read chunk_cycles cycles
+at a time so memory stays bounded
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import re
+from astropy.io import fits
+import catalog_module as cm
+
+#######################################################################
+
+# the four critical HWP angles, in the order the Stokes engine expects them
+HWP_ANGLES = (0.0, 45.0, 22.5, 67.5)
+
+# Wollaston channel boxes (y0, y1, x0, x1) in a full 1024x1024 frame, as in the HWP modulation notebooks...
+#   both channels have to be the same size so they can be differenced pixel by pixel
+CHANNELS = {'top': (575, 985, 250, 950), 'bottom': (40, 450, 250, 950)}
+
+# OBJECT labels written by the observing sequences, e.g. 'hd183143_hwp_22.5' or 'pol_cal_imr_15.0_hwp_40.0'
+_LABEL = re.compile(r'^(?P<base>.*?)(?:_imr_(?P<imr>[-+]?\d+(?:\.\d+)?))?_hwp_(?P<hwp>[-+]?\d+(?:\.\d+)?)$')
+
+def parse_label(obj):
+    '''
+    splits an OBJECT label from one of the sequences into its parts
+    in:
+        obj (str) - OBJECT header value
+    out:
+        base (str) - base object name
+        hwp (float) - HWP angle in degrees
+        imr (float) - IMR angle in degrees, None if the label doesn't have one
+        ...or None if the label isn't from a sequence
+    '''
+
+    match = _LABEL.match(str(obj).strip())
+    if match is None:
+        return None
+
+    imr = match.group('imr')
+    return match.group('base'), float(match.group('hwp')), None if imr is None else float(imr)
+
+def group_hwp_cycles(directory, pattern = '*.fits', angles = HWP_ANGLES, refresh = True):
+    '''
+    groups the frames of a night into complete HWP cycles...frames are taken in file order, and a cycle ends
+        when the base object changes or an angle that is already in the cycle comes around again after a
+        different angle (NUM_EXPOSURES > 1 puts several frames at the same angle in one cycle)...incomplete
+        cycles, e.g. from an aborted sequence, are dropped
+    in:
+        directory (str) - folder with the night's frames...the OBJECT keywords come from the header catalog
+        pattern (str) - glob pattern for the file names, e.g. 'n*.fits'
+        angles (tuple) - HWP angles a complete cycle needs
+        refresh (bool) - bring the header catalog up to date first
+    out:
+        cycles (list of dict) - {'base': base object, 'files': {angle: [paths]}} for every complete cycle
+    '''
+
+    rows = cm.query_catalog(directory, pattern, refresh = refresh)
+
+    cycles = []
+    current = None
+    last_angle = None
+
+    def close(cycle):
+        if cycle is not None and all(angle in cycle['files'] for angle in angles):
+            cycles.append(cycle)
+
+    for row in rows:
+        label = parse_label(row['object'])
+        if label is None or label[1] not in angles:
+            continue
+        base, hwp, imr = label
+
+        new_cycle = (current is None or base != current['base'] or
+                     (hwp in current['files'] and hwp != last_angle))
+        if new_cycle:
+            close(current)
+            current = {'base': base, 'files': {}}
+
+        current['files'].setdefault(hwp, []).append(row['path'])
+        last_angle = hwp
+
+    close(current)
+
+    return cycles
+
+def split_channels(frames, channels = CHANNELS):
+    '''
+    cuts the top and bottom Wollaston channels out of a stack of frames
+    in:
+        frames (np array) - (..., ny, nx) frames
+        channels (dict) - 'top' and 'bottom' boxes (y0, y1, x0, x1) of the same size
+    out:
+        channel_stack (np array) - (..., 2, box_ny, box_nx) with top first, then bottom
+    '''
+
+    (ty0, ty1, tx0, tx1), (by0, by1, bx0, bx1) = channels['top'], channels['bottom']
+
+    top = frames[..., ty0:ty1, tx0:tx1]
+    bottom = frames[..., by0:by1, bx0:bx1]
+
+    return np.stack((top, bottom), axis = -3)
+
+def double_difference(cycle_stack):
+    '''
+    double-difference Q, U and double-sum intensities for a stack of HWP cycles
+    in:
+        cycle_stack (np array) - (n_cycles, 4, 2, ny, nx)...the HWP angles in the order of HWP_ANGLES, then the
+            top and bottom channels
+    out:
+        stokes (dict) - 'Q', 'U', 'I_Q' and 'I_U', each (n_cycles, ny, nx)
+    '''
+
+    top = cycle_stack[:, :, 0]
+    bottom = cycle_stack[:, :, 1]
+
+    # single differences and sums for every angle of every cycle at once
+    diff = top - bottom
+    total = top + bottom
+
+    return {'Q': (diff[:, 0] - diff[:, 1]) / 2, 'U': (diff[:, 2] - diff[:, 3]) / 2,
+            'I_Q': (total[:, 0] + total[:, 1]) / 2, 'I_U': (total[:, 2] + total[:, 3]) / 2}
+
+def _read_frame(paths, dark = None, flat = None):
+    '''
+    the mean of the frames at one HWP angle, dark subtracted and flat fielded
+    '''
+
+    frame = 0
+    for path in paths:
+        with fits.open(path) as hdul:
+            frame = frame + np.asarray(hdul[0].data, dtype = float)
+    frame = frame / len(paths)
+
+    if dark is not None:
+        frame = frame - dark
+    if flat is not None:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frame = np.where(flat != 0, frame / flat, np.nan)
+
+    return frame
+
+def reduce_hwp_cycles(cycles, angles = HWP_ANGLES, dark = None, flat = None, channels = CHANNELS, chunk_cycles = 8):
+    '''
+    runs the double-difference reduction on every complete HWP cycle from group_hwp_cycles
+    in:
+        cycles (list of dict) - cycles from group_hwp_cycles
+        angles (tuple) - the four HWP angles the cycles were grouped with, in double-difference order (Q+, Q-, U+,
+            U-)...e.g. (5., 50., 27.5, 72.5) for a HWP with a 5 degree offset
+        dark (np array) - dark to subtract from every frame (e.g. from calibration_module), None for no dark
+        flat (np array) - normalized flat to divide every frame by, None for no flat
+        channels (dict) - 'top' and 'bottom' channel boxes
+        chunk_cycles (int) - number of cycles read and reduced at a time
+    out:
+        stokes (dict) - 'Q', 'U', 'I_Q' and 'I_U' as float32 (n_cycles, ny, nx) stacks, plus 'base' with the base
+            object of every cycle
+    '''
+
+    stokes = {key: [] for key in ('Q', 'U', 'I_Q', 'I_U')}
+
+    for start in range(0, len(cycles), chunk_cycles):
+        chunk = cycles[start:start + chunk_cycles]
+
+        # (n_cycles, 4, 2, ny, nx)...only the channel boxes of each frame are kept
+        cycle_stack = np.stack([[split_channels(_read_frame(cycle['files'][angle], dark, flat), channels)
+                                 for angle in angles] for cycle in chunk])
+        result = double_difference(cycle_stack)
+
+        for key in stokes:
+            stokes[key].append(result[key].astype(np.float32))
+
+    for key in ('Q', 'U', 'I_Q', 'I_U'):
+        stokes[key] = np.concatenate(stokes[key]) if stokes[key] else np.empty((0, 0, 0), dtype = np.float32)
+    stokes['base'] = [cycle['base'] for cycle in cycles]
+
+    return stokes
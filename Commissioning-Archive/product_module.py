@@ -0,0 +1,164 @@
+'''
+product_module.py
+
+Output formats for the fits products written by the reductions (_dsub, _dsub_norm)
+
+The products have always been written as uncompressed primary HDUs of whatever dtype the reduction produced
+('native'...float64 for integer NIRC2 frames), which is 2-4x the size of the raw data they came from.
+write_product() can also write them as
+
+    'float64'   - uncompressed float64, whatever the data came in as
+    'float32'   - uncompressed, half the size of float64...the rounding (~6e-8 relative) is far below the read noise
+    'rice'      - tile compressed (RICE_1) in an image extension
+    'hcompress' - tile compressed (HCOMPRESS_1) with one frame per tile
+
+Compressed products of integer-valued data (e.g. a dark subtracted cube when the dark median is a whole number)
+are stored as 32 bit integers, which is lossless. Anything else is quantized before it is compressed:
+quantize_level sets the quantization step as a fraction of the noise in each tile (step = sigma / quantize_level,
+with subtractive dithering), so the error is a small, flat fraction of the noise rather than of the signal
+
+Compressed data sit in HDU 1 behind an empty primary HDU, so anything that reads a product should go through
+data_hdu(), read_header() or read_data(), which find the data whatever the format, and change headers with
+update_header(), which doesn't decompress (and so requantize) the data
+'''
+
+############################## Imports ################################
+
+import numpy as np
+from astropy.io import fits
+
+#######################################################################
+
+# the formats products can be written in, and the compression of each (None for uncompressed)
+FORMATS = {
+    'native': None,
+    'float64': None,
+    'float32': None,
+    'rice': 'RICE_1',
+    'hcompress': 'HCOMPRESS_1',
+}
+
+# default quantization, as noise sigma over the quantization step (astropy's and cfitsio's default)
+QUANTIZE_LEVEL = 16
+
+def check_format(output_format):
+    '''
+    makes sure an output format is one of FORMATS
+    in:
+        output_format (str) - format name
+    out:
+        ok (bool) - True if it is...otherwise the formats are printed and it's False
+    '''
+
+    if output_format not in FORMATS:
+        print('Unknown output format ' + str(output_format) + ', use one of ' + ', '.join(FORMATS))
+        return False
+
+    return True
+
+def is_integer_valued(data):
+    '''
+    whether every value of an array is a whole number that fits in a 32 bit integer...those compress losslessly
+    '''
+
+    data = np.asarray(data)
+    if data.dtype.kind in 'iub':
+        return data.size == 0 or (data.min() >= -2**31 and data.max() < 2**31)
+
+    finite = np.isfinite(data)
+    if not finite.all():
+        return False
+
+    return data.size == 0 or (np.array_equal(data, np.round(data)) and data.min() >= -2**31 and data.max() < 2**31)
+
+def product_hdus(data, hdr, output_format = 'native', quantize_level = QUANTIZE_LEVEL):
+    '''
+    the HDU list a product is written as
+    in:
+        data (np array) - the frame or cube
+        hdr (fits header) - header to carry over (e.g. with OPMPOWER, NORMPWR)
+        output_format (str) - one of FORMATS
+        quantize_level (float) - quantization of non-integer data in the compressed formats, see above
+    out:
+        hdul (fits HDUList) - a primary HDU for the uncompressed formats, an empty primary and a compressed image
+            extension for 'rice' and 'hcompress'
+    '''
+
+    data = np.asarray(data)
+    compression = FORMATS[output_format]
+
+    if compression is None:
+        if output_format != 'native':
+            data = data.astype(output_format, copy = False)
+        return fits.HDUList([fits.PrimaryHDU(data = data, header = hdr)])
+
+    if is_integer_valued(data):
+        data = data.astype(np.int32, copy = False)
+    else:
+        data = data.astype(np.float32, copy = False)
+
+    # HCOMPRESS only works on 2d tiles...one frame each
+    tile_shape = None
+    if compression == 'HCOMPRESS_1' and data.ndim > 1:
+        tile_shape = (1,) * (data.ndim - 2) + data.shape[-2:]
+
+    comp = fits.CompImageHDU(data = data, header = hdr, compression_type = compression,
+                             quantize_level = quantize_level, tile_shape = tile_shape)
+
+    return fits.HDUList([fits.PrimaryHDU(), comp])
+
+def write_product(write_path, data, hdr, output_format = 'native', quantize_level = QUANTIZE_LEVEL,
+                  overwrite = False):
+    '''
+    writes a product
+    in:
+        write_path (str) - where the product is saved
+        data (np array) - the frame or cube
+        hdr (fits header) - header to carry over
+        output_format (str) - one of FORMATS
+        quantize_level (float) - quantization of non-integer data in the compressed formats
+        overwrite (bool) - replace an existing file...like writeto, it is an error otherwise
+    '''
+
+    product_hdus(data, hdr, output_format, quantize_level).writeto(write_path, overwrite = overwrite)
+
+def data_hdu(hdul):
+    '''
+    the HDU of an open fits file that holds the image...the primary HDU, or the first extension if the primary is
+        empty (a compressed product)
+    '''
+
+    if hdul[0].header.get('NAXIS', 0) == 0 and len(hdul) > 1:
+        return hdul[1]
+
+    return hdul[0]
+
+def read_header(path):
+    '''
+    the header that goes with the image in a fits file, whatever format it was written in
+    '''
+
+    with fits.open(path) as hdul:
+        return data_hdu(hdul).header.copy()
+
+def read_data(path):
+    '''
+    the image in a fits file, whatever format it was written in
+    '''
+
+    with fits.open(path) as hdul:
+        return np.asarray(data_hdu(hdul).data)
+
+def update_header(path, **cards):
+    '''
+    sets header cards on the image of a fits file in place...compressed images are updated through their binary
+        table, so the data aren't decompressed and quantized again
+    in:
+        path (str) - fits file
+        cards - keyword = value for each card, e.g. THRUPUT = 0.8
+    '''
+
+    with fits.open(path, mode = 'update', disable_image_compression = True) as hdul:
+        hdr = data_hdu(hdul).header
+        for key, value in cards.items():
+            hdr[key] = value
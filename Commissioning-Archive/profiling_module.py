@@ -0,0 +1,320 @@
+'''
+profiling_module.py
+
+Per-stage instrumentation of the reductions and the observing sequences, written out as JSON lines
+
+Code marks its stages with
+
+    with pr.stage('median_collapse', file = f):
+        ...
+
+and when profiling is switched on with start(path), every stage writes one JSON line to path with its wall
+time, CPU time, bytes read and written (read/write calls, from /proc/self/io), bytes memory mapped and number
+of files opened inside it (counted with an audit hook, so astropy's own opens are included), plus any fields
+passed in. Stages nest: each record has its parent stage and its self time (wall time minus that of the stages
+inside it). When profiling is off a stage costs a few microseconds and records nothing
+
+The reductions in throughput_module mark glob, catalog_update, catalog_query, fits_open, median_collapse,
+dark_subtract, normalization, centroid, aperture, header_update and fits_write stages, inside a stage for each
+top level function. sequence_module marks its phases (hwp_move, settle,
+object, goi, dither) with kind = 'phase' and the sequence clock, so a sequence run against the simulator is timed
+in simulated seconds. report() reads the records back and prints the hot spots and the observing efficiency of
+every HWP cycle
+
+Worker processes append their own records to the same file. Forked workers inherit the switch; pools that
+start them with spawn or forkserver (the default on macOS, and on Linux from Python 3.14) pass it on with
+pool_args(), e.g. ProcessPoolExecutor(max_workers = 4, **pr.pool_args())
+
+Typical use:
+    pr.start('profile.jsonl')
+    tm.measure_throughput(directory, wvls, threshold, radius)
+    pr.stop()
+    pr.report('profile.jsonl')
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+
+#######################################################################
+
+# JSON lines file records go to...None when profiling is off
+_path = None
+
+# files opened and bytes memory mapped so far, counted by the audit hook while profiling is on
+_counts = {'file_opens': 0, 'bytes_mapped': 0}
+_hooked = False
+
+# stages currently open in each thread, innermost last
+_local = threading.local()
+
+def _audit(event, args):
+    '''
+    audit hook counting file opens and memory maps...hooks can't be removed, so it does nothing while profiling
+        is off
+    '''
+
+    if _path is None:
+        return
+    if event == 'open':
+        _counts['file_opens'] += 1
+    elif event == 'mmap.__new__':
+        _counts['bytes_mapped'] += max(args[1], 0)
+
+def io_counters():
+    '''
+    bytes read and written by this process so far, from /proc/self/io...None where that isn't available
+    '''
+
+    # reading the counters shouldn't count as a file open either
+    opens = _counts['file_opens']
+    try:
+        with open('/proc/self/io') as fo:
+            counters = dict(line.split(':') for line in fo)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+    finally:
+        _counts['file_opens'] = opens
+
+def start(path):
+    '''
+    switches profiling on
+    in:
+        path (str) - JSON lines file the records are appended to
+    '''
+
+    global _path, _hooked
+
+    if not _hooked:
+        sys.addaudithook(_audit)
+        _hooked = True
+    _path = os.path.abspath(path)
+
+def stop():
+    '''
+    switches profiling off
+    '''
+
+    global _path
+    _path = None
+
+def enabled():
+    '''
+    whether profiling is on
+    '''
+
+    return _path is not None
+
+def _start_worker(path):
+    '''
+    pool initializer...switches profiling on in a worker if it was on in the parent
+    '''
+
+    if path is not None:
+        start(path)
+
+def pool_args():
+    '''
+    initializer keywords for a ProcessPoolExecutor, so its workers profile to the same file as this process
+        however they are started
+    out:
+        kwargs (dict) - 'initializer' and 'initargs'
+    '''
+
+    return {'initializer': _start_worker, 'initargs': (_path,)}
+
+def _write(record):
+    '''
+    appends one record...the file is opened for every record so worker processes can share it
+    '''
+
+    line = json.dumps(record) + '\n'
+    # the open of the profile itself shouldn't count against the stage around it
+    opens = _counts['file_opens']
+    with open(_path, 'a') as fo:
+        fo.write(line)
+    _counts['file_opens'] = opens
+
+@contextlib.contextmanager
+def stage(name, kind = 'stage', clock = None, **fields):
+    '''
+    records a block of code as one stage
+    in:
+        name (str) - stage name, e.g. 'median_collapse' or 'goi'
+        kind (str) - 'stage' for the reductions, 'phase' for the observing sequences
+        clock (function) - clock to also time the stage on (e.g. a ktl_module backend's time), recorded as 'start'
+            and 'elapsed'...None uses the wall clock
+        fields - anything else to put in the record, e.g. file = f or cycle = 2
+    '''
+
+    if _path is None:
+        yield
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1]['name'] if stack else None
+    frame = {'name': name, 'child_wall': 0.}
+    stack.append(frame)
+
+    read0, written0 = io_counters()
+    opens0, mapped0 = _counts['file_opens'], _counts['bytes_mapped']
+    clock0 = clock() if clock is not None else None
+    t0 = time.time()
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        read1, written1 = io_counters()
+        stack.pop()
+        if stack:
+            stack[-1]['child_wall'] += wall
+
+        record = {'kind': kind, 'name': name, 'parent': parent, 'pid': os.getpid(), 'time': t0,
+                  'wall': wall, 'self_wall': wall - frame['child_wall'], 'cpu': cpu,
+                  'bytes_read': None if read0 is None else read1 - read0,
+                  'bytes_written': None if written0 is None else written1 - written0,
+                  'bytes_mapped': _counts['bytes_mapped'] - mapped0,
+                  'file_opens': _counts['file_opens'] - opens0}
+        if clock is not None:
+            record['start'] = clock0
+            record['elapsed'] = clock() - clock0
+        record.update(fields)
+        if _path is not None:
+            _write(record)
+
+def profiled(func):
+    '''
+    decorator that records every call of a function as a stage named after it
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def load_records(path):
+    '''
+    the records of a profile
+    in:
+        path (str) - JSON lines file written while profiling
+    out:
+        records (list of dict) - one per stage, in the order they finished
+    '''
+
+    with open(path) as fo:
+        return [json.loads(line) for line in fo if line.strip()]
+
+def hot_spots(records, kind = 'stage'):
+    '''
+    totals of every stage name, largest self time first
+    in:
+        records (list of dict) - from load_records
+        kind (str) - 'stage' or 'phase'
+    out:
+        totals (list of dict) - 'name', 'calls', 'wall', 'self_wall', 'cpu', 'bytes_read', 'bytes_written',
+            'bytes_mapped' and 'file_opens' summed over every call
+    '''
+
+    keys = ('wall', 'self_wall', 'cpu', 'bytes_read', 'bytes_written', 'bytes_mapped', 'file_opens')
+    totals = {}
+    for record in records:
+        if record['kind'] != kind:
+            continue
+        total = totals.setdefault(record['name'], dict({'name': record['name'], 'calls': 0}, **{k: 0 for k in keys}))
+        total['calls'] += 1
+        for key in keys:
+            total[key] += record[key] or 0
+
+    return sorted(totals.values(), key = lambda total: -total['self_wall'])
+
+def cycle_efficiency(records, science_time):
+    '''
+    observing efficiency of every HWP cycle, from the phase records of sequence_module.run_sequence
+    in:
+        records (list of dict) - from load_records
+        science_time (float) - integration time of one goi (itime * coadds * frames per angle) in the sequence
+            clock's seconds
+    out:
+        cycles (list of dict) - 'position', 'cycle', 'span' (first phase start to last phase end), 'science',
+            'efficiency' (science / span) and the time spent in each phase, in the order the cycles were taken
+    '''
+
+    cycles = []
+    for record in records:
+        if record['kind'] != 'phase' or 'cycle' not in record:
+            continue
+        start = record.get('start', record['time'])
+        elapsed = record.get('elapsed', record['wall'])
+
+        key = (record.get('position'), record['cycle'])
+        if not cycles or (cycles[-1]['position'], cycles[-1]['cycle']) != key:
+            cycles.append({'position': key[0], 'cycle': key[1], 'start': start, 'end': start, 'n_goi': 0,
+                           'phases': {}})
+        cycle = cycles[-1]
+        cycle['end'] = max(cycle['end'], start + elapsed)
+        cycle['phases'][record['name']] = cycle['phases'].get(record['name'], 0.) + elapsed
+        if record['name'] == 'goi':
+            cycle['n_goi'] += 1
+
+    for cycle in cycles:
+        cycle['span'] = cycle['end'] - cycle['start']
+        cycle['science'] = cycle.pop('n_goi') * science_time
+        cycle['efficiency'] = cycle['science'] / cycle['span'] if cycle['span'] > 0 else np.nan
+
+    return cycles
+
+def report(records, science_time = None, top = 10):
+    '''
+    prints the hot spots of a profile and, if it has sequence phases, the efficiency of every HWP cycle
+    in:
+        records (list of dict or str) - from load_records, or the path to a profile
+        science_time (float) - integration time of one goi, for the cycle efficiency...None skips it
+        top (int) - number of stages to list
+    out:
+        summary (dict) - 'stages' and 'phases' from hot_spots, 'cycles' from cycle_efficiency (None without
+            science_time)
+    '''
+
+    if isinstance(records, str):
+        records = load_records(records)
+
+    def mb(value):
+        return value / 1e6
+
+    summary = {'stages': hot_spots(records, 'stage'), 'phases': hot_spots(records, 'phase'), 'cycles': None}
+
+    for kind in ('stages', 'phases'):
+        totals = summary[kind]
+        if not totals:
+            continue
+        all_self = sum(total['self_wall'] for total in totals)
+        print('{:<40} {:>6} {:>10} {:>10} {:>6} {:>9} {:>9} {:>9} {:>6}'.format(
+            kind, 'calls', 'self (s)', 'wall (s)', '%', 'cpu (s)', 'read MB', 'mmap MB', 'opens'))
+        for total in totals[:top]:
+            print('{:<40} {:>6} {:>10.3f} {:>10.3f} {:>6.1f} {:>9.3f} {:>9.1f} {:>9.1f} {:>6}'.format(
+                total['name'], total['calls'], total['self_wall'], total['wall'],
+                100 * total['self_wall'] / all_self if all_self else 0, total['cpu'], mb(total['bytes_read']),
+                mb(total['bytes_mapped']), total['file_opens']))
+        print()
+
+    if science_time is not None:
+        summary['cycles'] = cycle_efficiency(records, science_time)
+        for cycle in summary['cycles']:
+            phases = '  '.join('{} {:.1f}'.format(name, t) for name, t in cycle['phases'].items())
+            print('position {} cycle {}: {:.1f} s, efficiency {:.1%}  ({})'.format(
+                cycle['position'], cycle['cycle'], cycle['span'], cycle['efficiency'], phases))
+
+    return summary
@@ -0,0 +1,291 @@
+'''
+qacits_module.py
+
+QACITS tip-tilt estimates for the vortex coronagraph in polarimetry mode, from both Wollaston channels at once
+
+QACITS (Huby+ 2015, 2017) measures how far the star is off the vortex from the asymmetry of the coronagraphic
+image: the differential intensity between the right and left (top and bottom) halves of a square of half width
+quad_width around the vortex centre, normalized by the flux of the off-axis PSF in the same square, is
+proportional to the tip-tilt. The light inside inner_rad and the light outside it respond with different
+factors (gam_in, which is negative, and gam_out), giving the inner and outer estimators
+
+    tiptilt_in = dI_in / gam_in, tiptilt_out = dI_out / gam_out     (lambda / D, the star's offset in x and y)
+
+estimator_type is one of the types the params file documents, each mapped to one of three ways of picking the
+estimate (ESTIMATORS): 'outer_only' and 'both_outonly' use the outer estimator, 'inner_only' the inner one, and
+'both_revsign' and 'both_simple' the outer one until its tip-tilt drops below tt_limit and the inner one from
+there...the inner region's reversed sign is carried by gam_in < 0, so the two 'both' switches come out the same
+here. The null depth is the flux inside
+null_depth_rad over the off-axis PSF's flux there. The loop applies -gain x tip-tilt, unless the tip-tilt is
+inside the deadband
+
+The parameters are the ones qacits_nirc2_pol_params.pro sets (PARAMS has its K band values, load_params reads
+them from the file), with the vortex centre of the top Wollaston beam. The bottom beam's centre is BEAM_SEPARATION
+rows below it, the separation of the channel boxes in polarimetry_module.CHANNELS, until it is measured
+
+Every region of both channels is a row of one precomputed weight matrix (+1 / -1 on either side of the centre for
+the differential intensities, 1 inside for the totals) over the two cutouts, so estimating a frame, or a whole
+stack of them, is one cutout and one matrix product. The two channels see the same tip-tilt, so they are also
+combined (their differential intensities and PSF fluxes summed) into a third estimate, 'both'
+
+Typical use:
+    plan = make_plan()
+    psf_flux = offaxis_flux(psf_frame, plan, psf_centres)
+    est = estimate(frame, plan, psf_flux)
+    command = est['correction'][0, 2]    ...(dx, dy) in lambda / D from both channels
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import re
+import polarimetry_module as pol
+
+#######################################################################
+
+# QACITS parameters from qacits_nirc2_pol_params.pro for K band in polarimetry mode (not PWS)...centerx and
+#   centery are the vortex centre of the upper Wollaston beam (2025-10-02), plate_scale in mas, telescope_diam in m,
+#   quad_width, inner_rad, null_depth_rad, deadband and tt_limit in lambda / D
+PARAMS = {'centerx': 326., 'centery': 696., 'plate_scale': 9.971, 'telescope_diam': 10.9299,
+          'gam_in': -0.10, 'gam_out': 0.085, 'estimator_type': 'outer_only', 'quad_width': 3.5, 'inner_rad': 2.,
+          'null_depth_rad': 2., 'gain': 0.2, 'deadband': 0.05, 'tt_limit': 0.2}
+
+# the IDL params file, next to this module
+PARAMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qacits_nirc2_pol_params.pro')
+
+# how each estimator_type of the params file picks its estimate...'outer', 'inner', or 'switch' (outer above
+#   tt_limit, inner below)
+ESTIMATORS = {'outer_only': 'outer', 'both_outonly': 'outer', 'inner_only': 'inner', 'both_revsign': 'switch',
+              'both_simple': 'switch'}
+
+# central wavelengths of the NIRC2 filters the vortex is used with, in m
+WAVELENGTHS = {'H': 1.633e-6, 'Kp': 2.124e-6, 'Ks': 2.146e-6, 'K': 2.196e-6, 'Lp': 3.776e-6}
+
+# rows from the top Wollaston beam to the bottom one, from the centres of the channel boxes
+BEAM_SEPARATION = ((pol.CHANNELS['top'][0] + pol.CHANNELS['top'][1]) -
+                   (pol.CHANNELS['bottom'][0] + pol.CHANNELS['bottom'][1])) / 2
+
+# channels of the estimates...the two beams and both combined
+CHANNEL_NAMES = ('top', 'bottom', 'both')
+
+# the regions of a plan's weights: differential intensities (x, y) inside and outside inner_rad, then the totals
+#   of the off-axis PSF normalization square, of inside inner_rad, and of inside null_depth_rad
+TERMS = ('in_x', 'in_y', 'out_x', 'out_y', 'square', 'inner', 'null')
+
+def load_params(path = PARAMS_FILE, band = 'K'):
+    '''
+    the QACITS parameters set in an IDL params file like qacits_nirc2_pol_params.pro...every numeric or string
+        literal assigned outside a band case, or inside the case of this band, with later assignments winning (so
+        the non-PWS branch, which comes last, is the one kept)...derived values (e.g. quad_width_pix) aren't read
+    in:
+        path (str) - the .pro file
+        band (str) - band of the case blocks to read, e.g. 'K'
+    out:
+        params (dict) - PARAMS updated with what the file sets
+    '''
+
+    params = dict(PARAMS)
+    block = None
+    with open(path) as fo:
+        for line in fo:
+            line = line.split(';')[0].strip()
+
+            case = re.match(r"^'(\w+)'\s*:\s*begin$", line)
+            if case:
+                block = case.group(1).upper()
+                continue
+            if re.match(r'^end$', line):
+                block = None
+                continue
+            if block is not None and block != band.upper():
+                continue
+
+            assign = re.match(r"^(\w+)\s*=\s*([-+]?\d*\.?\d+(?:[eEdD][-+]?\d+)?|'[^']*')$", line)
+            if assign and assign.group(1) in params:
+                value = assign.group(2)
+                params[assign.group(1)] = value.strip("'") if value.startswith("'") else \
+                    float(value.replace('d', 'e').replace('D', 'e'))
+
+    return params
+
+def lambda_over_d(wavelength, plate_scale = PARAMS['plate_scale'], telescope_diam = PARAMS['telescope_diam']):
+    '''
+    lambda / D in pixels, as the params file works it out
+    in:
+        wavelength (float or str) - in m, or a filter in WAVELENGTHS
+        plate_scale (float) - mas per pixel
+        telescope_diam (float) - m
+    '''
+
+    if isinstance(wavelength, str):
+        wavelength = WAVELENGTHS[wavelength]
+
+    return wavelength / telescope_diam * 180. / np.pi * 3600. / plate_scale * 1000.
+
+def make_plan(wavelength = 'Kp', params = PARAMS, centres = None):
+    '''
+    the cutouts and region weights of both channels, made once for a setup and reused for every frame
+    in:
+        wavelength (float or str) - in m, or a filter in WAVELENGTHS
+        params (dict) - QACITS parameters, as in PARAMS
+        centres (list) - (y, x) vortex centre of the top and bottom beams in the full frame, None for
+            (centery, centerx) and BEAM_SEPARATION rows below it
+    out:
+        plan (dict) - 'params', 'lambdaoverd' (pixels), 'centres', 'boxes' ((y0, y1, x0, x1) cutout of each
+            channel) and 'weights' ((2, len(TERMS), n_pixels) over the flattened cutouts)
+    '''
+
+    lod = lambda_over_d(wavelength, params['plate_scale'], params['telescope_diam'])
+    if centres is None:
+        centres = [(params['centery'], params['centerx']), (params['centery'] - BEAM_SEPARATION, params['centerx'])]
+    centres = np.asarray(centres, dtype = float)
+
+    half = params['quad_width'] * lod
+    size = int(np.ceil(half)) + 1
+
+    boxes = []
+    weights = []
+    for cy, cx in centres:
+        y0, x0 = int(np.round(cy)) - size, int(np.round(cx)) - size
+        boxes.append((y0, y0 + 2 * size + 1, x0, x0 + 2 * size + 1))
+
+        # pixel centres relative to the vortex...pixels right on an axis count for neither side
+        dy, dx = np.indices((2 * size + 1,) * 2, dtype = float)
+        dy, dx = dy + y0 - cy, dx + x0 - cx
+        r = np.hypot(dx, dy)
+        square = (np.abs(dx) <= half) & (np.abs(dy) <= half)
+        inner = r < params['inner_rad'] * lod
+        outer = square & ~inner
+
+        terms = [inner * np.sign(dx), inner * np.sign(dy), outer * np.sign(dx), outer * np.sign(dy),
+                 square, inner, r < params['null_depth_rad'] * lod]
+        weights.append(np.stack([term.ravel() for term in terms]).astype(float))
+
+    return {'params': dict(params), 'lambdaoverd': lod, 'centres': centres, 'boxes': boxes,
+            'weights': np.stack(weights)}
+
+def _cutouts(frames, boxes):
+    '''
+    (n_frames, 2, n_pixels) cutouts of both channels of every frame
+    '''
+
+    return np.stack([frames[:, y0:y1, x0:x1].reshape(len(frames), -1) for y0, y1, x0, x1 in boxes], axis = 1)
+
+def region_sums(frames, plan, background = None):
+    '''
+    the sums of every region of both channels
+    in:
+        frames (np array) - (n_frames, ny, nx) or (ny, nx) coronagraphic frames
+        plan (dict) - from make_plan
+        background (np array) - (ny, nx) sky / dark to subtract first, None for none
+    out:
+        sums (np array) - (n_frames, 2, len(TERMS))
+    '''
+
+    frames = np.asarray(frames)
+    if frames.ndim == 2:
+        frames = frames[None]
+
+    cutouts = _cutouts(frames, plan['boxes']).astype(float)
+    if background is not None:
+        cutouts = cutouts - _cutouts(np.asarray(background)[None], plan['boxes'])
+
+    return np.einsum('ncp,ctp->nct', cutouts, plan['weights'])
+
+def offaxis_flux(psf_frame, plan, centres, background = None):
+    '''
+    flux of the off-axis PSF in the normalization square and inside null_depth_rad, for each channel...the same
+        regions as the estimates, moved onto the PSF
+    in:
+        psf_frame (np array) - (ny, nx) frame with the star off the vortex (the dpix offset of the params file)
+        plan (dict) - from make_plan
+        centres (list) - (y, x) centre of the off-axis PSF in each beam
+        background (np array) - (ny, nx) sky / dark to subtract first, None for none
+    out:
+        flux (dict) - 'square' and 'null', each (2,) one per channel
+    '''
+
+    shift = np.round(np.asarray(centres, dtype = float) - plan['centres']).astype(int)
+    moved = dict(plan, boxes = [(y0 + dy, y1 + dy, x0 + dx, x1 + dx)
+                                for (y0, y1, x0, x1), (dy, dx) in zip(plan['boxes'], shift)])
+    sums = region_sums(psf_frame, moved, background)[0]
+
+    return {'square': sums[:, TERMS.index('square')], 'null': sums[:, TERMS.index('null')]}
+
+def estimate(frames, plan, psf_flux, background = None):
+    '''
+    QACITS tip-tilt estimates of a frame or a stack of frames, for each channel and for both combined
+    in:
+        frames (np array) - (n_frames, ny, nx) or (ny, nx) coronagraphic frames
+        plan (dict) - from make_plan
+        psf_flux (dict) - from offaxis_flux, scaled to the integration of the frames
+        background (np array) - (ny, nx) sky / dark to subtract first, None for none
+    out:
+        est (dict) - with the channels along axis 1 in the order of CHANNEL_NAMES and (x, y) along the last axis:
+            'dI_in', 'dI_out' (n_frames, 3, 2) normalized differential intensities, 'tiptilt_in' and 'tiptilt_out'
+            (n_frames, 3, 2) their tip-tilts in lambda / D, 'tiptilt' (n_frames, 3, 2) from the estimator type,
+            'tiptilt_pix' the same in pixels, 'null_depth' (n_frames, 3), and 'correction' (n_frames, 3, 2) the
+            loop command in lambda / D
+    '''
+
+    params = plan['params']
+    if params['estimator_type'] not in ESTIMATORS:
+        print('Unknown estimator type ' + str(params['estimator_type']) + ', use one of ' + ', '.join(ESTIMATORS))
+        return False
+
+    sums = region_sums(frames, plan, background)
+    # the combined channel is the sum of both
+    sums = np.concatenate([sums, sums.sum(axis = 1, keepdims = True)], axis = 1)
+    square = np.append(psf_flux['square'], np.sum(psf_flux['square']))
+    null = np.append(psf_flux['null'], np.sum(psf_flux['null']))
+
+    d_in = sums[:, :, 0:2] / square[None, :, None]
+    d_out = sums[:, :, 2:4] / square[None, :, None]
+    tt_in = d_in / params['gam_in']
+    tt_out = d_out / params['gam_out']
+
+    method = ESTIMATORS[params['estimator_type']]
+    if method == 'outer':
+        tiptilt = tt_out
+    elif method == 'inner':
+        tiptilt = tt_in
+    else:
+        small = np.hypot(tt_out[..., 0], tt_out[..., 1]) < params['tt_limit']
+        tiptilt = np.where(small[..., None], tt_in, tt_out)
+
+    return {'dI_in': d_in, 'dI_out': d_out, 'tiptilt_in': tt_in, 'tiptilt_out': tt_out, 'tiptilt': tiptilt,
+            'tiptilt_pix': tiptilt * plan['lambdaoverd'], 'null_depth': sums[:, :, TERMS.index('null')] / null,
+            'correction': correction(tiptilt, params['gain'], params['deadband'])}
+
+def correction(tiptilt, gain = PARAMS['gain'], deadband = PARAMS['deadband']):
+    '''
+    proportional loop command for tip-tilt estimates...nothing inside the deadband
+    in:
+        tiptilt (np array) - (..., 2) estimates in lambda / D
+        gain (float) - loop gain
+        deadband (float) - lambda / D
+    out:
+        command (np array) - (..., 2) tip-tilt to apply in lambda / D
+    '''
+
+    tiptilt = np.asarray(tiptilt, dtype = float)
+    outside = np.hypot(tiptilt[..., 0], tiptilt[..., 1]) >= deadband
+
+    return np.where(outside[..., None], -gain * tiptilt, 0.)
+
+def calibrate_gamma(d_i, tiptilt):
+    '''
+    proportionality factor of an estimator from frames with known tip-tilt (e.g. a scan with the modulator)...the
+        least-squares slope through the origin
+    in:
+        d_i (np array) - (n, 2) normalized differential intensities, e.g. est['dI_out'][:, 2]
+        tiptilt (np array) - (n, 2) tip-tilts of the frames in lambda / D
+    out:
+        gam (float)
+    '''
+
+    d_i = np.ravel(d_i)
+    tiptilt = np.ravel(tiptilt)
+
+    return float(np.sum(d_i * tiptilt) / np.sum(tiptilt**2))
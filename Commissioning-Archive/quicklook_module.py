@@ -0,0 +1,305 @@
+'''
+quicklook_module.py
+
+Quicklook of HWP modulation while Fast_Axis_Cal_Sequence.sh or HWP_Rotation_Sequence.sh is running
+
+watch() polls the NIRC2 output directory for new nNNNN.fits files and pushes each one through update() as soon
+as goi has finished writing it: the frame is dark subtracted and flat fielded with cached masters, the top and
+bottom Wollaston channels are summed, and the normalized difference (top - bottom) / (top + bottom) is added to a
+running curve vs HWP angle and to a running harmonic fit (harmonic_module). The fit keeps only the normal
+equations A^T A, A^T y and y^T y, so every update costs the same however long the sequence is, and nothing that
+was already processed is read again
+
+Offline, replay() runs a directory of frames that was already taken through the same update() in file order
+
+Typical use, at the summit:
+    watch('/net/kol/s/nirc2data/...', library_dir = '.../calibration_library')
+...or after the fact:
+    state = replay(directory, dark = dark, flat = flat)
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import os
+import re
+import time
+import warnings
+from astropy.io import fits
+import calibration_module as cal
+import catalog_module as cm
+import harmonic_module as hm
+import photometry_module as pm
+import polarimetry_module as pol
+
+#######################################################################
+
+# file names written by NIRC2
+FRAME_NAME = re.compile(r'^n\d{4}\.fits$')
+
+def new_state(harmonics = (2, 4), channels = pol.CHANNELS):
+    '''
+    empty quicklook state, to be filled in by update()
+    in:
+        harmonics (tuple) - harmonics of the HWP angle in the running fit
+        channels (dict) - 'top' and 'bottom' channel boxes (y0, y1, x0, x1)
+    out:
+        state (dict) - running sums and results...'base' is the sequence being followed, 'frames' a list of
+            (file, hwp, top, bottom, norm_diff), 'curve' the mean normalized difference at each HWP angle, and
+            'fit' the latest harmonic fit (None until there are enough angles)
+    '''
+
+    n_params = 1 + 2 * len(harmonics)
+
+    return {
+        'harmonics': tuple(harmonics),
+        'boxes': np.array([channels['top'], channels['bottom']]),
+        'base': None,
+        'frames': [],
+        'curve': {},
+        'ata': np.zeros((n_params, n_params)),
+        'aty': np.zeros(n_params),
+        'yty': 0.,
+        'n': 0,
+        'fit': None,
+        'masters': {},
+        'seen': set(),
+    }
+
+def _reset_sequence(state, base):
+    '''
+    starts a new running curve and fit when the sequence changes
+    '''
+
+    state['base'] = base
+    state['frames'] = []
+    state['curve'] = {}
+    state['ata'][:] = 0
+    state['aty'][:] = 0
+    state['yty'] = 0.
+    state['n'] = 0
+    state['fit'] = None
+
+def _is_complete(path):
+    '''
+    whether goi has finished writing a file...the size on disk has to cover the header plus the padded data
+        the header promises
+    '''
+
+    try:
+        size = os.path.getsize(path)
+        # astropy warns about the truncation this is checking for
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            hdr = fits.getheader(path)
+    except (OSError, IndexError, ValueError):
+        return False
+
+    n_pixels = int(np.prod([hdr['NAXIS' + str(i)] for i in range(1, hdr['NAXIS'] + 1)])) if hdr['NAXIS'] else 0
+    n_data = n_pixels * abs(hdr['BITPIX']) // 8
+    n_header = len(hdr.tostring())
+
+    return size >= n_header + -(-n_data // 2880) * 2880
+
+def _masters(state, hdr, dark, flat, library_dir):
+    '''
+    dark and flat for a frame...explicit ones win, otherwise they are looked up in the calibration library once per
+        instrument configuration and kept in the state
+    '''
+
+    if library_dir is None:
+        return dark, flat
+
+    key = tuple(cal.calibration_key(hdr).values())
+    if key not in state['masters']:
+        paths = [cal.find_master(library_dir, kind, hdr) for kind in ('dark', 'flat')]
+        state['masters'][key] = [None if path is None else cal.load_master(path) for path in paths]
+    lib_dark, lib_flat = state['masters'][key]
+
+    return (lib_dark if dark is None else dark), (lib_flat if flat is None else flat)
+
+def update(state, path, dark = None, flat = None, library_dir = None):
+    '''
+    adds one frame to the quicklook...constant time, whatever number of frames came before
+    in:
+        state (dict) - from new_state()
+        path (str) - the new frame
+        dark (np array) - dark to subtract, None to look one up in library_dir (or for no dark)
+        flat (np array) - normalized flat to divide by, None to look one up in library_dir (or for no flat)
+        library_dir (str) - calibration library (calibration_module) to find masters in by configuration
+    out:
+        result (dict) - 'file', 'base', 'hwp', 'top', 'bottom', 'norm_diff' of the frame and the running 'fit'...
+            None if the frame has no HWP angle (e.g. a dark or an acquisition image)
+    '''
+
+    with fits.open(path) as hdul:
+        hdr = hdul[0].header
+        frame = np.asarray(hdul[0].data, dtype = float)
+    state['seen'].add(os.path.basename(path))
+
+    # the HWP angle from the sequence label, or from the header if the frame wasn't labelled
+    label = pol.parse_label(hdr.get('OBJECT', ''))
+    if label is not None:
+        base, hwp = label[0], label[1]
+    else:
+        base, hwp = None, cm.header_row('', hdr)['hwp']
+    if hwp is None:
+        return None
+
+    if base != state['base']:
+        _reset_sequence(state, base)
+
+    if frame.ndim == 3:
+        frame = frame.mean(axis = 0)
+    dark, flat = _masters(state, hdr, dark, flat, library_dir)
+    if dark is not None:
+        frame = frame - dark
+    if flat is not None:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frame = np.where(flat != 0, frame / flat, np.nan)
+
+    top, bottom = pm.box_sums(frame[None], state['boxes'])[0]
+    norm_diff = (top - bottom) / (top + bottom)
+
+    state['frames'].append((path, hwp, top, bottom, norm_diff))
+    total, n = state['curve'].get(hwp, (0., 0))
+    state['curve'][hwp] = (total + norm_diff, n + 1)
+
+    # rank one update of the normal equations
+    row = hm.harmonic_design([hwp], state['harmonics'])[0]
+    state['ata'] += np.outer(row, row)
+    state['aty'] += row * norm_diff
+    state['yty'] += norm_diff**2
+    state['n'] += 1
+
+    # the fit needs enough distinct angles (mod 360/k) to pin down every parameter
+    n_params = len(row)
+    if np.linalg.matrix_rank(state['ata']) == n_params:
+        unscaled_cov = np.linalg.inv(state['ata'])
+        coefs = unscaled_cov @ state['aty']
+        rss = max(state['yty'] - coefs @ state['aty'], 0.)
+        sigma2 = np.array([rss / max(state['n'] - n_params, 1)])
+        terms = hm.harmonic_terms(coefs[:, None], unscaled_cov, sigma2, state['harmonics'])
+        state['fit'] = {
+            'coefs': coefs,
+            'amplitude': terms[0][:, 0],
+            'amplitude_err': terms[1][:, 0],
+            'peak_angle': terms[2][:, 0],
+            'peak_angle_err': terms[3][:, 0],
+            'residual_rms': np.sqrt(rss / state['n']),
+        }
+
+    return {'file': path, 'base': base, 'hwp': hwp, 'top': top, 'bottom': bottom, 'norm_diff': norm_diff,
+            'fit': state['fit']}
+
+def curve(state):
+    '''
+    the running modulation curve
+    in:
+        state (dict) - from new_state()
+    out:
+        angles (np array) - HWP angles seen so far, sorted
+        norm_diff (np array) - mean normalized difference at each angle
+    '''
+
+    angles = np.array(sorted(state['curve']))
+    return angles, np.array([state['curve'][a][0] / state['curve'][a][1] for a in angles])
+
+def report(state, result):
+    '''
+    default callback...one line per frame with the running fit of the 4 theta harmonic (or the highest one fit)
+    '''
+
+    line = '{} {} hwp {:6.2f} norm diff {:+.4f}'.format(os.path.basename(result['file']), result['base'],
+                                                        result['hwp'], result['norm_diff'])
+    fit = result['fit']
+    if fit is not None:
+        i = state['harmonics'].index(4) if 4 in state['harmonics'] else -1
+        line += '  peak {:6.2f} +/- {:.2f} deg  amplitude {:.4f} +/- {:.4f}'.format(
+            fit['peak_angle'][i], fit['peak_angle_err'][i], fit['amplitude'][i], fit['amplitude_err'][i])
+    print(line)
+
+def _new_frames(state, directory):
+    '''
+    frames in the directory that haven't been processed yet, oldest first
+    '''
+
+    names = [entry.name for entry in os.scandir(directory)
+             if FRAME_NAME.match(entry.name) and entry.name not in state['seen']]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+def watch(directory, dark = None, flat = None, library_dir = None, callback = report, state = None,
+          poll_interval = 0.2, timeout = None, max_frames = None, skip_existing = True):
+    '''
+    follows a directory as frames are written into it, updating the quicklook with each new frame
+    in:
+        directory (str) - NIRC2 output directory
+        dark, flat (np array) - masters to use, see update()
+        library_dir (str) - calibration library to find masters in, see update()
+        callback (function) - called as callback(state, result) after every frame with an HWP angle
+        state (dict) - from new_state(), to carry on from an earlier watch...None starts a new one
+        poll_interval (float) - seconds between looks at the directory
+        timeout (float) - stop after this many seconds without a new frame...None runs until interrupted
+        max_frames (int) - stop after this many frames...None for no limit
+        skip_existing (bool) - ignore the frames that are already there when the watch starts
+    out:
+        state (dict) - the quicklook state
+    '''
+
+    if state is None:
+        state = new_state()
+    if skip_existing:
+        state['seen'].update(os.path.basename(f) for f in _new_frames(state, directory))
+
+    n_frames = 0
+    last_frame = time.time()
+    try:
+        while True:
+            for f in _new_frames(state, directory):
+                # goi may still be writing it...it is picked up again on the next poll
+                if not _is_complete(f):
+                    break
+
+                result = update(state, f, dark, flat, library_dir)
+                if result is not None:
+                    result['latency'] = time.time() - os.path.getmtime(f)
+                    if callback is not None:
+                        callback(state, result)
+
+                n_frames += 1
+                last_frame = time.time()
+                if max_frames is not None and n_frames >= max_frames:
+                    return state
+
+            if timeout is not None and time.time() - last_frame > timeout:
+                return state
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+    return state
+
+def replay(directory, dark = None, flat = None, library_dir = None, callback = report, pattern = 'n*.fits',
+           interval = 0):
+    '''
+    runs frames that were already taken through the quicklook in file order, as watch() would have seen them
+    in:
+        directory (str) - folder with the frames
+        dark, flat (np array) - masters to use, see update()
+        library_dir (str) - calibration library to find masters in, see update()
+        callback (function) - called as callback(state, result) after every frame with an HWP angle
+        pattern (str) - glob pattern for the file names
+        interval (float) - seconds to wait between frames, to mimic the cadence of a sequence
+    out:
+        state (dict) - the quicklook state after the last frame
+    '''
+
+    state = new_state()
+    for row in cm.query_catalog(directory, pattern):
+        result = update(state, row['path'], dark, flat, library_dir)
+        if result is not None and callback is not None:
+            callback(state, result)
+        if interval:
+            time.sleep(interval)
+
+    return state
@@ -0,0 +1,296 @@
+'''
+registration_module.py
+
+ABBA pair sky subtraction and sub-pixel registration of the dithered HWP sequences
+
+With XY set, HWP_Rotation_Sequence.sh takes its HWP cycles at two positions in an A B B A pattern (cycles at A,
+twice as many at B, the same number at A again, see sequence_module.hwp_plan). The frames don't say which
+position they were taken at, so the positions come from that order: the complete cycles of each run of a base
+object (from polarimetry_module.group_hwp_cycles) are split into the four blocks. The k-th A cycle is paired with
+the k-th B cycle, and at every HWP angle each frame of a pair is the sky of the other:
+
+    A - B (source at A, registered with the A offset), B - A (source at B, registered with the B offset)
+
+The offsets are measured on the sky subtracted frames, so static structure (bad pixels, flat residuals, ghosts,
+thermal gradients) cancels instead of pulling every offset to zero. A - B is split into its positive part (the
+source at A) and the positive part of B - A (the source at B), and both are cross-correlated with the positive
+part of A - B of the first pair and angle, with sub-pixel refinement by a locally upsampled DFT of the cross power
+around the correlation peak (Guizar-Sicairos+ 2008). The two parts add back up to A - B, so their spectra are
+also what is shifted onto the reference with a phase ramp and averaged at every HWP angle.
+Everything is done in the Fourier domain on whole stacks at once: every frame of a chunk of pairs is transformed
+in one batched FFT, the offsets of the chunk come out of one batched inverse FFT and a few batched matrix
+products, and the shift-and-average is a sum of phase-ramped spectra, so each frame is transformed exactly once
+and each HWP angle transformed back once at the end. The frequency grids of the FFTs and of the upsampled DFT
+are planned once per frame shape and cached, and the reference spectrum once per run
+
+The averaged frames keep a negative image of the source half as bright on either side of it, one dither away
+
+Typical use:
+    runs = reduce_dither(pol.group_hwp_cycles(directory), dark = dark, flat = flat)
+    stokes = pol.double_difference(pol.split_channels(runs[0]['frames'])[None])
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import scipy.fft
+import polarimetry_module as pol
+import profiling_module as pr
+
+#######################################################################
+
+# default upsampling of the cross power for the sub-pixel offsets...offsets come out to 1 / UPSAMPLE pixels
+UPSAMPLE = 20
+
+# pairs of cycles transformed together...a pair is 2 frames per HWP angle, and with its spectra and their
+#   temporaries a full 1024x1024 frame takes ~40 MB at the peak
+CHUNK_PAIRS = 4
+
+# FFT plans by (frame shape, upsample)...see fft_plan
+_plans = {}
+
+def fft_plan(shape, upsample = UPSAMPLE):
+    '''
+    the frequency grids for one frame shape and upsampling, made once and cached
+    in:
+        shape (tuple) - (ny, nx) of a frame
+        upsample (int) - upsampling of the cross power for the sub-pixel offsets
+    out:
+        plan (dict) - 'shape', 'upsample', 'freqs' (ky, kx in cycles per pixel), 'region' (size of the upsampled
+            region around each peak, in upsampled pixels), 'centre' (the peak's place in that region) and
+            'ups_freqs' (ky, kx in cycles per upsampled pixel)
+    '''
+
+    key = (tuple(shape), int(upsample))
+    if key not in _plans:
+        ny, nx = shape
+        region = int(np.ceil(upsample * 1.5))
+        _plans[key] = {'shape': key[0], 'upsample': key[1],
+                       'freqs': (scipy.fft.fftfreq(ny), scipy.fft.fftfreq(nx)),
+                       'region': region, 'centre': np.fix(region / 2.),
+                       'ups_freqs': (scipy.fft.fftfreq(ny, upsample), scipy.fft.fftfreq(nx, upsample))}
+
+    return _plans[key]
+
+def spectra(stack, workers = 1):
+    '''
+    2d FFTs of a stack of frames in one call, with the mean of every frame (the zero frequency) taken out so the
+        sky level doesn't pull the correlation peak to zero offset
+    in:
+        stack (np array) - (n_frames, ny, nx) frames
+        workers (int) - threads for the FFT
+    out:
+        spec (np array) - (n_frames, ny, nx) complex64
+    '''
+
+    spec = scipy.fft.fft2(np.asarray(stack, dtype = np.float32), workers = workers)
+    spec[..., 0, 0] = 0
+
+    return spec
+
+def _upsampled_dft(data, plan, offsets):
+    '''
+    the inverse DFT of every spectrum of a stack on a small upsampled grid around its own point...the same as
+        upsampling the whole inverse FFT and cutting a region out, for a fraction of the work
+    in:
+        data (np array) - (n, ny, nx) spectra
+        plan (dict) - from fft_plan
+        offsets (np array) - (n, 2) where each region starts, in upsampled pixels
+    out:
+        region (np array) - (n, region, region)
+    '''
+
+    ky, kx = plan['ups_freqs']
+    grid = np.arange(plan['region'])
+
+    # (n, region, ny) and (n, nx, region) exponents...both axes of every frame as two batched matrix products
+    kernel_y = np.exp(-2j * np.pi * (grid[None, :, None] - offsets[:, 0, None, None]) * ky[None, None, :])
+    kernel_x = np.exp(-2j * np.pi * (grid[None, None, :] - offsets[:, 1, None, None]) * kx[None, :, None])
+
+    return kernel_y.astype(np.complex64) @ data @ kernel_x.astype(np.complex64)
+
+def measure_offsets(spec, ref_spec, plan, workers = 1):
+    '''
+    sub-pixel offsets of a stack of frames from a reference, by cross-correlation
+    in:
+        spec (np array) - (n_frames, ny, nx) spectra of the frames, from spectra()
+        ref_spec (np array) - (ny, nx) spectrum of the reference frame
+        plan (dict) - from fft_plan
+        workers (int) - threads for the inverse FFT
+    out:
+        offsets (np array) - (n_frames, 2) (dy, dx) in pixels that shift each frame onto the reference
+        peaks (np array) - (n_frames,) height of each correlation peak
+    '''
+
+    shape = np.array(plan['shape'])
+    upsample = plan['upsample']
+    cross = ref_spec[None] * spec.conj()
+
+    # whole pixel peaks of every frame's correlation from one batched inverse FFT
+    corr = scipy.fft.ifft2(cross, workers = workers).real
+    peak = np.argmax(corr.reshape(len(corr), -1), axis = 1)
+    offsets = np.stack(np.unravel_index(peak, plan['shape']), axis = 1).astype(float)
+    offsets = np.where(offsets > shape // 2, offsets - shape, offsets)
+
+    # then refined on an upsampled grid 1.5 pixels across around each peak
+    offsets = np.round(offsets * upsample) / upsample
+    region = _upsampled_dft(cross.conj(), plan, plan['centre'] - offsets * upsample).conj().real
+    n, size = region.shape[0], region.shape[1]
+    best = np.argmax(region.reshape(n, -1), axis = 1)
+    offsets = offsets + (np.stack(np.unravel_index(best, (size, size)), axis = 1) - plan['centre']) / upsample
+
+    return offsets, region.reshape(n, -1)[np.arange(n), best] / np.prod(shape)
+
+def shift_spectra(spec, offsets, plan):
+    '''
+    shifts the frames of a stack by sub-pixel offsets in the Fourier domain
+    in:
+        spec (np array) - (n_frames, ny, nx) spectra
+        offsets (np array) - (n_frames, 2) (dy, dx) in pixels
+        plan (dict) - from fft_plan
+    out:
+        shifted (np array) - (n_frames, ny, nx) spectra of the shifted frames
+    '''
+
+    ky, kx = plan['freqs']
+    # the phase ramp of every frame is separable, so it is the product of a ramp in y and one in x
+    ramp_y = np.exp(-2j * np.pi * offsets[:, 0, None] * ky[None, :]).astype(np.complex64)
+    ramp_x = np.exp(-2j * np.pi * offsets[:, 1, None] * kx[None, :]).astype(np.complex64)
+
+    return spec * ramp_y[:, :, None] * ramp_x[:, None, :]
+
+def abba_runs(cycles, cycles_per_position = None):
+    '''
+    splits the complete HWP cycles of a night into ABBA dither runs and pairs their A and B cycles
+    in:
+        cycles (list of dict) - cycles from polarimetry_module.group_hwp_cycles
+        cycles_per_position (int) - cycles in each A block (CYCLES in the sequence), None to take a quarter of
+            each run of the same base object...set it when one target was observed with several ABBA runs in a
+            row
+    out:
+        runs (list of dict) - {'base', 'pairs': [(A cycle, B cycle)]} for every complete ABBA run...runs whose
+            cycles don't split into A B B A blocks are printed and skipped
+    '''
+
+    # consecutive cycles of the same base object
+    groups = []
+    for cycle in cycles:
+        if groups and groups[-1][0]['base'] == cycle['base']:
+            groups[-1].append(cycle)
+        else:
+            groups.append([cycle])
+
+    runs = []
+    for group in groups:
+        n = cycles_per_position if cycles_per_position is not None else len(group) // 4
+        if n == 0 or len(group) % (4 * n) != 0:
+            print('Skipping ' + group[0]['base'] + ': ' + str(len(group)) + ' cycles do not make whole ABBA runs')
+            continue
+
+        for start in range(0, len(group), 4 * n):
+            run = group[start:start + 4 * n]
+            a_cycles = run[:n] + run[3 * n:]
+            b_cycles = run[n:3 * n]
+            runs.append({'base': run[0]['base'], 'pairs': list(zip(a_cycles, b_cycles))})
+
+    return runs
+
+def register_pairs(pairs, angles = pol.HWP_ANGLES, dark = None, flat = None, upsample = UPSAMPLE,
+                   chunk_pairs = CHUNK_PAIRS, workers = 1):
+    '''
+    sky subtracts, registers and averages the A/B cycle pairs of one ABBA run
+    in:
+        pairs (list) - (A cycle, B cycle) pairs from abba_runs
+        angles (tuple) - HWP angles, in the order the frames are returned
+        dark (np array) - dark to subtract from every frame, None for no dark
+        flat (np array) - normalized flat to divide every frame by, None for no flat
+        upsample (int) - offsets are measured to 1 / upsample pixels
+        chunk_pairs (int) - pairs read and transformed at a time
+        workers (int) - threads for the FFTs
+    out:
+        frames (np array) - (n_angles, ny, nx) registered, sky subtracted frames averaged at each HWP angle
+        offsets (dict) - 'A' and 'B', each (n_pairs, n_angles, 2) (dy, dx) offsets onto the first A frame...
+            these come from the sky subtracted frames, so the B offsets pick up a small bias along the dither
+            when the A and B images overlap (a dither of less than a few PSF widths, halo included)
+    '''
+
+    n_angles = len(angles)
+    total = None
+    offsets = {'A': [], 'B': []}
+
+    for start in range(0, len(pairs), chunk_pairs):
+        chunk = pairs[start:start + chunk_pairs]
+        n = len(chunk)
+
+        # every A frame of the chunk, then every B frame, pair by pair and angle by angle
+        with pr.stage('registration_read', frames = 2 * n * n_angles):
+            stack = np.stack([pol._read_frame(pair[side]['files'][angle], dark, flat)
+                              for side in (0, 1) for pair in chunk for angle in angles])
+
+        # A - B with its sky level taken out, split into the source at A (A - B > 0) and the source at B
+        #   (B - A > 0)...anything static cancels in the difference, and the two parts add back up to it
+        with pr.stage('registration_difference', frames = len(stack)):
+            diff = stack[:n * n_angles] - stack[n * n_angles:]
+            diff -= diff.mean(axis = (1, 2), keepdims = True)
+            np.maximum(diff, 0, out = stack[:n * n_angles])
+            np.maximum(-diff, 0, out = stack[n * n_angles:])
+            del diff
+
+        with pr.stage('registration_fft', frames = len(stack)):
+            spec = spectra(stack, workers)
+            if total is None:
+                plan = fft_plan(stack.shape[1:], upsample)
+                ref_spec = spec[0].copy()
+                total = np.zeros((n_angles,) + stack.shape[1:], dtype = np.complex128)
+            del stack
+
+        with pr.stage('registration_offsets', frames = len(spec)):
+            chunk_offsets = measure_offsets(spec, ref_spec, plan, workers)[0]
+
+        with pr.stage('registration_combine', frames = len(spec)):
+            spec_a, spec_b = spec[:n * n_angles], spec[n * n_angles:]
+            off_a, off_b = chunk_offsets[:n * n_angles], chunk_offsets[n * n_angles:]
+            # A - B registered at A and B - A registered at B, summed at each angle...the spectra of the two parts
+            #   add back up to the spectrum of A - B
+            diff = spec_a - spec_b
+            shifted = shift_spectra(diff, off_a, plan) - shift_spectra(diff, off_b, plan)
+            total += shifted.reshape((n, n_angles) + shifted.shape[1:]).sum(axis = 0)
+
+        offsets['A'].append(off_a.reshape(n, n_angles, 2))
+        offsets['B'].append(off_b.reshape(n, n_angles, 2))
+
+    with pr.stage('registration_inverse_fft', frames = n_angles):
+        frames = scipy.fft.ifft2(total / (2 * len(pairs)), workers = workers).real
+
+    return frames, {side: np.concatenate(offsets[side]) for side in offsets}
+
+def reduce_dither(cycles, cycles_per_position = None, angles = pol.HWP_ANGLES, dark = None, flat = None,
+                  upsample = UPSAMPLE, chunk_pairs = CHUNK_PAIRS, workers = 1):
+    '''
+    pair sky subtraction and registration of every ABBA run of a night
+    in:
+        cycles (list of dict) - cycles from polarimetry_module.group_hwp_cycles
+        cycles_per_position (int) - cycles in each A block, None to work it out (see abba_runs)
+        angles (tuple) - HWP angles, in the order the frames are returned...pol.HWP_ANGLES is the order
+            polarimetry_module.double_difference expects
+        dark (np array) - dark to subtract from every frame, None for no dark
+        flat (np array) - normalized flat to divide every frame by, None for no flat
+        upsample (int) - offsets are measured to 1 / upsample pixels
+        chunk_pairs (int) - pairs read and transformed at a time
+        workers (int) - threads for the FFTs
+    out:
+        runs (list of dict) - one per ABBA run with 'base', 'n_pairs', 'frames' (n_angles, ny, nx) float32,
+            'offsets' ('A' and 'B', each (n_pairs, n_angles, 2)) and 'dither' (median B offset minus median A
+            offset)
+    '''
+
+    results = []
+    for run in abba_runs(cycles, cycles_per_position):
+        with pr.stage('register_dither', base = run['base'], pairs = len(run['pairs'])):
+            frames, offsets = register_pairs(run['pairs'], angles, dark, flat, upsample, chunk_pairs, workers)
+
+        dither = np.median(offsets['B'].reshape(-1, 2), axis = 0) - np.median(offsets['A'].reshape(-1, 2), axis = 0)
+        results.append({'base': run['base'], 'n_pairs': len(run['pairs']), 'frames': frames.astype(np.float32),
+                        'offsets': offsets, 'dither': dither})
+
+    return results
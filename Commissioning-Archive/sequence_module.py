@@ -0,0 +1,416 @@
+'''
+sequence_module.py
+
+HWP cycles and ABBA dithers as in HWP_Rotation_Sequence.sh, with the next HWP move overlapped with the file write
+
+HWP_Rotation_Sequence.sh moves the HWP, polls PCUPR until it is in tolerance and only then calls goi, so every
+move is dead time. Here goi runs in a thread while the sequencer is subscribed to alad expstate: once the last
+frame of the goi reaches Filewait (the detector is done, the file is being written) the HWP is sent to the angle
+of the next step, so by the time goi returns the move is mostly over. The HWP is never commanded while the detector is
+integrating or reading out...if Filewait is missed (goi returns first, or the watch times out) the move just
+happens after goi, as in the bash script
+
+grid_plan lays out the IMR x HWP grid of Internal_Pol_Cal_Sequence.sh. The bash script sends the HWP from its
+last angle back to the first at every IMR step; the planner instead turns the HWP sweep around (serpentine) and
+picks the outer axis and direction with the least predicted slew, from a speed / acceleration / settle model of
+each axis (MOVE_MODELS). predict_duration gives the expected length of any plan, and run_sequence runs grid
+plans directly, moving the IMR and HWP together
+
+The sequencer only talks to a ktl_module backend, so the same plan runs on the telescope (shell_backend) or
+against the simulator (sim_backend), where simulate() measures the per-cycle overhead with and without
+pipelining
+
+Typical use:
+    plan = hwp_plan('hd183143', cycles = 2, dither = (3, 0))
+    log = run_sequence(km.shell_backend(), plan)
+...or for the calibration grid:
+    plan = grid_plan('pol_cal')
+    print(predict_duration(plan, exposure = 10.))
+    log = run_sequence(km.shell_backend(), plan)
+'''
+
+############################## Imports ################################
+
+import numpy as np
+import threading
+import ktl_module as km
+import profiling_module as pr
+
+#######################################################################
+
+# the four critical HWP angles in the order HWP_Rotation_Sequence.sh takes them
+ANGLES = (0., 45., 22.5, 67.5)
+
+# the IMR x HWP grid of Internal_Pol_Cal_Sequence.sh
+IMR_ANGLES = (0., 15., 30., 45., 60., 75., 90., 105., 120., 135., 150.)
+GRID_HWP_ANGLES = (0., 10., 20., 30., 40., 50., 60., 70., 80., 90., 100., 110., 120.)
+
+# move-time model of each axis...speeds and accelerations in deg/s and deg/s^2, settle in s (time to creep into
+#   tolerance once the move stops)...these match the simulator defaults and should be refit from real move logs
+MOVE_MODELS = {'hwp': {'speed': 10., 'accel': 20., 'settle': 0.4}, 'imr': {'speed': 2., 'accel': 2., 'settle': 0.4}}
+
+def hwp_plan(base_obj, angles = ANGLES, cycles = 1, dither = None):
+    '''
+    the steps of an HWP sequence, with the ABBA dither of HWP_Rotation_Sequence.sh
+    in:
+        base_obj (str) - base object name...frames are labelled <base_obj>_hwp_<angle>
+        angles (list) - HWP angles of a cycle in degrees
+        cycles (int) - HWP cycles at each A position (B gets twice as many)
+        dither (tuple) - (dx, dy) xy offset for an ABBA dither, None for no dither
+    out:
+        plan (list of dict) - steps in order...{'action': 'hwp', 'hwp', 'label', 'position', 'cycle'} to take
+            frames at an angle, {'action': 'cycle_end'} after every cycle and {'action': 'xy', 'dx', 'dy'} for
+            the dithers
+    '''
+
+    def block(position, n_cycles):
+        steps = []
+        for cycle in range(n_cycles):
+            for angle in angles:
+                steps.append({'action': 'hwp', 'hwp': float(angle), 'position': position, 'cycle': cycle,
+                              'label': '{}_hwp_{:.1f}'.format(base_obj, angle)})
+            steps.append({'action': 'cycle_end'})
+        return steps
+
+    if dither is None:
+        return block('A', cycles)
+
+    dx, dy = dither
+    return (block('A', cycles) + [{'action': 'xy', 'dx': dx, 'dy': dy}] + block('B', 2 * cycles) +
+            [{'action': 'xy', 'dx': -dx, 'dy': -dy}] + block('A', cycles))
+
+def axis_move_time(distance, model):
+    '''
+    predicted time for one axis to move and settle
+    in:
+        distance (float) - move in degrees
+        model (dict) - 'speed' (deg/s), 'accel' (deg/s^2) and 'settle' (s) of the axis, as in MOVE_MODELS
+    out:
+        duration (float) - seconds...0 if the axis doesn't move
+    '''
+
+    if distance == 0:
+        return 0.
+    return km.move_time(distance, model['speed'], model['accel']) + model['settle']
+
+def _grid_order(imr_angles, hwp_angles, cycles, outer, serpentine, reverse_outer):
+    '''
+    (imr, hwp, cycle) of every frame for one way of walking the grid...the outer axis steps through its angles
+        once, and the inner axis sweeps its angles cycles times at each of them, turning around at the end of
+        every sweep if serpentine
+    '''
+
+    outer_angles, inner_angles = (imr_angles, hwp_angles) if outer == 'imr' else (hwp_angles, imr_angles)
+    if reverse_outer:
+        outer_angles = outer_angles[::-1]
+
+    order = []
+    flip = False
+    for o in outer_angles:
+        for cycle in range(cycles):
+            for i in (inner_angles[::-1] if flip else inner_angles):
+                order.append((o, i, cycle) if outer == 'imr' else (i, o, cycle))
+            if serpentine:
+                flip = not flip
+
+    return order
+
+def _slew_time(order, models, start):
+    '''
+    total predicted move time of a grid order...both axes move at the same time, so each step takes as long as
+        the slower one
+    '''
+
+    imr, hwp = start
+    total = 0.
+    for next_imr, next_hwp, cycle in order:
+        total += max(axis_move_time(next_imr - imr, models['imr']), axis_move_time(next_hwp - hwp, models['hwp']))
+        imr, hwp = next_imr, next_hwp
+
+    return total
+
+def grid_plan(base_obj, imr_angles = IMR_ANGLES, hwp_angles = GRID_HWP_ANGLES, cycles = 1, order = 'fastest',
+              models = MOVE_MODELS, start = (0., 0.)):
+    '''
+    the steps of an IMR x HWP calibration grid (Internal_Pol_Cal_Sequence.sh), in the order that needs the least
+        slewing
+    in:
+        base_obj (str) - base object name...frames are labelled <base_obj>_imr_<imr>_hwp_<hwp>
+        imr_angles, hwp_angles (list) - angles of the grid in degrees
+        cycles (int) - number of times every (IMR, HWP) pair is taken
+        order (str) - 'nested' for the order of the bash script (IMR outer, every HWP sweep from the first angle),
+            'serpentine' to turn the HWP sweep around at every IMR step, or 'fastest' to also try the HWP as the
+            outer axis and walking the outer axis backwards, and keep whichever has the least predicted slew
+        models (dict) - move models of the 'hwp' and 'imr' axes, as in MOVE_MODELS
+        start (tuple) - (imr, hwp) positions before the sequence
+    out:
+        plan (list of dict) - {'action': 'hwp', 'imr', 'hwp', 'label', 'position', 'cycle'} steps for run_sequence,
+            covering every (IMR, HWP) pair cycles times...'position' is the IMR angle
+    '''
+
+    imr_angles = [float(a) for a in imr_angles]
+    hwp_angles = [float(a) for a in hwp_angles]
+
+    if order == 'nested':
+        candidates = [('imr', False, False)]
+    elif order == 'serpentine':
+        candidates = [('imr', True, False)]
+    elif order == 'fastest':
+        candidates = [(outer, serpentine, reverse) for outer in ('imr', 'hwp') for serpentine in (False, True)
+                      for reverse in (False, True)]
+    else:
+        print('Error: order must be nested, serpentine or fastest')
+        return False
+
+    orders = [_grid_order(imr_angles, hwp_angles, cycles, *candidate) for candidate in candidates]
+    best = min(orders, key = lambda o: _slew_time(o, models, start))
+
+    return [{'action': 'hwp', 'imr': imr, 'hwp': hwp, 'position': imr, 'cycle': cycle,
+             'label': '{}_imr_{:.1f}_hwp_{:.1f}'.format(base_obj, imr, hwp)} for imr, hwp, cycle in best]
+
+def predict_duration(plan, models = MOVE_MODELS, exposure = 0., overlap = 0., start = (0., 0.), xy_time = 5.):
+    '''
+    predicted duration of a plan as run_sequence runs it
+    in:
+        plan (list of dict) - from hwp_plan or grid_plan
+        models (dict) - move models of the 'hwp' and 'imr' axes, as in MOVE_MODELS
+        exposure (float) - time of one goi in s (setup, integration, readout and file write of every frame)
+        overlap (float) - seconds of each move hidden behind the previous goi...the file write time when
+            run_sequence pipelines, 0 if it doesn't
+        start (tuple) - (imr, hwp) positions before the sequence
+        xy_time (float) - time for a dither in s
+    out:
+        duration (float) - predicted seconds from the first move to the end of the last goi
+    '''
+
+    imr, hwp = start
+    total = 0.
+    first = True
+    for step in plan:
+        if step['action'] == 'xy':
+            total += xy_time
+        elif step['action'] == 'hwp':
+            next_imr = step.get('imr', imr)
+            move = max(axis_move_time(next_imr - imr, models['imr']), axis_move_time(step['hwp'] - hwp, models['hwp']))
+            if not first:
+                move = max(move - overlap, 0.)
+            total += move + exposure
+            imr, hwp = next_imr, step['hwp']
+            first = False
+
+    return total
+
+def wait_for_hwp(backend, angle, tol = 0.05, timeout = 120.):
+    '''
+    waits for PCUPR to come within tolerance of an angle...wakes on the keyword update rather than polling
+    in:
+        backend (dict) - ktl_module backend
+        angle (float) - target angle in degrees
+        tol (float) - tolerance in degrees
+        timeout (float) - seconds before giving up
+    out:
+        converged (bool) - False if the readback never got within tolerance
+    '''
+
+    if km.wait_for(backend, 'pcu2', 'PCUPR', km.in_tolerance(angle, tol), timeout) is None:
+        print('Error: HWP did not reach ' + str(angle) + ' deg within ' + str(timeout) + ' s')
+        return False
+    return True
+
+def _next_step(plan, i):
+    '''
+    the first 'hwp' step after step i, None if there isn't one
+    '''
+
+    for step in plan[i + 1:]:
+        if step['action'] == 'hwp':
+            return step
+    return None
+
+def _premove_at_filewait(backend, goi_thread, n_frames, move, timeout):
+    '''
+    commands the next move (move() returns whether it went through) as soon as the last frame of a running goi
+        reaches Filewait...gives up without moving if goi finishes or the timeout passes first
+    '''
+
+    lock = threading.Lock()
+    state = {'armed': False, 'n_filewait': 0, 'moved': False, 'closed': False}
+
+    def callback(value):
+        with lock:
+            if state['moved'] or state['closed']:
+                return
+            # only count a Filewait that follows another state, so a stale one from before the goi isn't taken
+            if value != 'Filewait':
+                state['armed'] = True
+            elif state['armed']:
+                state['armed'] = False
+                state['n_filewait'] += 1
+                if state['n_filewait'] == n_frames:
+                    state['moved'] = move()
+
+    handle = backend['subscribe']('alad', 'expstate', callback)
+    t_start = backend['time']()
+    while goi_thread.is_alive() and not state['moved'] and backend['time']() - t_start < timeout:
+        goi_thread.join(0.05)
+    with lock:
+        state['closed'] = True
+    backend['unsubscribe'](handle)
+
+    return state['moved']
+
+def run_sequence(backend, plan, num_exposures = 1, tol = 0.05, imr_tol = 0.05, pipeline = True,
+                 filewait_timeout = 600., verbose = True):
+    '''
+    runs a plan from hwp_plan or grid_plan
+    in:
+        backend (dict) - ktl_module backend
+        plan (list of dict) - steps from hwp_plan or grid_plan...steps with an 'imr' also rotate the IMR there
+        num_exposures (int) - frames per HWP angle (goi -s num_exposures)
+        tol (float) - HWP tolerance in degrees
+        imr_tol (float) - IMR tolerance in degrees, on the ao obrt readback...the backend's rotate converts the IMR
+            angle to the rotate argument (see ktl_module.imr_to_rotate)
+        pipeline (bool) - move the HWP (and IMR) to the next step while the last file of each goi is written
+        filewait_timeout (float) - seconds to wait for Filewait before giving up on a pre-move
+        verbose (bool) - print each step
+    out:
+        log (list of dict) - one entry per 'hwp' step with 'label', 'hwp', 'position', 'cycle', 'start', 'move'
+            (time spent waiting for the HWP), 'exposure' (time in goi) and 'premoved'...False if a command
+            failed and the sequence was aborted
+    '''
+
+    log = []
+    commanded = None
+    commanded_imr = None
+    premoved = False
+
+    for i, step in enumerate(plan):
+        if step['action'] == 'xy':
+            if verbose:
+                print('Executing dither: xy {} {}'.format(step['dx'], step['dy']))
+            with pr.stage('dither', kind = 'phase', clock = backend['time']):
+                if not backend['xy'](step['dx'], step['dy']):
+                    return False
+            continue
+
+        if step['action'] == 'cycle_end':
+            # end-of-sequence sound after each HWP cycle
+            backend['modify']('nirc2plus', 'sequenceip', 'Yes')
+            backend['modify']('nirc2plus', 'sequenceip', 'No')
+            continue
+
+        angle = step['hwp']
+        imr = step.get('imr')
+        t_start = backend['time']()
+        # fields of this step's profiling phases
+        phase = {'kind': 'phase', 'clock': backend['time'], 'position': step['position'], 'cycle': step['cycle'],
+                 'hwp': angle}
+        if verbose:
+            print('---- Moving to ' + ('' if imr is None else 'IMR ' + str(imr) + ' deg, ') + 'HWP ' + str(angle) +
+                  ' deg' + (' (pre-moved)' if premoved else '') + ' ----')
+        with pr.stage('hwp_move', **phase):
+            if commanded != angle:
+                if not backend['modify']('pcu2', 'PCUPR', angle):
+                    print('Error: modify failed (' + str(angle) + ' deg)')
+                    return False
+                commanded = angle
+            if imr is not None and commanded_imr != imr:
+                if not backend['rotate'](imr):
+                    print('Error: Failed to set IMR position to ' + str(imr) + ' degrees.')
+                    return False
+                commanded_imr = imr
+        # both axes move at once
+        with pr.stage('settle', **phase):
+            if not wait_for_hwp(backend, angle, tol):
+                return False
+            if imr is not None and km.wait_for(backend, 'ao', 'obrt', km.in_tolerance(imr, imr_tol)) is None:
+                print('Error: IMR did not reach ' + str(imr) + ' deg')
+                return False
+        t_moved = backend['time']()
+
+        with pr.stage('object', **phase):
+            if not backend['object'](step['label']):
+                print('object failed (' + step['label'] + ')')
+                return False
+
+        # the goi phase spans the exposures and any pre-move made while the last file is written
+        with pr.stage('goi', **phase):
+            result = []
+            goi_thread = threading.Thread(target = lambda: result.append(backend['goi'](num_exposures)))
+            goi_thread.start()
+
+            next_step = _next_step(plan, i)
+            premoved = False
+            if pipeline and next_step is not None:
+                next_angle = next_step['hwp'] if next_step['hwp'] != angle else None
+                next_imr = next_step.get('imr') if next_step.get('imr') not in (None, imr) else None
+
+                def move():
+                    moved = next_angle is None or backend['modify']('pcu2', 'PCUPR', next_angle)
+                    return moved and (next_imr is None or backend['rotate'](next_imr))
+
+                if next_angle is not None or next_imr is not None:
+                    premoved = _premove_at_filewait(backend, goi_thread, num_exposures, move, filewait_timeout)
+                if premoved:
+                    commanded = commanded if next_angle is None else next_angle
+                    commanded_imr = commanded_imr if next_imr is None else next_imr
+
+            goi_thread.join()
+        if not result or not result[0]:
+            print('goi failed (' + step['label'] + ' x' + str(num_exposures) + ')')
+            return False
+
+        log.append({'label': step['label'], 'hwp': angle, 'imr': imr, 'position': step['position'], 'cycle': step['cycle'],
+                    'start': t_start, 'move': t_moved - t_start, 'exposure': backend['time']() - t_moved,
+                    'premoved': premoved})
+
+    return log
+
+def cycle_overhead(log, science_time):
+    '''
+    time per HWP cycle that isn't spent integrating
+    in:
+        log (list of dict) - from run_sequence
+        science_time (float) - integration time per frame (itime * coadds) times the frames per angle
+    out:
+        overhead (np array) - seconds of overhead for each cycle, in the order they were taken...a cycle runs
+            from its first step to the first step of the next one, so dithers count against the cycle before
+    '''
+
+    starts = []
+    n_angles = []
+    for i, entry in enumerate(log):
+        key = (entry['position'], entry['cycle'])
+        if i == 0 or key != (log[i - 1]['position'], log[i - 1]['cycle']):
+            starts.append(entry['start'])
+            n_angles.append(0)
+        n_angles[-1] += 1
+
+    last = log[-1]
+    ends = starts[1:] + [last['start'] + last['move'] + last['exposure']]
+
+    return np.array(ends) - np.array(starts) - np.array(n_angles) * science_time
+
+def simulate(angles = ANGLES, cycles = 2, dither = None, num_exposures = 1, pipeline = True, tol = 0.05,
+             time_scale = 0.01, plan = None, **sim_kwargs):
+    '''
+    runs an HWP sequence against the KTL simulator
+    in:
+        angles, cycles, dither - as in hwp_plan
+        plan (list of dict) - a plan to run instead, e.g. from grid_plan
+        num_exposures, tol, pipeline - as in run_sequence
+        time_scale (float) - real seconds per simulated second
+        sim_kwargs - passed on to ktl_module.simulator, e.g. itime or hwp_speed
+    out:
+        log (list of dict) - from run_sequence
+        overhead (np array) - simulated seconds of overhead per cycle
+        sim (dict) - the simulator, e.g. sim['violations'] or sim['frames']
+    '''
+
+    sim = km.simulator(time_scale = time_scale, **sim_kwargs)
+    config = sim['config']
+    if plan is None:
+        plan = hwp_plan('sim', angles, cycles, dither)
+    log = run_sequence(km.sim_backend(sim), plan, num_exposures, tol = tol, pipeline = pipeline, verbose = False)
+
+    return log, cycle_overhead(log, config['itime'] * config['coadds'] * num_exposures), sim
@@ -19,10 +19,22 @@ from scipy.interpolate import interp1d
 import glob
 import os
 from astropy.io import fits
+from astropy.table import Table
 from scipy.ndimage import center_of_mass
 import shutil as su
+import photometry_module as pm
+import catalog_module as cm
+import calibration_module as cal
+import profiling_module as pr
+import product_module as prd
+import collapse_module as cl
+from concurrent.futures import ProcessPoolExecutor
 
 #######################################################################
+
+# numpy dtype of the values stored for each BITPIX
+BITPIX_DTYPES = {8: 'u1', 16: 'i2', 32: 'i4', 64: 'i8', -32: 'f4', -64: 'f8'}
+
 def splice_data(directory, file_name, ranges, scrap_savepath):
     '''
     splices out the wrapped images from a data cube in the JHK waveplate data set
@@ -33,66 +45,332 @@ def splice_data(directory, file_name, ranges, scrap_savepath):
         scrap_savepath - wherever we want to keep the original file
     out:
         returns - none
-        files - renames the original file and saves it to scrap_savepath...this should end with '_scrap'
+        files - renames the original file and saves it to scrap_savepath...this should end with '_scrap'...
+            the spliced cube keeps the original header, with OPMPOWER cut down to the kept frames
     '''   
 
-    path = directory + '\\' + file_name + '.fits'
+    path = os.path.join(directory, file_name + '.fits')
 
-    with fits.open(path) as hdul:
+    _splice_file(path, ranges, scrap_savepath)
 
-        # initialize the data cube
-        data_cube = np.asarray(hdul[0].data.copy())
-        print(type(data_cube))
+    print('done')
 
-        # initialize the pwr list
-        hdr = hdul[0].header.copy()
-        pwr_list = np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)
+def splice_batch(splices, scrap_dir, chunk_frames = 16, n_workers = 1):
+    '''
+    splices many files in one go...e.g. every wrapped OPM data set of a night...only the kept frames are read 
+        (through memory-mapped sections, chunk_frames at a time) and each spliced cube is written with its 
+        rewritten OPMPOWER header in a single pass, so memory stays bounded by a chunk of kept frames
+    in:
+        splices (list) - (path, ranges) pairs...path is the full path to the .fits file, ranges the (start, stop) 
+            ranges of frames to keep
+        scrap_dir (str) - folder the originals are moved into...created if it isn't there
+        chunk_frames (int) - number of frames read at a time
+        n_workers (int or None) - number of processes the files are spread over...1 runs serially, None uses 
+            every core
+    out:
+        files - the spliced cubes replace the originals, which are kept in scrap_dir under the same name
+    '''
 
-        # use the ranges to chop up the pwr_list and data_cube
-        indices = np.r_[tuple(slice(start,stop) for start,stop in ranges)]
-            
-        pwr_list_splice = pwr_list[indices]
+    os.makedirs(scrap_dir, exist_ok = True)
 
-        # make sure these are strings that can be read in to a header
-        pwr_list_splice = '[' + ', '.join(f'{x:.8e}' for x in pwr_list_splice) + ']'
+    jobs = []
+    for path, ranges in splices:
+        scrap_path = os.path.join(scrap_dir, os.path.basename(path))
+        jobs.append((_splice_file, (path, ranges, scrap_path, chunk_frames)))
 
-        data_cube_splice = data_cube[indices,:,:]
-        
+    _run_jobs(jobs, n_workers)
 
-    # move the original file to the scrap_savepath
-    su.move(path,scrap_savepath)
+    for path, ranges in splices:
+        print('spliced '+path)
 
-    # make a new file in the normal data directory containing the spliced data_cube and pwr_list
-    hdu2 = fits.PrimaryHDU(data=data_cube_splice)
-    hdu2.writeto(path)
+####################################################################################################################
 
-    with fits.open(path, mode='update') as hdul:
-        hdr = hdul[0].header
-        hdr['OPMPOWER'] = pwr_list_splice
+def _run_jobs(jobs, n_workers = 1):
+    '''
+    runs a list of jobs...serially and in order when n_workers is 1, otherwise spread over a pool of 
+        n_workers processes (None uses every core)...either way the results come back in the order of jobs
+    in:
+        jobs (list) - (function, args) tuples...the functions must live at module level so they can be pickled
+        n_workers (int or None) - number of worker processes
+    out:
+        results (list) - return value of each job
+    '''
 
-    print('done')
+    if n_workers == 1:
+        return [func(*args) for func, args in jobs]
 
-####################################################################################################################
+    with ProcessPoolExecutor(max_workers = n_workers, **pr.pool_args()) as pool:
+        futures = [pool.submit(func, *args) for func, args in jobs]
+        return [future.result() for future in futures]
 
-def dark_subtract_2(directory,wvls):
+def _product_path(f, marker, suffix):
+    '''
+    builds the path of a product (e.g. '_dsub.fits') for a file...the product goes into the folder above 
+        the marker in the original path ('Air_Meas' for the air_cal, 'D' for the position measurements)
+    in:
+        f (str) - path to the fits file the product is made from
+        marker (str) - folder name the original path is split on
+        suffix (str) - appended to the file name, including the extension
+    out:
+        write_path (str) - path for the product
+    '''
+
+    fname = f.split(os.sep)[-1].split('.f')[0]
+
+    if os.sep + marker in f:
+        path = f.split(os.sep + marker)[0]
+    else:
+        # the marker isn't in the path (the file was already moved up a level)...keep the product next to f
+        path = os.path.dirname(f)
+
+    return os.path.join(path, fname + suffix)
+
+def _median_opmpower(hdr):
+    '''
+    median of the photodiode readings in the OPMPOWER header...nan if the keyword isn't there (e.g. a dark)
+    '''
+
+    try:
+        pwr = np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)
+    except KeyError:
+        return np.nan
+
+    return np.median(pwr)
+
+def _median_dark(f_drk, n_threads = 1):
+    '''
+    median collapses a dark cube over the 0 axis...a band of rows at a time (collapse_module), so the cube is 
+        never read into memory whole
+    '''
+
+    with pr.stage('fits_open', file = f_drk):
+        hdul = fits.open(f_drk)
+
+    with hdul, pr.stage('median_collapse', file = f_drk):
+        return cl.collapse(prd.data_hdu(hdul).section, 'median', n_threads = n_threads)
+
+def _dark_medians(drk_files, library_dir = None, n_workers = 1, n_threads = 1):
+    '''
+    the median dark of each dark file...with a calibration library, the master darks are built once (and never 
+        again on later runs) and the paths to them are returned instead, so every worker maps the same master 
+        rather than getting its own copy
+    '''
+
+    if library_dir is None:
+        return _run_jobs([(_median_dark, (f_drk, n_threads)) for f_drk in drk_files], n_workers)
+
+    return _run_jobs([(cal.build_master, (library_dir, 'dark', [f_drk], None, n_threads)) for f_drk in drk_files],
+                     n_workers)
+
+def _load_dark(drk_med):
+    '''
+    the median dark itself, whether it was passed as an array or as the path to a master in the library
+    '''
+
+    if isinstance(drk_med, str):
+        return np.asarray(cal.load_master(drk_med))
+
+    return drk_med
+
+def _open_sections(f):
+    '''
+    opens a fits file for reading frames through hdul[0].section...memory mapped, except for scaled (BZERO/BSCALE) 
+        data, which astropy will not memory map...sections of those still only read the frames asked for
+    '''
+
+    hdr = fits.getheader(f)
+    memmap = not any(key in hdr for key in ('BZERO', 'BSCALE', 'BLANK'))
+
+    return fits.open(f, memmap = memmap)
+
+def _write_chunks(write_path, hdr, dtype, frame_shape, n_frames, chunks, overwrite = False):
+    '''
+    writes a cube to a fits file one chunk of frames at a time...the file is bit-identical to 
+        fits.PrimaryHDU(data = cube, header = hdr).writeto(write_path) for the concatenated chunks, scaled
+        (BZERO / BSCALE) dtypes like uint16 included
+    in:
+        write_path (str) - where the cube is saved
+        hdr (fits header) - header to build the output header from
+        dtype - dtype of the data
+        frame_shape (tuple) - (ny, nx) of a frame
+        n_frames (int) - total number of frames the chunks add up to
+        chunks (iterable) - (n, ny, nx) arrays
+        overwrite (bool) - replace an existing file...like writeto, it is an error otherwise
+    '''
+
+    # the output header is whatever PrimaryHDU would have built for the full cube...get it from an empty 
+    #   cube of the right dtype so nothing the size of the data is ever allocated
+    dtype = np.dtype(dtype)
+    out_hdr = fits.PrimaryHDU(data = np.empty((0,) + tuple(frame_shape), dtype = dtype), header = hdr).header
+    out_hdr['NAXIS3'] = n_frames
+
+    # match writeto, which refuses to overwrite an existing file unless asked to
+    if os.path.exists(write_path) and not overwrite:
+        raise OSError('File '+write_path+' already exists.')
+
+    # the values are stored as BITPIX with BZERO / BSCALE taken off (e.g. uint16 is int16 with BZERO = 32768), so
+    #   the chunks have to be unscaled the way writeto does it
+    disk_dtype = np.dtype(BITPIX_DTYPES[out_hdr['BITPIX']]).newbyteorder('>')
+    bzero, bscale = out_hdr.get('BZERO', 0), out_hdr.get('BSCALE', 1)
+
+    # write the header, then each chunk as big-endian bytes, then pad out the last block
+    n_bytes = 0
+    with open(write_path, 'wb') as fo:
+        fo.write(out_hdr.tostring().encode('ascii'))
+
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            if bzero != 0 or bscale != 1:
+                if chunk.dtype.kind in 'iub' and bscale == 1 and float(bzero).is_integer():
+                    chunk = chunk.astype(np.int64) - int(bzero)
+                else:
+                    chunk = (chunk - bzero) / bscale
+            chunk = chunk.astype(disk_dtype, copy = False)
+            fo.write(chunk.tobytes())
+            n_bytes += chunk.nbytes
+
+        fo.write(b'\0' * (-n_bytes % 2880))
+
+def _splice_file(path, ranges, scrap_path, chunk_frames = 16):
+    '''
+    moves a cube to scrap_path, then writes the frames (and OPMPOWER readings) inside ranges back to path
+    in:
+        path (str) - path to the cube
+        ranges (list) - (start, stop) ranges of frames to keep
+        scrap_path (str) - where the original is moved
+        chunk_frames (int) - number of frames read at a time
+    '''
+
+    # initialize the pwr list
+    hdr = fits.getheader(path).copy()
+    pwr_list = np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)
+
+    # use the ranges to chop up the pwr_list...indexing the frames too makes a bad range fail before anything moves
+    indices = np.r_[tuple(slice(start,stop) for start,stop in ranges)]
+    frames = np.arange(hdr['NAXIS3'])[indices]
+
+    # make sure these are strings that can be read in to a header
+    hdr['OPMPOWER'] = '[' + ', '.join(f'{x:.8e}' for x in pwr_list[indices]) + ']'
+
+    # move the original file out of the way...the kept frames are read back from there
+    su.move(path, scrap_path)
+
+    with _open_sections(scrap_path) as hdul:
+        n_frames, ny, nx = hdul[0].shape
+
+        # the data cube, a chunk of each range at a time
+        def chunks():
+            for start, stop in ranges:
+                stop = min(stop, n_frames)
+                for i in range(start, stop, chunk_frames):
+                    yield hdul[0].section[i:min(i + chunk_frames, stop)]
+
+        dtype = hdul[0].section[0:1].dtype
+        _write_chunks(path, hdr, dtype, (ny, nx), len(frames), chunks())
+
+def _dark_subtract_cube(f, drk_med, write_path, stream = False, chunk_frames = 16, output_format = 'native',
+                        quantize_level = prd.QUANTIZE_LEVEL, overwrite = False):
+    '''
+    subtracts the median dark from every frame of a cube and writes the result to write_path, keeping
+        the original header (and so the OPMPOWER readings)
+    in:
+        f (str) - path to the air_cal or position cube
+        drk_med (np array or str) - median dark frame, or the path to a master dark in the calibration library
+        write_path (str) - where the dark subtracted cube is saved
+        stream (bool) - if True, read the cube chunk_frames frames at a time through memory-mapped 
+            sections and write each chunk straight to write_path...peak memory is about one chunk no matter 
+            how deep the cube is, and the file is bit-identical to the in-memory version...the compressed formats
+            can only be compressed from a whole cube, so those are streamed to a temporary uncompressed file which
+            is then compressed from a memory map
+        chunk_frames (int) - number of frames per chunk when streaming
+        output_format (str) - format of the product, one of product_module.FORMATS
+        quantize_level (float) - quantization of the compressed formats, see product_module
+        overwrite (bool) - replace a product that is already there
+    out:
+        fits file - the dark subtracted cube at write_path
+    '''
+
+    drk_med = _load_dark(drk_med)
+
+    if not stream:
+
+        # access the file, nab the data cube and header
+        with pr.stage('fits_open', file = f), fits.open(f) as hdul:
+            cube = np.asarray(hdul[0].data)
+            hdr = hdul[0].header
+
+        # subtract the drk_med from the cube, save a fits file
+        with pr.stage('dark_subtract', file = f):
+            dsub = cube - drk_med
+        with pr.stage('fits_write', file = write_path, output_format = output_format):
+            prd.write_product(write_path, dsub, hdr, output_format, quantize_level, overwrite)
+        return
+
+    compressed = prd.FORMATS[output_format] is not None
+    stream_path = write_path + '.tmp' if compressed else write_path
+    if compressed and os.path.exists(write_path) and not overwrite:
+        raise OSError('File '+write_path+' already exists.')
+
+    with pr.stage('dark_subtract', file = f, stream = True), _open_sections(f) as hdul:
+        hdr = hdul[0].header
+        n_frames = hdul[0].shape[0]
+        dtype = np.result_type(hdul[0].section[0:1].dtype, drk_med.dtype)
+        if output_format in ('float64', 'float32'):
+            dtype = np.dtype(output_format)
+
+        chunks = (hdul[0].section[start:start + chunk_frames] - drk_med for start in range(0, n_frames, chunk_frames))
+        # a temporary file left behind by an interrupted run is always replaced
+        _write_chunks(stream_path, hdr, dtype, drk_med.shape, n_frames, chunks, overwrite or compressed)
+
+    if compressed:
+        with pr.stage('fits_write', file = write_path, output_format = output_format):
+            with fits.open(stream_path, memmap = True) as hdul:
+                prd.write_product(write_path, hdul[0].data, hdr, output_format, quantize_level, overwrite)
+            os.remove(stream_path)
+
+@pr.profiled
+def dark_subtract_2(directory, wvls, stream = False, chunk_frames = 16, n_workers = 1, library_dir = None,
+                    output_format = 'native', quantize_level = prd.QUANTIZE_LEVEL, collapse_threads = 1,
+                    overwrite = True):
     '''
     This version of dark_subtract goes before the normalization using the photodiode measurements...
     It performs pixel - by -pixe dark subtraction on the air and position measurements in the throughput data set
     in:
         directory (str) - greater directory containing the throughput data set
         wvls (list of str) - wavelengths used in the experiment 
+        stream (bool) - if True, cubes are read and written in chunks of chunk_frames frames instead of all at
+            once...use this for long OPM-logged cubes that don't fit in memory
+        chunk_frames (int) - number of frames per chunk when streaming
+        n_workers (int or None) - number of processes the dark medians and the files of every wavelength are 
+            spread over...1 runs serially, None uses every core
+        library_dir (str) - calibration library (calibration_module) to keep the median darks in, so they are only
+            computed on the first run...None computes them every time
+        output_format (str) - format the products are written in: 'native' (the dtype the data come out in, as
+            before), 'float64', 'float32', 'rice' or 'hcompress' (see product_module)
+        quantize_level (float) - quantization of non-integer data in the compressed formats
+        collapse_threads (int) - threads each median dark is collapsed with (collapse_module), on top of n_workers
+        overwrite (bool) - replace the products of an earlier run...False refuses to, as writeto does
 
     out:    
         fits files - they will have the same name as the originals with _dsub attached to the end...
             they will be placed in the same folder as the originals 
     '''
 
+    if not prd.check_format(output_format):
+        return False
+
+    # predefine lists that will hold the dark for each wavelength and the files to dark subtract with it
+    drk_files = []
+    sub_files = []
+
     for wvl in wvls:
 
         # create the pattern for the files we want...these should be the base files...use glob.glob to get 
         #   a list of file names
         pattern = os.path.join(directory,'**','*'+wvl+'*.fits')
-        file_list = glob.glob(pattern, recursive = True)
+        with pr.stage('glob', pattern = pattern):
+            # the products of an earlier run match the pattern too...leave them out
+            file_list = [f for f in glob.glob(pattern, recursive = True) if '_dsub' not in f]
 
         # predefine lists that will hold filenames for ach type of file
         pos_list = []
@@ -121,57 +399,68 @@ def dark_subtract_2(directory,wvls):
         if len(air_list) > 1:
             print('More than one air_cal frame detected for wvl: '+ str(wvl))
             return False        
-        
-        # create the dark frame...first, access the fits file
-        f_drk = drk_list[0]
-        with fits.open(f_drk) as hdul:
-            drk_cube = np.asarray(hdul[0].data)
-
-        # median over the 0 axis
-        drk_med = np.median(drk_cube, axis = 0)
 
-        # access each measurement and air_cal file...subtract the drk_med from each individual frame...
-        #   note that we need to keep the OPMPOWER header, so we also take take that out to put into the new file
+        # the air_cal file first, then the measurement files...the product of the air_cal goes above Air_Meas
+        drk_files.append(drk_list[0])
+        sub_files.append([(air_list[0], 'Air_Meas')] + [(f, 'D') for f in pos_list])
 
-        # first the air_cal file
+    # create the dark frame for each wavelength by taking the median over the 0 axis
+    drk_meds = _dark_medians(drk_files, library_dir, n_workers, collapse_threads)
 
-        # access the file, nab the data cube and header
-        with fits.open(air_list[0]) as hdul:
-            air_cube = np.asarray(hdul[0].data)
-            hdr = hdul[0].header
+    # access each measurement and air_cal file...subtract the drk_med from each individual frame...
+    #   note that we need to keep the OPMPOWER header, so _dark_subtract_cube puts that into the new file
+    jobs = []
+    write_paths = []
+    for drk_med, files in zip(drk_meds, sub_files):
+        for f, marker in files:
+            write_path = _product_path(f, marker, '_dsub.fits')
+            jobs.append((_dark_subtract_cube, (f, drk_med, write_path, stream, chunk_frames, output_format,
+                                               quantize_level, overwrite)))
+            write_paths.append(write_path)
 
+    _run_jobs(jobs, n_workers)
 
-        # dark subtract the air, save a fits file
-        air_dsub = air_cube - drk_med
-
-        fname = air_list[0].split("\\")[-1].split('.f')[0]
-        path = air_list[0].split("\\Air_Meas")[0]
-        hdu2 = fits.PrimaryHDU(data=air_dsub, header = hdr)
-        write_path = path+"\\"+fname+"_dsub.fits"
-        hdu2.writeto(write_path)
-        print('dark subtracted file saved to '+path+"\\"+fname+"_dsub.fits")
-            
-        # do the same for the measurement files
-        for i in range(len(pos_list)):
-            
-            # access the file, nab the data cube and header
-            with fits.open(pos_list[i]) as hdul:
-                pos_cube = np.asarray(hdul[0].data)
-                hdr = hdul[0].header
-
-            # subtract the drk_med from pos_cube, save a fit file
-            pos_cube_dsub = pos_cube - drk_med
-
-            fname = pos_list[i].split("\\")[-1].split('.f')[0]
-            path = pos_list[i].split("\\D")[0]
-            write_path = path+"\\"+fname+"_dsub.fits"
-            hdu2 = fits.PrimaryHDU(data=pos_cube_dsub, header = hdr)
-            hdu2.writeto(write_path)
-            print('dark subtracted file saved to '+path+"\\"+fname+"_dsub.fits")
+    for write_path in write_paths:
+        print('dark subtracted file saved to '+write_path)
 
 ####################################################################################################################
 
-def normalize_photodiode_readings_aircal_2(directory, wvls):
+def _normalize_cube(f, normpwr, write_path, output_format = 'native', quantize_level = prd.QUANTIZE_LEVEL,
+                    n_threads = 1, overwrite = False):
+    '''
+    median collapses a dark subtracted cube, divides it by its normalized photodiode reading and saves it with 
+        the reading as the header 'NORMPWR'
+    in:
+        f (str) - path to the '_dsub.fits' file
+        normpwr (float) - photodiode reading normalized by the air_cal
+        write_path (str) - where the normalized frame is saved
+        output_format (str) - format of the product, one of product_module.FORMATS
+        quantize_level (float) - quantization of the compressed formats, see product_module
+        n_threads (int) - threads the median is collapsed with (collapse_module)
+        overwrite (bool) - replace a product that is already there
+    '''
+
+    # the '_dsub.fits' file can be in any of the output formats
+    with pr.stage('fits_open', file = f):
+        hdul = fits.open(f)
+        hdu = prd.data_hdu(hdul)
+        hdr = hdu.header
+        hdr['NORMPWR'] = normpwr
+
+    ##median collapse cube...a band of rows at a time, so the cube is never read into memory whole
+    with hdul, pr.stage('median_collapse', file = f):
+        data = cl.collapse(hdu.section, 'median', n_threads = n_threads)
+    #normalized
+    with pr.stage('normalization', file = f):
+        norm_data = data/normpwr
+
+    with pr.stage('fits_write', file = write_path, output_format = output_format):
+        prd.write_product(write_path, norm_data, hdr, output_format, quantize_level, overwrite)
+
+@pr.profiled
+def normalize_photodiode_readings_aircal_2(directory, wvls, n_workers = 1, output_format = 'native',
+                                           quantize_level = prd.QUANTIZE_LEVEL, collapse_threads = 1,
+                                           overwrite = True):
     """Reads in all the .fits files, normalizes by air_cal, such that the air_cal photodiode reading for each
             wavelength is always 1, and the photodiode readings for the waveplate measurements give the percentage of 
             the power relative to the air_cal. It divides (pixel - by - pixel) each median frame by the normalized
@@ -182,45 +471,54 @@ def normalize_photodiode_readings_aircal_2(directory, wvls):
             directory (str) - string for directory containing all subfolders of data
             wvls (list) - list containing STRINGS for each wavelength (or other identifiable parameter for looping...
                 ***THIS MUST BE A LIST***
+            n_workers (int or None) - number of processes the files of every wavelength are spread over...the air_cal 
+                normalization is still computed once per wavelength...1 runs serially, None uses every core
+            output_format (str) - format the products are written in: 'native' (the dtype the data come out in,
+                as before), 'float64', 'float32', 'rice' or 'hcompress' (see product_module)...the '_dsub.fits'
+                files are read whatever format they are in
+            quantize_level (float) - quantization of non-integer data in the compressed formats
+            collapse_threads (int) - threads each cube is median collapsed with (collapse_module), on top of 
+                n_workers
+            overwrite (bool) - replace the products of an earlier run...False refuses to, as writeto does
 
         outs:
             fits files - 'dsub_norm.fits' containing the normalized median frame + previous headers and the 
                 normalized photodiode reading as a header 'NORMPWR'
     """
 
-    ##step 1: get the median power reading for each file; sepearate them into air cals and wp meas 
+    if not prd.check_format(output_format):
+        return False
+
+    # predefine a list that will hold the normalization of every file over all the wavelengths
+    jobs = []
+
+    ##step 1: get the median power reading for each file; sepearate them into air cals and wp meas...the readings 
+    #   come from the header catalog, so the files don't have to be opened here
+
+    with pr.stage('catalog_update'):
+        cm.update_catalog(directory)
 
     for wvl in wvls:
 
-        pattern = os.path.join(directory,'**','*'+wvl+'*dsub.fits')
-        #print("Pattern: " + str(pattern))
-        file_list = glob.glob(pattern, recursive = True)
+        with pr.stage('catalog_query', wvl = wvl):
+            rows = cm.query_catalog(directory, '*'+wvl+'*dsub.fits', refresh = False)
+        # the normalized readings below are air_cals first, so the files have to be in the same order
+        rows = sorted(rows, key = lambda row: row['kind'] != 'air')
+        file_list = [row['path'] for row in rows]
         # we need to separate airs from wp meas
         pwr_list = []
         air_pwr_list = []
 
-        for f in file_list:
-            if 'Air' in f:
-                hdul = fits.open(f)
-                hdr = hdul[0].header
-                try:
-                    pwr = np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)
-                    median_pwr = np.median(pwr)
-                    air_pwr_list.append(median_pwr)
-                except:
-                    print("this is probably a dark frame, keyword OPMPOWER not found")
-                    pwr_list.append(np.nan)
+        for row in rows:
+            if row['opmpower'] is None:
+                print("this is probably a dark frame, keyword OPMPOWER not found")
+                pwr_list.append(np.nan)
+
+            elif row['kind'] == 'air':
+                air_pwr_list.append(row['opmpower'])
             
             else:
-                hdul = fits.open(f)
-                hdr = hdul[0].header
-                try:
-                    pwr = np.asarray(hdr['OPMPOWER'][1:-1].split(',')).astype(float)
-                    median_pwr = np.median(pwr)
-                    pwr_list.append(median_pwr)
-                except:
-                    print("this is probably a dark frame, keyword OPMPOWER not found")
-                    pwr_list.append(np.nan)
+                pwr_list.append(row['opmpower'])
 
         ## step 2: normalize based on the average aircal reading
 
@@ -240,41 +538,35 @@ def normalize_photodiode_readings_aircal_2(directory, wvls):
         ## step 3: write these normalized jawns back to the headers
 
         for i in range(len(file_list)):
-                hdul = fits.open(file_list[i])
-                hdr = hdul[0].header
 
                 if np.isnan(norm_pwr_list[i])==False:
-                    normpwr = norm_pwr_list[i]
-                    hdr['NORMPWR'] = normpwr
 
-                    ##median collapse cube
-                    data = np.median(hdul[0].data,axis=0)
-                    #normalized
-                    norm_data = data/normpwr
-
-                    if 'Dark' in file_list[i]:
+                    if rows[i]['kind'] == 'dark':
                         print('dark frame...do nothing')
 
                     elif i < num_cals:
-                        fname = file_list[i].split("\\")[-1].split('.f')[0]
-                        path = file_list[i].split("\\Air_Meas")[0]
-                        hdu2 = fits.PrimaryHDU(data=norm_data,header=hdr)
-                        write_path = path+"\\"+fname+"_norm.fits"
-                        hdu2.writeto(write_path)
-                        print('normalized file saved to '+path+"\\"+fname+"_norm.fits")
+                        jobs.append((_normalize_cube, (file_list[i], norm_pwr_list[i], 
+                                                       _product_path(file_list[i], 'Air_Meas', '_norm.fits'),
+                                                       output_format, quantize_level, collapse_threads,
+                                                       overwrite)))
 
                     elif i >= num_cals:
-                        fname = file_list[i].split("\\")[-1].split('.f')[0]
-                        path = file_list[i].split("\\D")[0]
-                        hdu2 = fits.PrimaryHDU(data=norm_data,header=hdr)
-                        write_path = path+"\\"+fname+"_norm.fits"
-                        hdu2.writeto(write_path)
-                        print('normalized file saved to '+path+"\\"+fname+"_norm.fits")
+                        jobs.append((_normalize_cube, (file_list[i], norm_pwr_list[i], 
+                                                       _product_path(file_list[i], 'D', '_norm.fits'),
+                                                       output_format, quantize_level, collapse_threads,
+                                                       overwrite)))
 
                 else:
                     "not saving a normalized file, this is probably a dark"
                     pass
 
+    ## step 4: median collapse and normalize every file...the write path is the third argument of each job
+
+    _run_jobs(jobs, n_workers)
+
+    for func, args in jobs:
+        print('normalized file saved to '+args[2])
+
 #####################################################################################################################
 
 def mod_centroid(im, threshold):
@@ -331,7 +623,63 @@ def aperture_sum(im, com, radius):
 
     return total_counts
 
-def get_throughput(directory, wvls, threshold, radius):
+def _centroid_sum(im, threshold, radius):
+    '''
+    mod_centroid followed by aperture_sum, using the batched versions in photometry_module...the threshold is 
+        applied the same way, but the aperture is only evaluated on a cutout around the centroid
+    in:
+        im - numpy array of the image
+        threshold - value in counts
+        radius - radius in pixels to sum over
+    out:
+        com - [y,x] coordinates of the centroid
+        total_counts - total counts within the aperture
+    '''
+
+    with pr.stage('centroid'):
+        com = pm.centroid_stack(im, threshold)[0]
+    with pr.stage('aperture'):
+        total_counts = pm.aperture_sums(im, com, [radius])[0, 0]
+
+    return com, total_counts
+
+def _air_sum(f, threshold, radius):
+    '''
+    centroids the normalized air_cal and sums the counts in the aperture
+    '''
+
+    with pr.stage('fits_open', file = f):
+        air = np.array(prd.read_data(f))
+
+    # centroid the air_cal and sum counts in the aircal
+    air_com, air_sum = _centroid_sum(air, threshold, radius)
+
+    return air_sum
+
+def _position_throughput(f, threshold, radius, air_sum):
+    '''
+    centroids a normalized position measurement, sums the counts in the aperture and adds the throughput 
+        (as a fraction of the air_cal counts) to its header as 'THRUPUT'
+    '''
+
+    # open the measurement file
+    with pr.stage('fits_open', file = f):
+        pos = np.array(prd.read_data(f))
+
+    # centroid the image and sum counts in aperture
+    pos_com, pos_sum = _centroid_sum(pos, threshold, radius)
+
+    # calculate thruoghput
+    throughput = pos_sum / air_sum
+
+    # add throughput to the header of the dark subtracted file...without touching compressed data
+    with pr.stage('header_update', file = f):
+        prd.update_header(f, THRUPUT = throughput)
+
+    return throughput
+
+@pr.profiled
+def get_throughput(directory, wvls, threshold, radius, n_workers = 1):
     '''
     Takes the normalized, dark subtracted air_cal and pos_meas files and calcultes the throughput by summing the counts
     within a certain radius of the centroid of the beam on the detector within the aperture radius, then dividing
@@ -341,17 +689,24 @@ def get_throughput(directory, wvls, threshold, radius):
         directory (str) - directory containing the dark subtracted air_cal and pos_meas files
         wvls (list of str) - list of wavelengths for the measurements, each index must be a string
         radius (int) - radius in pixels for the aperture summing
+        n_workers (int or None) - number of processes the air_cals and then the position files of every 
+            wavelength are spread over...1 runs serially, None uses every core
     
     out:
         THRUPUT (Header) - THRUPUT keyword is added as a header to the '_dsub_norm.fits' files 
     '''
 
+    # predefine lists of the air_cal and the position measurements for each wavelength
+    air_files = []
+    pos_lists = []
+
     #define the wavelength:
     for wvl in wvls:
 
     ## step 1: we want to identify the air_cal and pos_meas file names for each wvl
         pattern = os.path.join(directory,'**','*'+ wvl +'*dsub_norm.fits')
-        file_list = glob.glob(pattern, recursive = True)
+        with pr.stage('glob', pattern = pattern):
+            file_list = glob.glob(pattern, recursive = True)
         print(file_list)
         # predefine lists of each file type
         pos_list = []
@@ -367,83 +722,233 @@ def get_throughput(directory, wvls, threshold, radius):
             else:
                 pos_list.append(f)
 
-    
-    ## Step 2: define the aircal, centroid it, and then aperture sum
+        air_files.append(air_list[0])
+        pos_lists.append(pos_list)
 
-        # define the air_cal
-        hdul_a = fits.open(air_list[0])
-        air = hdul_a[0].data
-        air = np.array(air)
+    ## Step 2: define the aircal, centroid it, and then aperture sum...once per wavelength
 
-        # centroid the air_cal
-        air_com = mod_centroid(air, threshold)
-
-        # sum counts in the aircal
-        air_sum = aperture_sum(air, air_com, radius)
+    air_sums = _run_jobs([(_air_sum, (f, threshold, radius)) for f in air_files], n_workers)
 
     ## Step 3: loop through the positional measurements, centroid them, aperture sum, and calculate throughput...
         # we'll also add the throughput (as a fraction of the aircal counts) to the dark subtracted fits file
         # as a header
 
-        # loop
+    jobs = []
+    for air_sum, pos_list in zip(air_sums, pos_lists):
+        for f in pos_list:
+            jobs.append((_position_throughput, (f, threshold, radius, air_sum)))
+
+    throughputs = _run_jobs(jobs, n_workers)
+
+    for wvl, pos_list in zip(wvls, pos_lists):
         for i in range(len(pos_list)):
-            # open the measurement file
-            hdul_p = fits.open(pos_list[i])
-            pos = hdul_p[0].data
-            pos = np.array(pos)
+            print(throughputs.pop(0))
+
+        print('finished with wavelength: ' + wvl)
+
+def _measure_file(f, drk_med, normpwr, threshold, radius, air_sum = None, dsub_path = None, norm_path = None,
+                  output_format = 'native', quantize_level = prd.QUANTIZE_LEVEL, n_threads = 1, overwrite = False):
+    '''
+    runs dark subtraction, median collapse, normalization, centroiding and aperture summing on one raw air_cal 
+        or position cube with a single read...the intermediate products are only written if paths are given
+    in:
+        f (str) - path to the raw cube
+        drk_med (np array or str) - median dark frame, or the path to a master dark in the calibration library
+        normpwr (float) - photodiode reading normalized by the air_cal
+        threshold - value in counts for mod_centroid
+        radius - radius in pixels for aperture_sum
+        air_sum (float) - air_cal aperture sum...if given, the throughput goes into the header as 'THRUPUT'
+        dsub_path (str) - where to checkpoint the dark subtracted cube, None to skip it
+        norm_path (str) - where to checkpoint the normalized median frame, None to skip it
+        output_format (str) - format of the checkpoints, one of product_module.FORMATS
+        quantize_level (float) - quantization of the compressed formats, see product_module
+        n_threads (int) - threads the median is collapsed with (collapse_module)
+        overwrite (bool) - replace checkpoints that are already there
+    out:
+        com - [y,x] coordinates of the centroid
+        total_counts - counts within the aperture
+    '''
+
+    # access the file, nab the data cube and header
+    with pr.stage('fits_open', file = f), fits.open(f) as hdul:
+        cube = np.asarray(hdul[0].data)
+        hdr = hdul[0].header
+
+    # dark subtract
+    with pr.stage('dark_subtract', file = f):
+        dsub = cube - _load_dark(drk_med)
+    if dsub_path is not None:
+        with pr.stage('fits_write', file = dsub_path, output_format = output_format):
+            prd.write_product(dsub_path, dsub, hdr, output_format, quantize_level, overwrite)
+
+    # median collapse and normalize
+    with pr.stage('median_collapse', file = f):
+        med = cl.collapse(dsub, 'median', n_threads = n_threads)
+    with pr.stage('normalization', file = f):
+        norm_data = med / normpwr
+
+    # centroid and sum the counts in the aperture
+    com, total_counts = _centroid_sum(norm_data, threshold, radius)
+
+    if norm_path is not None:
+        hdr['NORMPWR'] = normpwr
+        if air_sum is not None:
+            hdr['THRUPUT'] = total_counts / air_sum
+        with pr.stage('fits_write', file = norm_path, output_format = output_format):
+            prd.write_product(norm_path, norm_data, hdr, output_format, quantize_level, overwrite)
+
+    return com, total_counts
+
+@pr.profiled
+def measure_throughput(directory, wvls, threshold, radius, checkpoints = False, n_workers = 1, library_dir = None,
+                       output_format = 'native', quantize_level = prd.QUANTIZE_LEVEL, collapse_threads = 1,
+                       overwrite = True):
+    '''
+    Fused version of dark_subtract_2 -> normalize_photodiode_readings_aircal_2 -> get_throughput...every raw cube 
+    is read once and dark subtracted, median collapsed, normalized by its OPMPOWER reading, centroided and aperture 
+    summed in memory, so none of the intermediate fits files need to be written and read back
+
+    in:
+        directory (str) - greater directory containing the throughput data set
+        wvls (list of str) - wavelengths used in the experiment
+        threshold - value in counts for mod_centroid
+        radius (int) - radius in pixels for the aperture summing
+        checkpoints (bool) - if True, also write the '_dsub.fits' and '_dsub_norm.fits' products (with the NORMPWR 
+            and THRUPUT headers) to the same places the three step pipeline would
+        n_workers (int or None) - number of processes the files of every wavelength are spread over...1 runs 
+            serially, None uses every core
+        library_dir (str) - calibration library to keep the median darks in, as in dark_subtract_2
+        output_format (str) - format the checkpoints are written in, as in dark_subtract_2
+        quantize_level (float) - quantization of non-integer data in the compressed formats
+        collapse_threads (int) - threads every median is collapsed with (collapse_module), on top of n_workers
+        overwrite (bool) - replace the checkpoints of an earlier run...False refuses to, as writeto does
 
-            # centroid the image
-            pos_com = mod_centroid(pos, threshold)
+    out:
+        results (astropy Table) - one row per air_cal / position file with the wavelength, file, type, normalized 
+            photodiode reading, centroid, aperture sum and throughput (1 for the air_cal)...False if a wavelength 
+            has more than one dark or air_cal
+    '''
+
+    if not prd.check_format(output_format):
+        return False
+
+    # predefine lists that will hold the dark and the files of each wavelength
+    drk_files = []
+    air_files = []
+    pos_lists = []
+
+    for wvl in wvls:
+
+        # the same file selection as dark_subtract_2...raw files only, not the products
+        pattern = os.path.join(directory,'**','*'+wvl+'*.fits')
+        with pr.stage('glob', pattern = pattern):
+            file_list = [f for f in glob.glob(pattern, recursive = True) if '_dsub' not in f]
+
+        pos_list = []
+        air_list = []
+        drk_list = []
+
+        for f in file_list:
+            if 'Air' in f:
+                air_list.append(f)
+            elif 'Dark' in f:
+                drk_list.append(f)
+            else:
+                pos_list.append(f)
+
+        if len(drk_list) > 1:
+            print('More than one dark frame detected for wvl: '+ str(wvl))
+            return False
+
+        if len(air_list) > 1:
+            print('More than one air_cal frame detected for wvl: '+ str(wvl))
+            return False
+
+        drk_files.append(drk_list[0])
+        air_files.append(air_list[0])
+        pos_lists.append(pos_list)
+
+    ## step 1: median darks for every wavelength
+
+    drk_meds = _dark_medians(drk_files, library_dir, n_workers, collapse_threads)
+
+    ## step 2: median photodiode readings from the headers only, normalized by the air_cal of each wavelength
+
+    normpwrs = []
+    for f_air, pos_list in zip(air_files, pos_lists):
+        air_cal_med = _median_opmpower(fits.getheader(f_air))
+        normpwrs.append([_median_opmpower(fits.getheader(f)) / air_cal_med for f in [f_air] + pos_list])
+
+    ## step 3: the air_cal of every wavelength
+
+    def paths(f, marker):
+        if not checkpoints:
+            return None, None
+        dsub_path = _product_path(f, marker, '_dsub.fits')
+        return dsub_path, _product_path(dsub_path, marker, '_norm.fits')
+
+    jobs = []
+    for f_air, drk_med, normpwr in zip(air_files, drk_meds, normpwrs):
+        jobs.append((_measure_file, (f_air, drk_med, normpwr[0], threshold, radius, None) + paths(f_air, 'Air_Meas') +
+                     (output_format, quantize_level, collapse_threads, overwrite)))
+
+    air_results = _run_jobs(jobs, n_workers)
+
+    ## step 4: every position measurement, relative to the air_cal of its wavelength
 
-            # sum counts in aperture
-            pos_sum = aperture_sum(pos, pos_com, radius)
+    jobs = []
+    for pos_list, drk_med, normpwr, (air_com, air_sum) in zip(pos_lists, drk_meds, normpwrs, air_results):
+        for f, pwr in zip(pos_list, normpwr[1:]):
+            if np.isnan(pwr):
+                print('OPMPOWER not found, skipping '+f)
+                continue
+            jobs.append((_measure_file, (f, drk_med, pwr, threshold, radius, air_sum) + paths(f, 'D') +
+                         (output_format, quantize_level, collapse_threads, overwrite)))
 
-            # calculate thruoghput
-            throughput = pos_sum / air_sum
+    pos_results = iter(_run_jobs(jobs, n_workers))
 
-            # add throughput to the header of the dark subtracted file
-            with fits.open(pos_list[i], mode='update') as hdul_p:
-                hdr_p = hdul_p[0].header
-                hdr_p['THRUPUT'] = throughput
-                print(throughput)
+    ## step 5: the results table
+
+    rows = []
+    for wvl, f_air, pos_list, normpwr, (air_com, air_sum) in zip(wvls, air_files, pos_lists, normpwrs, air_results):
+        rows.append((wvl, f_air, 'air', normpwr[0], air_com[0], air_com[1], air_sum, 1.0))
+
+        for f, pwr in zip(pos_list, normpwr[1:]):
+            if np.isnan(pwr):
+                continue
+            pos_com, pos_sum = next(pos_results)
+            rows.append((wvl, f, 'position', pwr, pos_com[0], pos_com[1], pos_sum, pos_sum / air_sum))
 
         print('finished with wavelength: ' + wvl)
 
+    names = ('wvl', 'file', 'type', 'normpwr', 'com_y', 'com_x', 'aperture_sum', 'throughput')
+    return Table(rows = rows, names = names)
+
 ######################################################################################################################
 
-def throughput_readout(directory, wvl):
+def throughput_readout(directory, wvl, refresh = True):
     '''
     Takes thruput values from '...norm_dsub.fit' files and plots the throughputs as a function of wavelength 
 
     ***takes a single wavelength as a string, not a list of wavelengths***
-    '''
-
-    # define list of filenames 
-    pattern = os.path.join(directory,'**','*'+ wvl +'*dsub_norm.fits')
-    file_list = glob.glob(pattern, recursive = True)
 
-    # predefine list for files with wavlength of wvl
-    meas_list = []
+    the THRUPUT values come from the header catalog (catalog_module)...refresh = False skips the check for new
+        or changed files, which is only safe if nothing has been written since the last update
+    '''
 
-    # loop through the files and append the thruput values to the list
-    for f in file_list:
-        if 'Air' not in f:
-            meas_list.append(f)
-        
-    # we now have a list of filenames that will contain thruput measurements...
+    # the catalogued measurement files for this wavelength, i.e. everything but the air_cal
+    rows = cm.query_catalog(directory, '*'+ wvl +'*dsub_norm.fits', refresh = refresh)
+    meas_list = [row for row in rows if row['kind'] != 'air']
         
     # predefine a list that will contain the throughput values
     thruput_list = []
 
-    # loop through the files...open, read header, append header to list
-    for f in meas_list:
-        with fits.open(f) as hdul:
-            hdr = hdul[0].header
-            try:
-                thruput = hdr['THRUPUT']
-                thruput_list.append(float(thruput))
-            except KeyError:
-                print('THRUPUT keyword not found in header of file: ' + f)
+    # loop through the files...append the catalogued header to the list
+    for row in meas_list:
+        if row['thruput'] is None:
+            print('THRUPUT keyword not found in header of file: ' + row['path'])
+        else:
+            thruput_list.append(row['thruput'])
 
     # convert the wvl to a float
     wavelength = float(wvl)
@@ -452,7 +957,7 @@ def throughput_readout(directory, wvl):
     return thruput_list, wavelength 
 
 
-def plot_thruput(directory, wvls):
+def plot_thruput(directory, wvls, refresh = True):
     '''
     uses get_thruput to create a plot of the average throughput as a function of wavelength...
     error bars are one standard deviation
@@ -460,8 +965,12 @@ def plot_thruput(directory, wvls):
     in:
         directory (str) - location of all the measurements
         wvls (str) - list of strings containing wavelengths for each measurement
+        refresh (bool) - bring the header catalog up to date first
     '''
 
+    if refresh:
+        cm.update_catalog(directory)
+
     # initialize a list for averages, stds, and integer wavelengths
     avg_thruput_list = []
     std_list = []
@@ -471,7 +980,7 @@ def plot_thruput(directory, wvls):
     for wvl in wvls:
 
         # get thruputs and wvls using throughput_readout
-        thruput_list, wavelength = throughput_readout(directory, wvl)
+        thruput_list, wavelength = throughput_readout(directory, wvl, refresh = False)
 
         # append the integer wavelength to the list
         wvls_int.append(wavelength)
@@ -493,28 +1002,14 @@ def plot_thruput(directory, wvls):
     plt.grid(which = 'minor', color = 'lightgray', linestyle = '-', linewidth = 0.5)
     plt.show()
     
-def plot_wavelength(directory, wvl, pos_list = ['h3_v1', 'h3_v2', 'h3_v3', 'h3_v4', 'h3_v5', 'h3_v6', 'h4_v1', 'h4_v2', 'h4_v3', 'h4_v4', 'h4_v5', 'h4_v6', 'h5_v1', 'h5_v2', 'h5_v3', 'h5_v4', 'h5_v5', 'h5_v6', 'h6_v1', 'h6_v2', 'h6_v3', 'h6_v4', 'h6_v5', 'h6_v6', 'h6_vt4']):
+def plot_wavelength(directory, wvl, pos_list = ['h3_v1', 'h3_v2', 'h3_v3', 'h3_v4', 'h3_v5', 'h3_v6', 'h4_v1', 'h4_v2', 'h4_v3', 'h4_v4', 'h4_v5', 'h4_v6', 'h5_v1', 'h5_v2', 'h5_v3', 'h5_v4', 'h5_v5', 'h5_v6', 'h6_v1', 'h6_v2', 'h6_v3', 'h6_v4', 'h6_v5', 'h6_v6', 'h6_vt4'], refresh = True):
     '''
     plots all the thruput measurements taken at a given wavelength...x axis will be the 
-        position of the moving base
+        position of the moving base...the measurements are read from the header catalog in path order
     '''
 
-    # define the patern for the files
-    pattern = os.path.join(directory,'**','*'+ wvl +'*dsub_norm.fits')
-    file_list = glob.glob(pattern, recursive = True)
-
-    # readout the thruput measurements from each file...initiate a list first though
-    thruput_list = []
-
-    for f in file_list:
-        if 'Air' not in f:
-            with fits.open(f) as hdul:
-                hdr = hdul[0].header
-                try:
-                    thruput = hdr['THRUPUT']
-                    thruput_list.append(float(thruput))
-                except KeyError:
-                    print('THRUPUT keyword not found in header of file: ' + f)
+    # readout the thruput measurements from each file
+    thruput_list, wavelength = throughput_readout(directory, wvl, refresh = refresh)
 
     # create a scatterplot with thruput on y and pos_list on x
     plt.figure(figsize=(10, 6))